@@ -0,0 +1,68 @@
+"""Shared setup for the benchmarks.
+
+Benchmarks run against the database in `DATABASE_URL`, which defaults to
+`postgres://localhost/pgcrypto_fields_benchmarks`, using the models and the
+keys from the test suite.
+"""
+import os
+import sys
+import time
+
+import dj_database_url
+import django
+from django.conf import settings
+
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PUBLIC_PGP_KEY_PATH = os.path.join(BASEDIR, 'tests/keys/public.key')
+PRIVATE_PGP_KEY_PATH = os.path.join(BASEDIR, 'tests/keys/private.key')
+
+
+def setup(**extra_settings):
+    """Configure django and create the tables of the test models."""
+    sys.path.insert(0, BASEDIR)
+    settings.configure(
+        DATABASES={
+            'default': dj_database_url.config(
+                default='postgres://localhost/pgcrypto_fields_benchmarks'
+            ),
+        },
+        INSTALLED_APPS=(
+            'pgcrypto_fields',
+            'tests',
+        ),
+        MIDDLEWARE_CLASSES=(),
+        PUBLIC_PGP_KEY=open(PUBLIC_PGP_KEY_PATH, 'r').read(),
+        PRIVATE_PGP_KEY=open(PRIVATE_PGP_KEY_PATH, 'r').read(),
+        PGCRYPTO_KEY='ultrasecret',
+        **extra_settings
+    )
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0, interactive=False)
+
+
+def best_of(repeat, func, before=None):
+    """Run `func` `repeat` times and return the fastest wall time in seconds.
+
+    `before` is called before each run, out of the timing.
+    """
+    timings = []
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def statement_size(queryset):
+    """Size in bytes of the statement sent to postgres for `queryset`."""
+    from django.db import connections
+    from django.test.utils import CaptureQueriesContext
+
+    with CaptureQueriesContext(connections[queryset.db]) as context:
+        list(queryset[:1])
+    return len(context.captured_queries[0]['sql'])
@@ -0,0 +1,49 @@
+#! /usr/bin/env python
+"""Compare decryption with the private key written inline or bound as a parameter.
+
+Run with `python -m benchmarks.key_binding --rows 100000`.
+"""
+import argparse
+
+from benchmarks.base import best_of, setup, statement_size
+
+
+def main():
+    """Fill the table with `--rows` rows and time a full decrypting scan per mode."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    setup()
+
+    from pgcrypto_fields import KEY_BINDING_INLINE, KEY_BINDING_PARAM
+    from tests.models import EncryptedModel
+
+    EncryptedModel.objects.all().delete()
+    EncryptedModel.objects.bulk_create(
+        [
+            EncryptedModel(
+                email_pgp_pub_field='email{}@public.key'.format(i),
+                integer_pgp_pub_field=i,
+                pgp_pub_field='Text with public key {}'.format(i),
+            )
+            for i in range(args.rows)
+        ],
+        batch_size=1000,
+    )
+
+    manager = EncryptedModel.objects
+    for key_binding in (KEY_BINDING_INLINE, KEY_BINDING_PARAM):
+        manager.key_binding = key_binding
+        queryset = manager.all()
+        seconds = best_of(args.repeat, lambda: list(queryset.all()))
+        print('{:<8} {:>10.0f} rows/s {:>8} bytes/statement'.format(
+            key_binding,
+            args.rows / seconds,
+            statement_size(queryset),
+        ))
+
+
+if __name__ == '__main__':
+    main()
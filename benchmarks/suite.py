@@ -0,0 +1,284 @@
+#! /usr/bin/env python
+"""Measure the throughput of the PGP fields for each access path, as JSON.
+
+Each field of `pgcrypto_fields.fields` is measured on tables of `--rows` rows
+with `--columns` columns of the field, for every operation:
+
+- `insert`: `Model.objects.create()`, on `--sample` rows;
+- `bulk_create` and `bulk_create_encrypted`: all the rows;
+- `get`: `Model.objects.get(pk=...)`, on `--sample` rows;
+- `scan`: decrypting every column of every row with `PGPEncryptedManager`;
+- `values_list`: decrypting every column with `values_list()`;
+- `filter`: comparing the decrypted value of a column in `WHERE`;
+- `aggregate`: aggregating the decrypted values of a column.
+
+Run with `python -m benchmarks.suite --rows 1000,10000 --columns 1,4 --output
+results.json` and compare two runs with `--compare before.json after.json`.
+"""
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+
+from benchmarks.base import BASEDIR, best_of, setup
+
+
+def get_value(field_class, i):
+    """Return the `i`-th value of the rows for a field of `field_class`."""
+    from django.db import models
+    from pgcrypto_fields.mixins import JSONPGPPublicKeyFieldMixin
+
+    if issubclass(field_class, JSONPGPPublicKeyFieldMixin):
+        return {'value': i, 'text': 'Text value {}'.format(i)}
+    if issubclass(field_class, models.EmailField):
+        return 'user{}@example.com'.format(i)
+    if issubclass(field_class, models.IntegerField):
+        return i
+    if issubclass(field_class, models.DateField):
+        return datetime.date(2000, 1, 1) + datetime.timedelta(i % 3650)
+    if issubclass(field_class, models.NullBooleanField):
+        return i % 2 == 0
+    return 'Text value {}'.format(i)
+
+
+def get_field_classes(names=None):
+    """Return the PGP field classes of `fields.py`, or those named in `names`."""
+    from django.db import models
+    from pgcrypto_fields import fields
+    from pgcrypto_fields.mixins import PGPMixin
+
+    return [
+        value for name, value in sorted(vars(fields).items())
+        if isinstance(value, type) and issubclass(value, models.Field)
+        if issubclass(value, PGPMixin)
+        if not names or name in names
+    ]
+
+
+def get_plain_field(field_class):
+    """Return a field of the type decrypted from a field of `field_class`.
+
+    Filters on decrypted values then compare them as plain values, instead of
+    encrypting the looked up value as the lookups of the deterministic fields do.
+    JSON values are decrypted to `jsonb`, compared like the field does.
+    """
+    from pgcrypto_fields.mixins import JSONPGPPublicKeyFieldMixin
+
+    if issubclass(field_class, JSONPGPPublicKeyFieldMixin):
+        return field_class()
+    for base in field_class.__mro__:
+        if base.__module__.startswith('django.db.models'):
+            return base()
+
+
+def create_model(field_class, columns):
+    """Create the table of a model with `columns` columns of `field_class`."""
+    from django.db import connection, models
+    from pgcrypto_fields.managers import PGPEncryptedManager
+
+    attrs = {
+        '__module__': 'tests.models',
+        'Meta': type('Meta', (), {'app_label': 'tests'}),
+        'objects': PGPEncryptedManager(),
+    }
+    for i in range(columns):
+        attrs['c{}'.format(i)] = field_class(blank=True, null=True)
+    name = 'Benchmark{}{}'.format(field_class.__name__, columns)
+    model = type(str(name), (models.Model,), attrs)
+
+    with connection.schema_editor() as editor:
+        editor.create_model(model)
+    return model
+
+
+def drop_model(model):
+    """Drop the table of `model` and forget the model."""
+    from django.apps import apps
+    from django.db import connection
+
+    with connection.schema_editor() as editor:
+        editor.delete_model(model)
+    del apps.all_models['tests'][model._meta.model_name]
+    apps.clear_cache()
+
+
+def get_timings(model, rows, sample, repeat):
+    """Return `(operation, rows, seconds)` of each operation on `model`."""
+    from pgcrypto_fields.aggregates import DecryptedCount
+
+    names = [field.name for field in model._meta.fields if field.name != 'id']
+    field_class = type(model._meta.get_field(names[0]))
+    decrypt = field_class.aggregate
+    objs = [
+        model(**{name: get_value(field_class, i) for name in names})
+        for i in range(rows)
+    ]
+
+    def reset():
+        model.objects.all().delete()
+        for obj in objs:
+            obj.pk = None
+
+    def insert():
+        for obj in objs[:sample]:
+            obj.save()
+
+    # The last bulk insert leaves the rows read by the other operations.
+    timings = [
+        ('insert', sample, best_of(repeat, insert, reset)),
+        ('bulk_create_encrypted', rows, best_of(
+            repeat,
+            lambda: model.objects.bulk_create_encrypted(objs),
+            reset,
+        )),
+        ('bulk_create', rows, best_of(
+            repeat,
+            lambda: model.objects.bulk_create(objs, batch_size=1000),
+            reset,
+        )),
+    ]
+
+    pks = list(model.objects.order_by('pk').values_list('pk', flat=True)[:sample])
+    decrypted = decrypt(names[0], output_field=get_plain_field(field_class))
+    filtered = model.objects.annotate(decrypted=decrypted).filter(
+        decrypted=get_value(field_class, rows // 2),
+    )
+    timings.extend([
+        ('get', len(pks), best_of(
+            repeat,
+            lambda: [model.objects.get(pk=pk) for pk in pks],
+        )),
+        ('scan', rows, best_of(repeat, lambda: list(model.objects.all()))),
+        ('values_list', rows, best_of(
+            repeat,
+            lambda: list(model.objects.values_list(*names)),
+        )),
+        ('filter', rows, best_of(repeat, lambda: list(filtered.values_list('pk')))),
+        ('aggregate', rows, best_of(
+            repeat,
+            lambda: model.objects.aggregate(
+                count=DecryptedCount(names[0], distinct=True),
+            ),
+        )),
+    ])
+    return timings
+
+
+def get_environment():
+    """Describe the versions measured, to compare results between runs."""
+    import django
+    from django.db import connection
+
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=BASEDIR,
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    connection.ensure_connection()
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'postgres': connection.pg_version,
+        'date': datetime.datetime.utcnow().isoformat(),
+    }
+
+
+def measure(model, rows, args):
+    """Return the results of the operations on `rows` rows of `model`."""
+    results = []
+    timings = get_timings(model, rows, min(args.sample, rows), args.repeat)
+    for operation, count, seconds in timings:
+        result = {
+            'field': type(model._meta.get_field('c0')).__name__,
+            'rows': rows,
+            'columns': len(model._meta.fields) - 1,
+            'operation': operation,
+            'seconds': seconds,
+            'rows_per_second': count / seconds if seconds else None,
+        }
+        results.append(result)
+        sys.stderr.write(
+            '{field} rows={rows} columns={columns} {operation}: '
+            '{rows_per_second} rows/s\n'.format(**result),
+        )
+    return results
+
+
+def run(args):
+    """Measure every field, table size and column count, return the results."""
+    results = []
+    for field_class in get_field_classes(args.fields):
+        for columns in args.columns:
+            model = create_model(field_class, columns)
+            try:
+                for rows in args.rows:
+                    results.extend(measure(model, rows, args))
+            finally:
+                drop_model(model)
+    return {'environment': get_environment(), 'results': results}
+
+
+def compare(before, after):
+    """Print the change of throughput of each measure from `before` to `after`."""
+    def key(result):
+        return tuple(
+            result[name] for name in ('field', 'rows', 'columns', 'operation')
+        )
+
+    previous = {key(result): result for result in before['results']}
+    for result in after['results']:
+        old = previous.get(key(result))
+        if not old or not old['rows_per_second'] or not result['rows_per_second']:
+            continue
+        change = result['rows_per_second'] / old['rows_per_second'] - 1
+        print('{:<36} {:>8} {:>3} {:<22} {:>+8.1%}'.format(*key(result) + (change,)))
+
+
+def integers(value):
+    """Parse a comma separated list of integers."""
+    return [int(part) for part in value.split(',')]
+
+
+def main():
+    """Run the suite, or compare the results of two runs."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=integers, default=[1000, 10000])
+    parser.add_argument('--columns', type=integers, default=[1, 4])
+    parser.add_argument(
+        '--fields',
+        type=lambda value: value.split(','),
+        help='Comma separated names of the fields, all by default.',
+    )
+    parser.add_argument('--sample', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='JSON file of the results, stdout by default.')
+    parser.add_argument(
+        '--compare',
+        nargs=2,
+        metavar=('BEFORE', 'AFTER'),
+        help='Print the changes between two JSON files of results.',
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            compare(json.load(before), json.load(after))
+        return
+
+    setup()
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#! /usr/bin/env python
+"""Compare decryption of the PGP public key and symmetric key field families.
+
+Run with `python -m benchmarks.symmetric_key --rows 100000`.
+"""
+import argparse
+import datetime
+
+from benchmarks.base import best_of, setup
+
+
+def main():
+    """Fill both tables with `--rows` rows and time a full decrypting export."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    setup()
+
+    from tests.models import EncryptedModel, SymmetricEncryptedModel
+
+    date = datetime.date(2000, 1, 1)
+    EncryptedModel.objects.all().delete()
+    EncryptedModel.objects.bulk_create(
+        [
+            EncryptedModel(
+                email_pgp_pub_field='email{}@public.key'.format(i),
+                integer_pgp_pub_field=i,
+                pgp_pub_field='Text with public key {}'.format(i),
+                pgp_pub_date_field=date,
+            )
+            for i in range(args.rows)
+        ],
+        batch_size=1000,
+    )
+    SymmetricEncryptedModel.objects.all().delete()
+    SymmetricEncryptedModel.objects.bulk_create(
+        [
+            SymmetricEncryptedModel(
+                email_pgp_sym_field='email{}@symmetric.key'.format(i),
+                integer_pgp_sym_field=i,
+                pgp_sym_field='Text with symmetric key {}'.format(i),
+                pgp_sym_date_field=date,
+            )
+            for i in range(args.rows)
+        ],
+        batch_size=1000,
+    )
+
+    models = (('public', EncryptedModel), ('symmetric', SymmetricEncryptedModel))
+    for name, model in models:
+        queryset = model.objects.all()
+        seconds = best_of(args.repeat, lambda: list(queryset.values_list()))
+        print('{:<10} {:>10.0f} rows/s'.format(name, args.rows / seconds))
+
+
+if __name__ == '__main__':
+    main()
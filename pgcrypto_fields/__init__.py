@@ -1,13 +1,76 @@
 from django.conf import settings
 
 
+default_app_config = 'pgcrypto_fields.apps.PGCryptoFieldsConfig'
+
 CAST_TO_TEXT = "nullif(%s, NULL)::text"
 
-INTEGER_PGP_PUB_ENCRYPT_SQL = "pgp_pub_encrypt({}, dearmor('{}'))".format(
+# Keys are written in the SQL as `dearmor('<armored key>')`...
+KEY_BINDING_INLINE = 'inline'
+# ...or dearmored once by the application and sent as a `bytea` parameter...
+KEY_BINDING_PARAM = 'param'
+# ...or stored once per database session and read by the functions installed by
+# the `0002_add_key_functions` migration.
+KEY_BINDING_SESSION = 'session'
+
+
+def get_key_binding(key_binding=None):
+    """Return `key_binding`, or else the `PGCRYPTO_KEY_BINDING` setting.
+
+    The setting is read when called, so this module can be imported before the
+    settings are configured and follows `override_settings`.
+    """
+    if key_binding is None:
+        return getattr(settings, 'PGCRYPTO_KEY_BINDING', KEY_BINDING_INLINE)
+    return key_binding
+
+
+# Keys are read from the `PGCRYPTO_KEY_PROVIDER` on first use, so the SQL
+# embedding them holds `{public_key}`, `{private_key}` and `{symmetric_key}`
+# fields, formatted by `keys.format_sql`.
+
+# Uncorrelated subqueries are evaluated once per statement, not once per row.
+PUBLIC_KEY_SQL = {
+    KEY_BINDING_INLINE: "dearmor('{public_key}')",
+    KEY_BINDING_PARAM: '%s',
+    KEY_BINDING_SESSION: '(SELECT pgcrypto_fields_pub_key())',
+}
+
+PRIVATE_KEY_SQL = {
+    KEY_BINDING_INLINE: "dearmor('{private_key}')",
+    KEY_BINDING_PARAM: '%s',
+    KEY_BINDING_SESSION: '(SELECT pgcrypto_fields_priv_key())',
+}
+
+# Previous private keys, still decrypting the values which have not been
+# re-encrypted by the `rotate_pgcrypto_keys` command, are formatted with their
+# armored key or id (see `keys.previous_private_keys`).
+PREVIOUS_PRIVATE_KEY_SQL = {
+    KEY_BINDING_INLINE: "dearmor('{armored}')",
+    KEY_BINDING_PARAM: '%s',
+    KEY_BINDING_SESSION: "(SELECT pgcrypto_fields_priv_key('{key_id}'))",
+}
+
+SYMMETRIC_KEY_SQL = {
+    KEY_BINDING_INLINE: "'{symmetric_key}'",
+    KEY_BINDING_PARAM: '%s',
+    KEY_BINDING_SESSION: '(SELECT pgcrypto_fields_sym_key())',
+}
+
+# Encryption SQL is formatted with the SQL of the key (`{key}`, see
+# `keys.encrypt_key_sql`) and the fields' `pgp_options`.
+INTEGER_PGP_PUB_ENCRYPT_SQL = "pgp_pub_encrypt({}, {{key}}{{options}})".format(
     CAST_TO_TEXT,
-    settings.PUBLIC_PGP_KEY,
 )
 
-PGP_PUB_ENCRYPT_SQL = "pgp_pub_encrypt(%s, dearmor('{}'))".format(
-    settings.PUBLIC_PGP_KEY,
+PGP_PUB_ENCRYPT_SQL = "pgp_pub_encrypt(%s, {key}{options})"
+
+PGP_SYM_ENCRYPT_SQL = "pgp_sym_encrypt({}, {{key}}{{options}})".format(CAST_TO_TEXT)
+
+# Installed by the `0005_add_deterministic_functions` migration.
+DETERMINISTIC_ENCRYPT_SQL = "pgcrypto_fields_det_encrypt({}, {{key}})".format(
+    CAST_TO_TEXT,
 )
+
+# Formatted with the SQL of the hashed value (`{value}`).
+HMAC_SQL = "hmac({}, '{{symmetric_key}}', 'sha256')".format(CAST_TO_TEXT % '{value}')
@@ -1,55 +1,437 @@
-from django.conf import settings
-from django.db import models
-from django.db.models.sql.aggregates import Aggregate
+from django.db.models import Avg, Count, Func, Max, Min, Sum
+from django.db.models.expressions import Col
 
+from pgcrypto_fields import (
+    CAST_TO_TEXT,
+    get_key_binding,
+    KEY_BINDING_PARAM,
+    keys,
+    PREVIOUS_PRIVATE_KEY_SQL,
+    PRIVATE_KEY_SQL,
+    PUBLIC_KEY_SQL,
+    SYMMETRIC_KEY_SQL,
+)
 
-class PGPPublicKeySQL(Aggregate):
-    """Custom SQL aggregate to decrypt a field with public key.
 
-    `PGPPublicKeySQL` provides a SQL template using pgcrypto to decrypt
-    data from a field in the database.
+# Alias of the keys bound once per statement with `KEY_BINDING_PARAM`.
+KEYS_ALIAS = 'pgcrypto_keys'
 
-    `sql_function` defines `pgp_pub_decrypt` which is a pgcrypto SQL function.
-    This function takes two arguments:
+
+class BoundKeys(object):
+    """Keys sent once per statement as query parameters, with `KEY_BINDING_PARAM`.
+
+    `bind_keys` adds it to the `FROM` clause of the queries decrypting values:
+
+        CROSS JOIN (SELECT %s::bytea AS private_key) AS pgcrypto_keys
+
+    and the decrypt expressions read the keys from its columns (see
+    `read_bound_keys`), so each key is sent once whatever the number of
+    decrypted columns. `names` are those of the keys: `private_key`, with the
+    previous private keys, and `symmetric_key`.
+
+    The join is only written when a decrypt expression of the query reads it.
+    """
+    join_type = None
+    parent_alias = None
+    nullable = False
+    table_name = KEYS_ALIAS
+
+    def __init__(self, names, table_alias=KEYS_ALIAS):
+        """Bind the keys `names`, selected as `table_alias`."""
+        self.names = frozenset(names)
+        self.table_alias = table_alias
+
+    def as_sql(self, compiler, connection):
+        """Select the keys from their query parameters, if they are read."""
+        joined = compiler.__dict__.setdefault('bound_keys_joined', set())
+        if self.table_alias not in getattr(compiler, 'bound_keys_read', ()):
+            return '', []
+        joined.add(self.table_alias)
+
+        columns = []
+        params = []
+        if 'private_key' in self.names:
+            columns.append('%s::bytea AS private_key')
+            params.extend(keys.private_key_params(KEY_BINDING_PARAM))
+            for key_id in keys.previous_private_keys():
+                columns.append('%s::bytea AS {}'.format(previous_key_column(key_id)))
+            params.extend(keys.previous_private_key_params(KEY_BINDING_PARAM))
+        if 'symmetric_key' in self.names:
+            columns.append('%s::text AS symmetric_key')
+            params.extend(keys.symmetric_key_params(KEY_BINDING_PARAM))
+        sql = 'CROSS JOIN (SELECT {}) AS {}'.format(', '.join(columns), self.table_alias)
+        return sql, params
+
+    def relabeled_clone(self, change_map):
+        """Return a copy selected as the alias `change_map` gives."""
+        return self.__class__(
+            self.names,
+            change_map.get(self.table_alias, self.table_alias),
+        )
+
+    def __eq__(self, other):
+        """Tell if `other` binds the same keys."""
+        return isinstance(other, BoundKeys) and other.names == self.names
+
+    def __ne__(self, other):
+        """Tell if `other` binds other keys."""
+        return not self == other
+
+    def __hash__(self):
+        """Hash the names of the keys."""
+        return hash(self.names)
+
+
+def previous_key_column(key_id):
+    """Name of the column of `BoundKeys` holding the previous private key `key_id`."""
+    return 'private_key_{}'.format(key_id.lower())
+
+
+def get_keys_alias(query, name):
+    """Return the alias of the `BoundKeys` of `query` holding the key `name`, if any."""
+    for alias in query.tables:
+        bound_keys = query.alias_map.get(alias)
+        if not isinstance(bound_keys, BoundKeys) or not query.alias_refcount[alias]:
+            continue
+        if name in bound_keys.names:
+            return alias
+    return None
+
+
+def bind_keys(query, name):
+    """Add the key `name` to the `BoundKeys` of `query`, joining them if needed."""
+    if get_keys_alias(query, name) is not None:
+        return
+    if not query.tables:
+        query.get_initial_alias()
+    for alias in query.tables:
+        bound_keys = query.alias_map.get(alias)
+        if isinstance(bound_keys, BoundKeys) and query.alias_refcount[alias]:
+            # Clones of the query share the `alias_map` entries, so it is replaced.
+            query.alias_map[alias] = BoundKeys(bound_keys.names | {name}, alias)
+            return
+    alias, _ = query.table_alias(KEYS_ALIAS, create=True)
+    query.alias_map[alias] = BoundKeys([name], alias)
+
+
+def read_bound_keys(compiler, name):
+    """Return the alias of the bound keys a decrypt compiled by `compiler` can read.
+
+    Only `SELECT` statements join the keys: their select list, ordering and
+    grouping are compiled before the `FROM` clause, which then joins the keys
+    they read. Expressions compiled afterwards, in `WHERE` or `HAVING`, only read
+    keys which were joined. Without an alias the keys are sent as parameters.
+    """
+    alias = get_keys_alias(compiler.query, name)
+    select_compiler = compiler.connection.ops.compiler('SQLCompiler')
+    if alias is None or type(compiler) is not select_compiler:
+        return None
+    joined = getattr(compiler, 'bound_keys_joined', None)
+    if joined is not None:
+        return alias if alias in joined else None
+    compiler.__dict__.setdefault('bound_keys_read', set()).add(alias)
+    return alias
+
+
+class PGPPublicKeyDecrypt(Func):
+    """Decrypt a PGP public key encrypted field with the private key.
+
+    `PGPPublicKeyDecrypt` is an expression using pgcrypto to decrypt data from a
+    field in the database. Column references are resolved by the query, so it can
+    be used in `annotate`, `filter`, `order_by`, `values` or through relations.
+
+    `function` is `pgp_pub_decrypt`, a pgcrypto SQL function which takes two
+    arguments:
     - a encrypted message (bytea);
     - a key (bytea).
 
-    `%(function)s` in `sql_template` is populated by `sql_function`.
+    `key_binding` defines how the private key is sent to postgres, the
+    `PGCRYPTO_KEY_BINDING` setting by default.
 
-    `%(field)s` is replaced with the field's name.
+    If the field needs an explicit cast (`cast_sql`), the decrypted value is cast
+    to the field's type.
 
-    `dearmor` is used to unwrap the key from the PGP key.
+    With `settings.PREVIOUS_PRIVATE_PGP_KEYS`, values are decrypted with the key
+    matching their `pgp_key_id`, until they are re-encrypted with the current key.
+
+    With `KEY_BINDING_PARAM`, the keys are bound once per query (see `BoundKeys`).
     """
-    sql_function = 'pgp_pub_decrypt'
-    sql_template = "%(function)s(%(field)s, dearmor('{}'))".format(
-        settings.PRIVATE_PGP_KEY,
-    )
+    function = 'pgp_pub_decrypt'
+    template = '%(function)s(%(expressions)s, %(key)s)'
+    name = 'Decrypted'
+    key_sql = PRIVATE_KEY_SQL
+    key_name = 'private_key'
+
+    def __init__(self, expression, key_binding=None, **extra):
+        """Decrypt `expression` with the key sent as defined by `key_binding`."""
+        self.key_binding = get_key_binding(key_binding)
+        super(PGPPublicKeyDecrypt, self).__init__(expression, **extra)
+
+    @property
+    def default_alias(self):
+        """Name the annotation `<field name>__decrypted`."""
+        return '{}__{}'.format(self.source_expressions[0].name, self.name.lower())
+
+    @classmethod
+    def cast(cls, field, sql):
+        """Cast decrypted `sql` to the type of `field` if it needs it."""
+        if hasattr(field, 'cast_sql'):
+            return field.cast_sql % sql
+        return sql
 
+    @classmethod
+    def get_decrypt_sql(cls, field, column, key_binding=None, column_params=(),
+                        keys_alias=None):
+        """Return the SQL decrypting `column` holding values of `field`, and its params.
 
-class EncryptionBase(models.Aggregate):
-    """Base class to add a custom aggregate method to a query."""
+        `column_params` are the query parameters of `column`. With `keys_alias`,
+        the keys are read from the `BoundKeys` of the query.
+        """
+        key_sql, key_params = cls.get_key_sql(
+            column,
+            column_params,
+            key_binding,
+            keys_alias,
+        )
+        sql = cls.template % {
+            'function': cls.function,
+            'expressions': column,
+            'key': key_sql,
+        }
+        return cls.cast(field, sql), list(column_params) + key_params
+
+    @classmethod
+    def get_key_sql(cls, column, column_params=(), key_binding=None,
+                    keys_alias=None):
+        """Return the SQL of the key decrypting `column`, and its parameters.
+
+        The key is picked by the id of the key which encrypted each value when
+        there are previous private keys:
+
+            CASE pgp_key_id(column) WHEN '<id>' THEN <previous key> ELSE <key> END
+        """
+        key_binding = get_key_binding(key_binding)
+        if keys_alias is not None:
+            key_sql = '{}.private_key'.format(keys_alias)
+            key_params = []
+        else:
+            key_sql = keys.format_sql(cls.key_sql[key_binding])
+            key_params = cls.get_key_params(key_binding)
+        previous_keys = keys.previous_private_keys()
+        if not previous_keys:
+            return key_sql, key_params
 
-    def add_to_query(self, query, alias, col, source, is_summary):
-        """Add the aggregate to the query.
+        cases = [
+            "WHEN '{}' THEN {}".format(
+                key_id,
+                '{}.{}'.format(keys_alias, previous_key_column(key_id))
+                if keys_alias is not None else
+                keys.format_sql(
+                    PREVIOUS_PRIVATE_KEY_SQL[key_binding],
+                    armored=keys.escape_sql(armored),
+                    key_id=key_id,
+                ),
+            )
+            for key_id, armored in previous_keys.items()
+        ]
+        sql = 'CASE pgp_key_id({}) {} ELSE {} END'.format(
+            column,
+            ' '.join(cases),
+            key_sql,
+        )
+        params = list(column_params)
+        if keys_alias is None:
+            params.extend(keys.previous_private_key_params(key_binding))
+        return sql, params + key_params
+
+    @classmethod
+    def get_key_params(cls, key_binding=None):
+        """Query parameters needed by the key SQL."""
+        return keys.private_key_params(get_key_binding(key_binding))
+
+    @classmethod
+    def read_bound_keys(cls, compiler, key_binding=None):
+        """Return the alias of the keys bound to the query of `compiler`, if any."""
+        if get_key_binding(key_binding) != KEY_BINDING_PARAM:
+            return None
+        return read_bound_keys(compiler, cls.key_name)
+
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None,
+                           summarize=False, for_save=False):
+        """Bind the keys to `query` with `KEY_BINDING_PARAM`."""
+        clone = super(PGPPublicKeyDecrypt, self).resolve_expression(
+            query,
+            allow_joins,
+            reuse,
+            summarize,
+            for_save,
+        )
+        if query is not None and self.key_binding == KEY_BINDING_PARAM:
+            bind_keys(query, self.key_name)
+        return clone
 
-        `alias` is `{self.lookup}__decrypt` where 'decrypt' is `self.name.lower()`.
+    def as_sql(self, compiler, connection):
+        """Decrypt and cast the value, adding the key parameters.
 
-        `self.lookup` is defined in `models.Aggregate.__init__`.
+        Queries without bound keys, such as the outer query of an aggregation on
+        a subquery or an `UPDATE`, get them as parameters.
         """
-        aggregate = self.sql(
-            col,
-            source=source,
-            is_summary=is_summary,
-            **self.extra
+        expression = self.source_expressions[0]
+        sql, params = compiler.compile(expression)
+        return self.get_decrypt_sql(
+            expression.output_field,
+            sql,
+            self.key_binding,
+            params,
+            self.read_bound_keys(compiler, self.key_binding),
         )
-        query.aggregates[alias] = aggregate
 
 
-class PGPPublicKeyAggregate(EncryptionBase):
-    """PGP public key based aggregation.
+class PGPPublicKeyEncrypt(Func):
+    """Encrypt a value with the PGP public key.
 
-    `pgp_pub_encrypt` and `dearmor` are pgcrypto functions which encrypt
-    the field's value with the PGP key unwrapped by `dearmor`.
+    `PGPPublicKeyEncrypt` can be used to write to a PGP public key field from
+    another expression, for example with `update`.
     """
-    name = 'decrypted'
-    sql = PGPPublicKeySQL
+    function = 'pgp_pub_encrypt'
+    template = '%(function)s({}, %(key)s)'.format(CAST_TO_TEXT % '%(expressions)s')
+    key_sql = PUBLIC_KEY_SQL
+
+    def as_sql(self, compiler, connection, function=None, template=None):
+        """Encrypt with the current key."""
+        self.extra['key'] = keys.encrypt_key_sql(self.key_sql)
+        return super(PGPPublicKeyEncrypt, self).as_sql(
+            compiler,
+            connection,
+            function,
+            template,
+        )
+
+
+class PGPSymmetricKeyDecrypt(PGPPublicKeyDecrypt):
+    """Decrypt a PGP symmetric key encrypted field with `settings.PGCRYPTO_KEY`.
+
+    `function` is `pgp_sym_decrypt`, which reads the cipher and compression
+    algorithms from the message, so any `pgp_options` can be decrypted.
+    """
+    function = 'pgp_sym_decrypt'
+    key_sql = SYMMETRIC_KEY_SQL
+    key_name = 'symmetric_key'
+
+    @classmethod
+    def get_key_sql(cls, column, column_params=(), key_binding=None,
+                    keys_alias=None):
+        """Return the SQL of `settings.PGCRYPTO_KEY`, and its parameters."""
+        if keys_alias is not None:
+            return '{}.symmetric_key'.format(keys_alias), []
+        key_binding = get_key_binding(key_binding)
+        key_sql = keys.format_sql(cls.key_sql[key_binding])
+        return key_sql, cls.get_key_params(key_binding)
+
+    @classmethod
+    def get_key_params(cls, key_binding=None):
+        """Query parameters needed by the key SQL."""
+        return keys.symmetric_key_params(get_key_binding(key_binding))
+
+
+class PGPSymmetricKeyEncrypt(PGPPublicKeyEncrypt):
+    """Encrypt a value with `settings.PGCRYPTO_KEY`.
+
+    `PGPSymmetricKeyEncrypt` can be used to write to a PGP symmetric key field
+    from another expression, for example with `update`.
+    """
+    function = 'pgp_sym_encrypt'
+    key_sql = SYMMETRIC_KEY_SQL
+
+
+class DeterministicDecrypt(PGPSymmetricKeyDecrypt):
+    """Decrypt a deterministic field with `settings.PGCRYPTO_KEY`.
+
+    `function` is installed by the `0005_add_deterministic_functions` migration.
+    """
+    function = 'pgcrypto_fields_det_decrypt'
+
+
+class DeterministicEncrypt(PGPSymmetricKeyEncrypt):
+    """Encrypt a value for a deterministic field with `settings.PGCRYPTO_KEY`.
+
+    `DeterministicEncrypt` can be used to write to a deterministic field from
+    another expression, for example with `update`.
+    """
+    function = 'pgcrypto_fields_det_encrypt'
+
+
+class DecryptedAggregateMixin(object):
+    """Aggregate the decrypted values of a PGP field, in postgres.
+
+    The column is decrypted and cast by the decrypt expression of its field
+    (`field.aggregate`) inside the aggregate, so only the result is returned:
+
+        SUM(CAST(nullif(pgp_pub_decrypt(column, <key>), '') AS integer))
+
+    pgcrypto's functions, and those of the `0006_parallel_safe_functions`
+    migration, are parallel safe, so postgres can decrypt the rows of large
+    tables in parallel workers. Expressions which are not columns are
+    aggregated as they are.
+    """
+    def __init__(self, expression, key_binding=None, **extra):
+        """Decrypt with the key sent as defined by `key_binding`."""
+        self.key_binding = get_key_binding(key_binding)
+        super(DecryptedAggregateMixin, self).__init__(expression, **extra)
+
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None,
+                           summarize=False, for_save=False):
+        """Decrypt the resolved column."""
+        clone = super(DecryptedAggregateMixin, self).resolve_expression(
+            query,
+            allow_joins,
+            reuse,
+            summarize,
+            for_save,
+        )
+        expression = clone.source_expressions[0]
+        decrypt = getattr(expression.output_field, 'aggregate', None)
+        if isinstance(expression, Col) and decrypt is not None:
+            clone.set_source_expressions([
+                decrypt(expression, key_binding=self.key_binding).resolve_expression(
+                    query,
+                    allow_joins,
+                    reuse,
+                    summarize,
+                ),
+            ])
+        return clone
+
+
+class DecryptedSum(DecryptedAggregateMixin, Sum):
+    """Sum the decrypted values of a PGP field."""
+
+
+class DecryptedAvg(DecryptedAggregateMixin, Avg):
+    """Average the decrypted values of a PGP field."""
+
+
+class DecryptedMin(DecryptedAggregateMixin, Min):
+    """Return the smallest decrypted value of a PGP field."""
+
+
+class DecryptedMax(DecryptedAggregateMixin, Max):
+    """Return the largest decrypted value of a PGP field."""
+
+
+class DecryptedCount(DecryptedAggregateMixin, Count):
+    """Count the decrypted values of a PGP field, distinct ones with `distinct`."""
+
+
+def contains_decryption(expression):
+    """Return whether `expression` decrypts values in postgres."""
+    if isinstance(expression, (PGPPublicKeyDecrypt, DecryptedAggregateMixin)):
+        return True
+    return any(
+        contains_decryption(source)
+        for source in getattr(expression, 'get_source_expressions', list)()
+    )
+
+
+# Kept for backwards compatibility.
+PGPPublicKeyAggregate = PGPPublicKeyDecrypt
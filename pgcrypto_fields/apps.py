@@ -0,0 +1,49 @@
+from django.apps import AppConfig
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from pgcrypto_fields import get_key_binding, instrumentation, KEY_BINDING_SESSION, keys
+
+
+def uses_session_keys():
+    """Tell if the `PGCRYPTO_KEY_BINDING` setting stores the keys in the sessions."""
+    return get_key_binding() == KEY_BINDING_SESSION
+
+
+def send_session_keys(sender, connection, **kwargs):
+    """Store the PGP keys in each new postgres database session."""
+    if connection.vendor == 'postgresql' and uses_session_keys():
+        keys.set_session_keys(connection)
+
+
+def refresh_session_keys(sender, **kwargs):
+    """Store the PGP keys again in the open sessions when they were reloaded."""
+    if not uses_session_keys():
+        return
+    for connection in connections.all():
+        if connection.vendor == 'postgresql':
+            keys.refresh_session_keys(connection)
+
+
+class PGCryptoFieldsConfig(AppConfig):
+    """Application configuration of `pgcrypto_fields`."""
+    name = 'pgcrypto_fields'
+    verbose_name = 'pgcrypto fields'
+
+    def ready(self):
+        """Send the PGP keys to new database sessions when they are read from it.
+
+        Sessions opened before the keys are reloaded by the key provider get the
+        new keys at the start of the next request. The receivers read the
+        `PGCRYPTO_KEY_BINDING` setting when they are called.
+
+        With the `PGCRYPTO_INSTRUMENTATION` setting, every connection sends the
+        `instrumentation.pgcrypto_query` signal.
+        """
+        connection_created.connect(send_session_keys)
+        request_started.connect(refresh_session_keys)
+        if getattr(settings, 'PGCRYPTO_INSTRUMENTATION', False):
+            connection_created.connect(instrumentation.install_connection)
+            request_started.connect(instrumentation.install_connections)
@@ -0,0 +1,213 @@
+import atexit
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.utils import six
+from django.utils.module_loading import import_string
+
+from pgcrypto_fields import keys
+
+try:
+    import pgpy
+    from pgpy.constants import CompressionAlgorithm
+except ImportError:
+    pgpy = None
+
+
+DEFAULT_BACKEND = 'pgcrypto_fields.backends.DatabaseBackend'
+
+BATCH_DECRYPT_SQL = (
+    'SELECT {} FROM unnest(%s::bytea[]) WITH ORDINALITY AS t(ciphertext, ordinal) '
+    'ORDER BY ordinal'
+)
+
+_backends = {}
+_pgp_keys = {}
+
+
+def get_backend(path=None):
+    """Return the backend at `path`, or `PGCRYPTO_BACKEND`, created once per process.
+
+    Backends are created with the keyword arguments found under their path in the
+    `PGCRYPTO_BACKEND_OPTIONS` setting.
+    """
+    path = path or getattr(settings, 'PGCRYPTO_BACKEND', DEFAULT_BACKEND)
+    try:
+        return _backends[path]
+    except KeyError:
+        options = getattr(settings, 'PGCRYPTO_BACKEND_OPTIONS', {}).get(path, {})
+        backend = _backends[path] = import_string(path)(**options)
+        return backend
+
+
+def decrypt_values(field, values, using='default', key_binding=None):
+    """Decrypt a list of `field` ciphertexts with postgres in one query."""
+    sql, params = field.aggregate.get_decrypt_sql(field, 'ciphertext', key_binding)
+    sql = BATCH_DECRYPT_SQL.format(sql)
+    params = params + [values]
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+class DatabaseBackend(object):
+    """Encrypt and decrypt values with pgcrypto, in postgres."""
+    in_database = True
+
+    def decrypt(self, field, values, using='default', key_binding=None):
+        """Decrypt a list of `field` ciphertexts in one query."""
+        return decrypt_values(field, values, using, key_binding)
+
+
+def pgp_key(armored):
+    """Return the PGPy key of `armored`, parsed only once per process."""
+    try:
+        return _pgp_keys[armored]
+    except KeyError:
+        key, _ = pgpy.PGPKey.from_blob(armored)
+        _pgp_keys[armored] = key
+        return key
+
+
+def pgp_key_ids(key):
+    """Return the ids of the PGPy `key` and of its subkeys."""
+    return set(key.subkeys) | {key.fingerprint.keyid}
+
+
+def decrypt_message(ciphertext, private_key=None, passphrase=None,
+                    previous_private_keys=()):
+    """Decrypt a pgcrypto `ciphertext` with the armored `private_key` or `passphrase`.
+
+    Messages encrypted for one of the armored `previous_private_keys` are
+    decrypted with it. Return the decrypted text.
+    """
+    message = pgpy.PGPMessage.from_blob(ciphertext)
+    if passphrase is not None:
+        text = message.decrypt(passphrase).message
+    else:
+        key = pgp_key(private_key)
+        for armored in previous_private_keys:
+            if message.encrypters & pgp_key_ids(pgp_key(armored)):
+                key = pgp_key(armored)
+                break
+        text = key.decrypt(message).message
+    if isinstance(text, (bytes, bytearray)):
+        text = bytes(text).decode('utf-8')
+    return text
+
+
+def encrypt_message(text, public_key=None, passphrase=None):
+    """Encrypt `text` like pgcrypto with the armored `public_key` or `passphrase`."""
+    message = pgpy.PGPMessage.new(
+        text,
+        compression=CompressionAlgorithm.Uncompressed,
+    )
+    if passphrase is not None:
+        message = message.encrypt(passphrase)
+    else:
+        message = pgp_key(public_key).encrypt(message)
+    return bytes(message.__bytes__())
+
+
+class PGPyBackend(object):
+    """Encrypt and decrypt values in the Django process with PGPy.
+
+    The database only stores and returns the ciphertexts, in the OpenPGP format
+    used by pgcrypto, so the columns can still be read by the other backends.
+    The fields' `pgp_options` are not applied.
+
+    Batches of at least `min_batch_size` values are encrypted and decrypted by
+    `workers` threads, or processes if `processes` is set. PGPy being pure
+    Python, only processes use more than one CPU. The message functions take and
+    return texts and bytes, so the batches can be pickled for the processes.
+    """
+    in_database = False
+
+    def __init__(self, workers=0, processes=False, min_batch_size=100):
+        """Configure the pool used to decrypt large batches."""
+        if pgpy is None:
+            raise ImproperlyConfigured('PGPyBackend requires the PGPy package.')
+        self.workers = workers
+        self.processes = processes
+        self.min_batch_size = min_batch_size
+        self._pool = None
+        atexit.register(self.close)
+
+    @property
+    def pool(self):
+        """Pool of `workers` threads or processes, created on first use.
+
+        It is closed by `close`, or when the interpreter exits.
+        """
+        if self._pool is None:
+            pool_class = Pool if self.processes else ThreadPool
+            self._pool = pool_class(self.workers)
+        return self._pool
+
+    def close(self):
+        """Stop the workers of the pool, if any; a new pool is created on next use."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def get_keys(self, field):
+        """Return the keyword arguments of the message functions for `field`."""
+        key_set = keys.get_key_set()
+        if field.symmetric_key:
+            return {'passphrase': key_set.symmetric_key}
+        return {
+            'private_key': key_set.private_key,
+            'previous_private_keys': list(key_set.previous_private_keys),
+            'public_key': key_set.public_key,
+        }
+
+    def to_python(self, field, text):
+        """Convert decrypted `text` like the field's `cast_sql` does."""
+        if text is None or (text == '' and not field.empty_strings_allowed):
+            return None
+        return field.to_python(text)
+
+    def decrypt(self, field, values, using='default', key_binding=None):
+        """Decrypt a list of `field` ciphertexts, with the pool for large batches."""
+        message_keys = self.get_keys(field)
+        message_keys.pop('public_key', None)
+        func = partial(decrypt_message, **message_keys)
+
+        # Values are loaded as memoryviews, which can't be sent to processes.
+        ciphertexts = [bytes(value) for value in values if value is not None]
+        if self.workers > 1 and len(ciphertexts) >= self.min_batch_size:
+            texts = iter(self.pool.map(func, ciphertexts))
+        else:
+            texts = six.moves.map(func, ciphertexts)
+
+        return [
+            self.to_python(field, next(texts) if value is not None else None)
+            for value in values
+        ]
+
+    def encrypt(self, field, value):
+        """Encrypt the prepared `value` of `field`."""
+        return self.encrypt_values(field, [value])[0]
+
+    def encrypt_values(self, field, values):
+        """Encrypt a list of prepared `field` values, with the pool for large batches."""
+        message_keys = self.get_keys(field)
+        message_keys.pop('private_key', None)
+        message_keys.pop('previous_private_keys', None)
+        func = partial(encrypt_message, **message_keys)
+
+        texts = [six.text_type(value) for value in values if value is not None]
+        if self.workers > 1 and len(texts) >= self.min_batch_size:
+            ciphertexts = iter(self.pool.map(func, texts))
+        else:
+            ciphertexts = six.moves.map(func, texts)
+
+        return [
+            next(ciphertexts) if value is not None else None
+            for value in values
+        ]
@@ -0,0 +1,218 @@
+from django.db import models
+from django.utils import six
+
+from pgcrypto_fields import (
+    get_key_binding,
+    keys,
+    PUBLIC_KEY_SQL,
+    SYMMETRIC_KEY_SQL,
+)
+from pgcrypto_fields.mixins import PGPMixin
+
+
+# Size of the query parameters sent in one statement.
+MAX_BATCH_BYTES = 1024 * 1024
+
+INSERT_SQL = 'INSERT INTO {table} ({columns}) SELECT {values} FROM {source}'
+UPDATE_SQL = 'UPDATE {table} SET {assignments} FROM {source} WHERE {table}.{pk} = {key}'
+SOURCE_SQL = '(VALUES {rows}) AS v({columns})'
+KEYS_SQL = ' CROSS JOIN (SELECT {keys}) AS k'
+
+
+def value_size(value):
+    """Approximate size in bytes of a query parameter."""
+    if value is None:
+        return 4
+    if isinstance(value, six.text_type):
+        return len(value.encode('utf-8'))
+    if isinstance(value, (six.binary_type, six.memoryview)):
+        return len(value)
+    return len(six.text_type(value))
+
+
+class EncryptedBatch(object):
+    """Rows written to a model in one statement, with the keys bound only once.
+
+    Values are sent in a `VALUES` list and encrypted by postgres from a single
+    `CROSS JOIN` on the keys, instead of repeating the keys for every value:
+
+        INSERT INTO t (a, b) SELECT pgp_pub_encrypt(v.c0::text, k.public_key), ...
+        FROM (VALUES (%s, %s), ...) AS v(c0, c1)
+        CROSS JOIN (SELECT dearmor('<key>') AS public_key) AS k
+
+    Fields with a backend which doesn't use the database are encrypted by the
+    backend, a batch at a time. Ciphertexts which have not been decrypted are
+    written as they are.
+    """
+    def __init__(self, model, fields, connection, key_binding=None,
+                 update=False):
+        """Write the values of `fields` of `model` with `connection`.
+
+        With `update`, rows are updated instead of inserted, the first field
+        being the primary key.
+        """
+        self.model = model
+        self.fields = fields
+        self.connection = connection
+        self.key_binding = get_key_binding(key_binding)
+        self.update = update
+        self.rows = []
+        self.size = 0
+
+    def __len__(self):
+        """Return the number of rows in the batch."""
+        return len(self.rows)
+
+    def add(self, values):
+        """Add a row of values prepared with `get_db_prep_save` (or plaintexts)."""
+        self.rows.append(values)
+        self.size += sum(value_size(value) for value in values)
+
+    def prepare(self, field, obj, add):
+        """Return the value of `field` to add to the batch for `obj`.
+
+        The values of PGP fields are kept in plaintext, or as loaded ciphertexts,
+        and those of their indexes are computed again.
+        """
+        if isinstance(field, PGPMixin):
+            value = field.get_save_value(obj, add)
+            if isinstance(value, six.memoryview):
+                return value
+            return field.get_db_prep_plaintext(value, self.connection)
+        value = getattr(field, 'get_save_value', field.pre_save)(obj, add)
+        return field.get_db_prep_save(value, connection=self.connection)
+
+    def _cast_type(self, field):
+        if isinstance(field, models.AutoField):
+            return models.IntegerField().db_type(self.connection)
+        return field.db_type(self.connection)
+
+    def _get_columns(self):
+        """Return the columns of `VALUES`, their SQL and the `k` keys needed."""
+        columns = []
+        ciphertext_columns = []
+        values_sql = []
+        key_names = set()
+
+        for i, field in enumerate(self.fields):
+            column = 'c{}'.format(i)
+            columns.append(column)
+            value_sql = 'v.{}'.format(column)
+
+            if not isinstance(field, PGPMixin):
+                if hasattr(field, 'get_hash_sql'):
+                    values_sql.append(field.get_hash_sql(value_sql))
+                elif hasattr(field, 'get_placeholder'):
+                    placeholder = field.get_placeholder(None, None, self.connection)
+                    values_sql.append(placeholder % value_sql)
+                else:
+                    values_sql.append('CAST({} AS {})'.format(
+                        value_sql,
+                        self._cast_type(field),
+                    ))
+                continue
+
+            if not field.backend.in_database:
+                values_sql.append('CAST({} AS bytea)'.format(value_sql))
+                continue
+
+            key_name = 'symmetric_key' if field.symmetric_key else 'public_key'
+            key_names.add(key_name)
+            sql = field.get_encrypt_sql(value_sql, 'k.{}'.format(key_name))
+
+            if any(isinstance(row[i], six.memoryview) for row in self.rows):
+                ciphertext_column = '{}_ciphertext'.format(column)
+                ciphertext_columns.append(ciphertext_column)
+                sql = 'coalesce(v.{}, {})'.format(ciphertext_column, sql)
+            values_sql.append(sql)
+
+        return columns + ciphertext_columns, values_sql, key_names
+
+    def _get_rows(self):
+        """Rows of query parameters, followed by the ciphertext columns."""
+        rows = [list(row) for row in self.rows]
+        for i, field in enumerate(self.fields):
+            if not isinstance(field, PGPMixin):
+                continue
+
+            values = [row[i] for row in self.rows]
+            ciphertexts = [isinstance(value, six.memoryview) for value in values]
+            if not field.backend.in_database:
+                plaintexts = [
+                    None if ciphertext else value
+                    for value, ciphertext in zip(values, ciphertexts)
+                ]
+                encrypted = field.backend.encrypt_values(field, plaintexts)
+                for row, value, ciphertext in zip(rows, encrypted, ciphertexts):
+                    if not ciphertext:
+                        row[i] = None if value is None else six.memoryview(value)
+            elif any(ciphertexts):
+                for row, ciphertext in zip(rows, ciphertexts):
+                    ciphertext_value = row[i] if ciphertext else None
+                    row[i] = None if ciphertext else row[i]
+                    row.append(ciphertext_value)
+        return rows
+
+    def _get_source(self, columns, key_names, rows):
+        """Return the `FROM` SQL and its parameters."""
+        placeholders = '({})'.format(', '.join(['%s'] * len(columns)))
+        sql = SOURCE_SQL.format(
+            rows=', '.join([placeholders] * len(rows)),
+            columns=', '.join(columns),
+        )
+        params = [value for row in rows for value in row]
+
+        if key_names:
+            key_sql = {
+                'public_key': keys.format_sql(PUBLIC_KEY_SQL[self.key_binding]),
+                'symmetric_key': keys.format_sql(SYMMETRIC_KEY_SQL[self.key_binding]),
+            }
+            key_params = {
+                'public_key': keys.public_key_params(self.key_binding),
+                'symmetric_key': keys.symmetric_key_params(self.key_binding),
+            }
+            sql += KEYS_SQL.format(keys=', '.join(
+                '{} AS {}'.format(key_sql[name], name) for name in sorted(key_names)
+            ))
+            for name in sorted(key_names):
+                params.extend(key_params[name])
+        return sql, params
+
+    def insert_sql(self):
+        """Return the `INSERT` statement and its parameters."""
+        qn = self.connection.ops.quote_name
+        columns, values_sql, key_names = self._get_columns()
+        source, params = self._get_source(columns, key_names, self._get_rows())
+        sql = INSERT_SQL.format(
+            table=qn(self.model._meta.db_table),
+            columns=', '.join(qn(field.column) for field in self.fields),
+            values=', '.join(values_sql),
+            source=source,
+        )
+        return sql, params
+
+    def update_sql(self):
+        """Return the `UPDATE` statement and its parameters."""
+        qn = self.connection.ops.quote_name
+        columns, values_sql, key_names = self._get_columns()
+        source, params = self._get_source(columns, key_names, self._get_rows())
+        pk = self.fields[0]
+        sql = UPDATE_SQL.format(
+            table=qn(self.model._meta.db_table),
+            assignments=', '.join(
+                '{} = {}'.format(qn(field.column), value_sql)
+                for field, value_sql in zip(self.fields[1:], values_sql[1:])
+            ),
+            source=source,
+            pk=qn(pk.column),
+            key=values_sql[0],
+        )
+        return sql, params
+
+    def execute(self):
+        """Write the rows and empty the batch."""
+        sql, params = self.update_sql() if self.update else self.insert_sql()
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+        self.rows = []
+        self.size = 0
@@ -0,0 +1,156 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+
+
+_caches = {}
+
+
+class DecryptionCache(object):
+    """Bounded LRU of decrypted values, keyed by a digest of their ciphertext.
+
+    Values are only added once decrypted by a backend, so a ciphertext read again,
+    for example the lazily loaded profile of the session user, is not sent to
+    `pgp_pub_decrypt` again. The same ciphertext always holds the same value: it
+    never needs to be invalidated, only evicted.
+
+    `max_entries` values are kept in the process for `timeout` seconds, or until
+    evicted. With `django_cache`, the alias of a Django cache, values are shared
+    with the other processes through it. `hits`, `misses` and `evictions` count
+    the reads and evictions of the process.
+    """
+    def __init__(self, max_entries=1000, timeout=None, django_cache=None):
+        """Keep `max_entries` values for `timeout` seconds."""
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.django_cache = caches[django_cache] if django_cache else None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_key(self, field, ciphertext):
+        """Return the cache key of `ciphertext`, a value of `field`."""
+        return 'pgcrypto_fields:{}:{}'.format(
+            field.get_internal_type(),
+            hashlib.sha256(bytes(ciphertext)).hexdigest(),
+        )
+
+    def get(self, key):
+        """Return `(found, value)` for `key`."""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and (entry[0] is None or entry[0] > time.time()):
+                self.entries[key] = entry
+                self.hits += 1
+                return True, entry[1]
+
+        if self.django_cache is not None:
+            entry = self.django_cache.get(key)
+            if entry is not None:
+                self.set(key, entry[0], shared=False)
+                with self.lock:
+                    self.hits += 1
+                return True, entry[0]
+
+        with self.lock:
+            self.misses += 1
+        return False, None
+
+    def set(self, key, value, shared=True):
+        """Keep `value` for `key`, evicting the least recently used values."""
+        expires = None if self.timeout is None else time.time() + self.timeout
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+        if shared and self.django_cache is not None:
+            # Values are wrapped so a cached `None` can be told from a miss.
+            self.django_cache.set(key, (value,), self.timeout)
+
+    def decrypt(self, field, ciphertexts, decrypt):
+        """Decrypt the `ciphertexts` of `field` missing from the cache with `decrypt`.
+
+        `decrypt` takes and returns a list; `None` and duplicates are never sent
+        to it.
+        """
+        values = [None] * len(ciphertexts)
+        missing = OrderedDict()
+        for i, ciphertext in enumerate(ciphertexts):
+            if ciphertext is None:
+                continue
+            key = self.get_key(field, ciphertext)
+            if key in missing:
+                missing[key].append(i)
+                continue
+            found, values[i] = self.get(key)
+            if not found:
+                missing[key] = [i]
+
+        if missing:
+            decrypted = decrypt([ciphertexts[indexes[0]] for indexes in missing.values()])
+            for (key, indexes), value in zip(missing.items(), decrypted):
+                self.set(key, value)
+                for i in indexes:
+                    values[i] = value
+        return values
+
+    def clear(self):
+        """Empty the values kept in the process and reset the counters."""
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Return the counters and the number of values kept in the process."""
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def get_cache():
+    """Return the `DecryptionCache` of the process, or `None` when it is disabled.
+
+    It is created once with the keyword arguments of the `PGCRYPTO_CACHE`
+    setting.
+    """
+    try:
+        return _caches['default']
+    except KeyError:
+        options = getattr(settings, 'PGCRYPTO_CACHE', None)
+        cache = _caches['default'] = (
+            None if options is None else DecryptionCache(**options)
+        )
+        return cache
+
+
+def decrypt(field, ciphertexts, using='default', key_binding=None):
+    """Decrypt a list of `field` ciphertexts with its backend, through the cache."""
+    def backend_decrypt(values):
+        return field.backend.decrypt(field, values, using, key_binding)
+
+    cache = get_cache()
+    if cache is None:
+        return backend_decrypt(ciphertexts)
+    return cache.decrypt(field, ciphertexts, backend_decrypt)
+
+
+def reset_cache(setting, **kwargs):
+    """Create the cache again when `PGCRYPTO_CACHE` is changed, in tests."""
+    if setting == 'PGCRYPTO_CACHE':
+        _caches.clear()
+
+
+setting_changed.connect(reset_cache)
@@ -8,19 +8,24 @@ from pgcrypto_fields import (
     PGP_PUB_ENCRYPT_SQL,
 )
 from pgcrypto_fields.mixins import (
+    DeterministicFieldMixin,
+    EmailDeterministicFieldMixin,
     EmailPGPPublicKeyFieldMixin,
+    EmailPGPSymmetricKeyFieldMixin,
+    JSONPGPPublicKeyFieldMixin,
     PGPPublicKeyFieldMixin,
+    PGPSymmetricKeyFieldMixin,
 )
 
 
 class EmailPGPPublicKeyField(EmailPGPPublicKeyFieldMixin, models.EmailField):
     """Email PGP public key encrypted field."""
-    encrypt_sql = PGP_PUB_ENCRYPT_SQL
+    encrypt_sql_template = PGP_PUB_ENCRYPT_SQL
 
 
 class IntegerPGPPublicKeyField(PGPPublicKeyFieldMixin, models.IntegerField):
     """Integer PGP public key encrypted field."""
-    encrypt_sql = INTEGER_PGP_PUB_ENCRYPT_SQL
+    encrypt_sql_template = INTEGER_PGP_PUB_ENCRYPT_SQL
     cast_sql = "CAST(nullif(%s, '') AS integer)"
 
     @classmethod
@@ -32,13 +37,13 @@ class IntegerPGPPublicKeyField(PGPPublicKeyFieldMixin, models.IntegerField):
 
 class TextPGPPublicKeyField(PGPPublicKeyFieldMixin, models.TextField):
     """Text PGP public key encrypted field."""
-    encrypt_sql = PGP_PUB_ENCRYPT_SQL
+    encrypt_sql_template = PGP_PUB_ENCRYPT_SQL
 
 
 class DatePGPPublicKeyField(PGPPublicKeyFieldMixin, models.DateField):
     """Date PGP public key encrypted field."""
 
-    encrypt_sql = PGP_PUB_ENCRYPT_SQL
+    encrypt_sql_template = PGP_PUB_ENCRYPT_SQL
     cast_sql = "to_date(%s, 'YYYY-MM-DD')"
 
     def get_prep_value(self, value):
@@ -55,7 +60,7 @@ class DatePGPPublicKeyField(PGPPublicKeyFieldMixin, models.DateField):
 class NullBooleanPGPPublicKeyField(PGPPublicKeyFieldMixin, models.NullBooleanField):
     """NullBoolean PGP public key encrypted field."""
 
-    encrypt_sql = PGP_PUB_ENCRYPT_SQL
+    encrypt_sql_template = PGP_PUB_ENCRYPT_SQL
     cast_sql = "CASE %s WHEN 'True' THEN TRUE WHEN 'False' THEN FALSE ELSE NULL END"
 
     def get_prep_value(self, value):
@@ -64,3 +69,79 @@ class NullBooleanPGPPublicKeyField(PGPPublicKeyFieldMixin, models.NullBooleanFie
         if value is None:
             return None
         return "%s" % bool(value)
+
+
+class JSONPGPPublicKeyField(JSONPGPPublicKeyFieldMixin, models.TextField):
+    """JSON PGP public key encrypted field."""
+
+
+class EmailPGPSymmetricKeyField(EmailPGPSymmetricKeyFieldMixin, models.EmailField):
+    """Email PGP symmetric key encrypted field."""
+
+
+class IntegerPGPSymmetricKeyField(PGPSymmetricKeyFieldMixin, models.IntegerField):
+    """Integer PGP symmetric key encrypted field."""
+    cast_sql = IntegerPGPPublicKeyField.cast_sql
+
+    @classmethod
+    def _parse_decrypted_value(cls, value):
+        return IntegerPGPPublicKeyField._parse_decrypted_value(value)
+
+
+class TextPGPSymmetricKeyField(PGPSymmetricKeyFieldMixin, models.TextField):
+    """Text PGP symmetric key encrypted field."""
+
+
+class DatePGPSymmetricKeyField(PGPSymmetricKeyFieldMixin, models.DateField):
+    """Date PGP symmetric key encrypted field."""
+
+    cast_sql = DatePGPPublicKeyField.cast_sql
+
+    def get_prep_value(self, value):
+        """Need explicit string cast to avoid quotes, see `DatePGPPublicKeyField`."""
+        if value is None:
+            return None
+        return "%s" % super(DatePGPSymmetricKeyField, self).get_prep_value(value)
+
+
+class NullBooleanPGPSymmetricKeyField(PGPSymmetricKeyFieldMixin,
+                                      models.NullBooleanField):
+    """NullBoolean PGP symmetric key encrypted field."""
+
+    cast_sql = NullBooleanPGPPublicKeyField.cast_sql
+
+    def get_prep_value(self, value):
+        """Before encryption, need to prepare values."""
+        value = super(NullBooleanPGPSymmetricKeyField, self).get_prep_value(value)
+        if value is None:
+            return None
+        return "%s" % bool(value)
+
+
+class EmailDeterministicField(EmailDeterministicFieldMixin, models.EmailField):
+    """Email deterministic encrypted field."""
+
+
+class IntegerDeterministicField(DeterministicFieldMixin, models.IntegerField):
+    """Integer deterministic encrypted field."""
+    cast_sql = IntegerPGPPublicKeyField.cast_sql
+
+    @classmethod
+    def _parse_decrypted_value(cls, value):
+        return IntegerPGPPublicKeyField._parse_decrypted_value(value)
+
+
+class TextDeterministicField(DeterministicFieldMixin, models.TextField):
+    """Text deterministic encrypted field."""
+
+
+class DateDeterministicField(DeterministicFieldMixin, models.DateField):
+    """Date deterministic encrypted field."""
+
+    cast_sql = DatePGPPublicKeyField.cast_sql
+
+    def get_prep_value(self, value):
+        """Need explicit string cast to avoid quotes, see `DatePGPPublicKeyField`."""
+        if value is None:
+            return None
+        return "%s" % super(DateDeterministicField, self).get_prep_value(value)
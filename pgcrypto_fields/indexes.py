@@ -0,0 +1,299 @@
+import datetime
+import hashlib
+import hmac
+import json
+import struct
+import threading
+from contextlib import contextmanager
+
+from django.db import models
+from django.utils import six
+from django.utils.encoding import force_bytes
+
+from pgcrypto_fields import HMAC_SQL, keys
+from pgcrypto_fields.lookups import TokensContain
+
+
+# Prefixes of up to `SEARCH_PREFIX_LENGTH` characters are indexed by default.
+SEARCH_PREFIX_LENGTH = 10
+# Tokens are truncated digests: collisions only add rows to check.
+SEARCH_TOKEN_BYTES = 8
+
+
+# Whether the indexes are computed again by `recompute_indexes`, per thread.
+_recompute = threading.local()
+
+
+@contextmanager
+def recompute_indexes():
+    """Compute the indexes of the instances saved in the block again.
+
+    The indexes of unchanged values are otherwise kept: saving the rows within
+    the block refreshes them once `PGCRYPTO_KEY` changed.
+    """
+    previous = getattr(_recompute, 'active', False)
+    _recompute.active = True
+    try:
+        yield
+    finally:
+        _recompute.active = previous
+
+
+class IndexFieldMixin(object):
+    """Keep the stored value of an index whose source field wasn't changed.
+
+    `get_save_value` computes the value of the index from the source field's.
+    """
+    def pre_save(self, model_instance, add):
+        """Return the column itself if the source field is unchanged, see `PGPMixin`.
+
+        The value loaded lazily isn't decrypted to compute the index again,
+        unless the index wasn't loaded or is `NULL`, such as an index added to
+        existing rows, or inside `recompute_indexes`.
+        """
+        stored = model_instance.__dict__.get(self.attname)
+        if add or stored is None or getattr(_recompute, 'active', False):
+            return self.get_save_value(model_instance, add)
+        if self.source_field.is_unchanged(model_instance):
+            return models.F(self.attname)
+        return self.get_save_value(model_instance, add)
+
+
+class BlindIndexField(IndexFieldMixin, models.Field):
+    """Keyed hash of an encrypted field's value.
+
+    `BlindIndexField` is added to a model by `PGPMixin` when a field is declared
+    with `blind_index=True`. It stores `hmac(value, PGCRYPTO_KEY)` of the source
+    field's value in an indexed column so equality lookups can be answered with a
+    B-tree probe instead of decrypting every row.
+
+    `source` is the name of the encrypted field the digest is computed from.
+    """
+    def __init__(self, source=None, *args, **kwargs):
+        """Blind index values are derived from `source`, never edited directly."""
+        self.source = source
+        kwargs.setdefault('editable', False)
+        kwargs.setdefault('null', True)
+        kwargs.setdefault('db_index', True)
+        super(BlindIndexField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        """Add `source` to the field's arguments for migrations."""
+        name, path, args, kwargs = super(BlindIndexField, self).deconstruct()
+        kwargs['source'] = self.source
+        return name, path, args, kwargs
+
+    @property
+    def source_field(self):
+        """Encrypted field whose value is hashed."""
+        return self.model._meta.get_field(self.source)
+
+    def db_type(self, connection=None):
+        """HMAC digests are stored as raw bytes."""
+        return 'bytea'
+
+    def get_save_value(self, model_instance, add):
+        """Hash the current value of the source field."""
+        return getattr(model_instance, self.source_field.attname)
+
+    def get_prep_value(self, value):
+        """Prepare the value the same way the source field does before encryption.
+
+        Digests copied with their ciphertext (see `serializers`) are kept.
+        """
+        if isinstance(value, six.memoryview):
+            return value
+        return self.source_field.get_prep_value(value)
+
+    def get_hash_sql(self, value_sql):
+        """Return the SQL hashing `value_sql` with the secret key."""
+        return keys.format_sql(HMAC_SQL, value=value_sql)
+
+    def get_placeholder(self, value=None, compiler=None, connection=None):
+        """Tell postgres to hash the value with the secret key, unless it's a digest."""
+        if isinstance(value, six.memoryview):
+            return '%s'
+        return self.get_hash_sql('%s')
+
+
+def range_index_offset():
+    """Return the keyed offset added to the buckets of every `RangeIndexField`.
+
+    It is derived from `PGCRYPTO_KEY` so the stored buckets aren't the bucket
+    numbers of the values. It is the same constant for every row, so it only
+    hides where the values are: their order and the distances between them, to
+    the precision of the bucket size, are kept, and a single value known with
+    its stored bucket gives away the bucket of every other row.
+    """
+    digest = hmac.new(
+        force_bytes(keys.get_key_set().symmetric_key),
+        b'range_index',
+        hashlib.sha256,
+    ).digest()
+    return struct.unpack('>I', digest[:4])[0]
+
+
+class RangeIndexField(IndexFieldMixin, models.BigIntegerField):
+    """Keyed, order preserving bucket of an encrypted integer or date field's value.
+
+    `RangeIndexField` is added to a model by `PGPMixin` when a field is declared
+    with `range_index=<bucket size>`. It stores the number of the bucket of
+    `bucket_size` values (or days) holding the source field's value, shifted by
+    `range_index_offset()`, in an indexed column so range lookups and ordering
+    can be pruned with a B-tree before the values are decrypted. The buckets
+    reveal the order of the values and the distances between them.
+
+    `source` is the name of the encrypted field the bucket is computed from.
+    """
+    def __init__(self, source=None, bucket_size=1, *args, **kwargs):
+        """Range index values are derived from `source`, never edited directly."""
+        self.source = source
+        self.bucket_size = bucket_size
+        kwargs.setdefault('editable', False)
+        kwargs.setdefault('null', True)
+        kwargs.setdefault('db_index', True)
+        super(RangeIndexField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        """Add `source` and `bucket_size` to the field's arguments for migrations."""
+        name, path, args, kwargs = super(RangeIndexField, self).deconstruct()
+        kwargs['source'] = self.source
+        kwargs['bucket_size'] = self.bucket_size
+        return name, path, args, kwargs
+
+    @property
+    def source_field(self):
+        """Encrypted field whose value is bucketed."""
+        return self.model._meta.get_field(self.source)
+
+    def get_bucket(self, value):
+        """Return the bucket of a value of the source field."""
+        if value is None:
+            return None
+        value = self.source_field.to_python(value)
+        if isinstance(value, datetime.date):
+            value = value.toordinal()
+        return value // self.bucket_size + range_index_offset()
+
+    def get_save_value(self, model_instance, add):
+        """Bucket the current value of the source field."""
+        return self.get_bucket(getattr(model_instance, self.source_field.attname))
+
+
+class SearchIndexField(IndexFieldMixin, models.Field):
+    """Keyed tokens of the prefixes of an encrypted text field's value.
+
+    `SearchIndexField` is added to a model by `PGPMixin` when a field is declared
+    with `search_index=True`, or the maximum length of the indexed prefixes. It
+    stores an array of `hmac(prefix, PGCRYPTO_KEY)` tokens of the lowercased
+    prefixes of the source field's value, and of the domain of email addresses,
+    so `startswith`, `istartswith` and `email_domain` lookups can be pruned with
+    a GIN index (see `operations.AddSearchIndex`).
+
+    `source` is the name of the encrypted field the tokens are computed from.
+    """
+    def __init__(self, source=None, prefix_length=SEARCH_PREFIX_LENGTH, *args,
+                 **kwargs):
+        """Search index values are derived from `source`, never edited directly."""
+        self.source = source
+        self.prefix_length = prefix_length
+        kwargs.setdefault('editable', False)
+        kwargs.setdefault('null', True)
+        super(SearchIndexField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        """Add `source` and `prefix_length` to the field's arguments for migrations."""
+        name, path, args, kwargs = super(SearchIndexField, self).deconstruct()
+        kwargs['source'] = self.source
+        kwargs['prefix_length'] = self.prefix_length
+        return name, path, args, kwargs
+
+    @property
+    def source_field(self):
+        """Encrypted field whose value is tokenized."""
+        return self.model._meta.get_field(self.source)
+
+    def db_type(self, connection=None):
+        """Tokens are stored as an array of raw bytes."""
+        return 'bytea[]'
+
+    def get_lookup(self, lookup_name):
+        """Look for tokens with `@>`."""
+        if lookup_name == 'contains':
+            return TokensContain
+        return super(SearchIndexField, self).get_lookup(lookup_name)
+
+    def get_token(self, kind, text):
+        """Return the keyed token of `text`, `kind` keeping tokens of each kind apart."""
+        return six.memoryview(hmac.new(
+            force_bytes(keys.get_key_set().symmetric_key),
+            force_bytes('{}:{}'.format(kind, text.lower())),
+            hashlib.sha256,
+        ).digest()[:SEARCH_TOKEN_BYTES])
+
+    def get_prefix_token(self, prefix):
+        """Return the token of the values starting with `prefix`, whatever its case."""
+        return self.get_token('prefix', prefix[:self.prefix_length])
+
+    def get_domain_token(self, domain):
+        """Return the token of the email addresses at `domain`."""
+        return self.get_token('domain', domain)
+
+    def get_tokens(self, value):
+        """Return the tokens of a value of the source field."""
+        if value is None:
+            return None
+        value = six.text_type(value)
+        tokens = [
+            self.get_prefix_token(value[:length])
+            for length in range(1, min(len(value), self.prefix_length) + 1)
+        ]
+        if isinstance(self.source_field, models.EmailField) and '@' in value:
+            tokens.append(self.get_domain_token(value.rpartition('@')[2]))
+        return tokens
+
+    def get_save_value(self, model_instance, add):
+        """Tokenize the current value of the source field."""
+        return self.get_tokens(getattr(model_instance, self.source_field.attname))
+
+
+class KeyIndexField(SearchIndexField):
+    """Keyed tokens of the values at top-level keys of an encrypted JSON field.
+
+    `KeyIndexField` is added to a model by `JSONPGPPublicKeyField` when it is
+    declared with `key_index=[<key>, ...]`. It stores an array of
+    `hmac(key:value, PGCRYPTO_KEY)` tokens of the lowercased text of the values
+    at these keys, so `<field>__<key>=<value>` filters can be pruned with a GIN
+    index (see `operations.AddKeyIndex`). Objects and arrays are not indexed.
+
+    `source` is the name of the encrypted field the tokens are computed from.
+    """
+    def __init__(self, source=None, keys=(), *args, **kwargs):
+        """Key index values are derived from `source`, never edited directly."""
+        self.keys = list(keys)
+        super(KeyIndexField, self).__init__(source, *args, **kwargs)
+
+    def deconstruct(self):
+        """Add `source` and `keys` to the field's arguments for migrations."""
+        name, path, args, kwargs = super(KeyIndexField, self).deconstruct()
+        del kwargs['prefix_length']
+        kwargs['keys'] = self.keys
+        return name, path, args, kwargs
+
+    def get_key_token(self, key, text):
+        """Return the token of the values whose text at `key` is `text`."""
+        return self.get_token('key:{}'.format(key), text)
+
+    def get_tokens(self, value):
+        """Return the tokens of a value of the source field."""
+        if not isinstance(value, dict):
+            return None
+        tokens = []
+        for key in self.keys:
+            item = value.get(key)
+            if item is None or isinstance(item, (dict, list)):
+                continue
+            if not isinstance(item, six.string_types):
+                item = json.dumps(item)
+            tokens.append(self.get_key_token(key, item))
+        return tokens
@@ -0,0 +1,307 @@
+import re
+import threading
+import time
+from collections import Counter
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+from django.dispatch import Signal
+from django.utils import six
+from django.utils.encoding import force_bytes
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+
+DECRYPT_RE = re.compile(
+    r'\b(?:pgp_(?:pub|sym)_decrypt(?:_bytea)?|pgcrypto_fields_det_decrypt)\(',
+)
+ENCRYPT_RE = re.compile(
+    r'\b(?:pgp_(?:pub|sym)_encrypt(?:_bytea)?|pgcrypto_fields_det_encrypt)\(',
+)
+
+# Fields decrypted on access this many times, one instance at a time, are
+# flagged as N+1 decryptions by `QueryStats`.
+N_PLUS_ONE_THRESHOLD = 3
+
+# Sent after each statement calling pgcrypto, by the connections instrumented
+# with `install`: `decrypted` and `encrypted` are the numbers of columns (or
+# values, for the placeholders of an `INSERT`) decrypted and encrypted by the
+# statement, `size` the bytes of SQL and binary parameters sent and `duration`
+# the seconds it took.
+pgcrypto_query = Signal(providing_args=[
+    'connection',
+    'sql',
+    'decrypted',
+    'encrypted',
+    'rows',
+    'size',
+    'duration',
+])
+
+# Sent by `EncryptedProxyField` when it decrypts the ciphertexts of `values`
+# instances on access, with `PGPEncryptedManager(decrypt='lazy')` or a backend
+# which doesn't use the database.
+decrypted_on_access = Signal(providing_args=['field', 'values', 'using'])
+
+
+def count_operations(sql):
+    """Return the numbers of pgcrypto decryptions and encryptions in `sql`."""
+    return len(DECRYPT_RE.findall(sql)), len(ENCRYPT_RE.findall(sql))
+
+
+def get_statement_size(sql, params):
+    """Return the bytes of `sql` and of its binary parameters, such as keys."""
+    size = len(force_bytes(sql))
+    if isinstance(params, (list, tuple)):
+        size += sum(
+            len(param) for param in params
+            if isinstance(param, (six.binary_type, bytearray, six.memoryview))
+        )
+    return size
+
+
+class InstrumentedCursorWrapper(CursorWrapper):
+    """Cursor sending `pgcrypto_query` for the statements calling pgcrypto.
+
+    It wraps the cursor Django would have used, logging queries or not.
+    """
+    def execute(self, sql, params=None):
+        """Execute and time `sql`."""
+        return self._execute(self.cursor.execute, sql, params, params)
+
+    def executemany(self, sql, param_list):
+        """Execute and time `sql` for each parameters of `param_list`."""
+        return self._execute(self.cursor.executemany, sql, param_list, None)
+
+    def _execute(self, execute, sql, params, size_params):
+        decrypted, encrypted = count_operations(sql)
+        if not decrypted and not encrypted:
+            return execute(sql, params)
+
+        started = time.time()
+        try:
+            return execute(sql, params)
+        finally:
+            rows = self.cursor.rowcount
+            pgcrypto_query.send(
+                sender=self.db.__class__,
+                connection=self.db,
+                sql=sql,
+                decrypted=decrypted,
+                encrypted=encrypted,
+                rows=rows if rows >= 0 else None,
+                size=get_statement_size(sql, size_params),
+                duration=time.time() - started,
+            )
+
+
+def wrap_make_cursor(make_cursor, connection):
+    """Return `make_cursor` returning an `InstrumentedCursorWrapper`."""
+    def make_instrumented_cursor(cursor):
+        return InstrumentedCursorWrapper(make_cursor(cursor), connection)
+    return make_instrumented_cursor
+
+
+def install(connection):
+    """Send `pgcrypto_query` for the statements of `connection` calling pgcrypto."""
+    if getattr(connection, 'pgcrypto_instrumented', False):
+        return
+    connection.pgcrypto_instrumented = True
+    connection.make_cursor = wrap_make_cursor(connection.make_cursor, connection)
+    connection.make_debug_cursor = wrap_make_cursor(
+        connection.make_debug_cursor,
+        connection,
+    )
+
+
+def install_connection(sender, connection, **kwargs):
+    """Instrument a new database connection, see `install`."""
+    install(connection)
+
+
+def install_connections(sender=None, **kwargs):
+    """Instrument the database connections of the current thread.
+
+    The cursor of the statement opening a connection is created before
+    `connection_created` is sent, so connections are also instrumented at the
+    start of each request.
+    """
+    for connection in connections.all():
+        install(connection)
+
+
+class QueryStats(object):
+    """Collect the pgcrypto statements and decryptions on access of a thread.
+
+    Used as a context manager, it instruments the database connections of the
+    thread and records what they send until it exits:
+
+        with QueryStats() as query_stats:
+            response = view(request)
+        query_stats.stats()
+
+    `queries` lists the statements calling pgcrypto, `accesses` counts the
+    decryptions on access by field. Fields decrypted on access one instance at a
+    time at least `n_plus_one_threshold` times are flagged in `n_plus_one`: their
+    instances should be loaded in one queryset or decrypted by the query.
+    """
+    def __init__(self, using=None, n_plus_one_threshold=N_PLUS_ONE_THRESHOLD):
+        """Collect the statements of the database `using`, or of all of them."""
+        self.using = using
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.queries = []
+        self.accesses = Counter()
+        self.single_accesses = Counter()
+        self.thread = None
+
+    def __enter__(self):
+        """Instrument the connections and start collecting."""
+        self.thread = threading.current_thread()
+        install_connections()
+        pgcrypto_query.connect(self.add_query)
+        decrypted_on_access.connect(self.add_access)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop collecting."""
+        pgcrypto_query.disconnect(self.add_query)
+        decrypted_on_access.disconnect(self.add_access)
+
+    def is_collected(self, using):
+        """Tell if what the database `using` does in this thread is collected."""
+        if threading.current_thread() is not self.thread:
+            return False
+        return self.using is None or self.using == using
+
+    def add_query(self, sender, connection, **kwargs):
+        """Record a statement calling pgcrypto, see `pgcrypto_query`."""
+        if self.is_collected(connection.alias):
+            self.queries.append(dict(kwargs, using=connection.alias))
+
+    def add_access(self, sender, field, values, using, **kwargs):
+        """Record a decryption on access, see `decrypted_on_access`."""
+        if self.is_collected(using):
+            label = six.text_type(field)
+            self.accesses[label] += 1
+            if values == 1:
+                self.single_accesses[label] += 1
+
+    @property
+    def n_plus_one(self):
+        """Return the labels of the fields decrypted on access one at a time."""
+        return sorted(
+            label for label, count in self.single_accesses.items()
+            if count >= self.n_plus_one_threshold
+        )
+
+    def stats(self):
+        """Return the totals of the statements and decryptions on access."""
+        return {
+            'queries': len(self.queries),
+            'decrypted': sum(query['decrypted'] for query in self.queries),
+            'encrypted': sum(query['encrypted'] for query in self.queries),
+            'rows': sum(query['rows'] or 0 for query in self.queries),
+            'size': sum(query['size'] for query in self.queries),
+            'duration': sum(query['duration'] for query in self.queries),
+            'decrypted_on_access': sum(self.accesses.values()),
+            'n_plus_one': self.n_plus_one,
+        }
+
+
+class Metrics(object):
+    """Receiver of the instrumentation signals, exporting them as metrics.
+
+    Subclasses export the signals they are interested in; the others are
+    ignored.
+    """
+    def connect(self):
+        """Start exporting the signals, for example from `AppConfig.ready`."""
+        pgcrypto_query.connect(self.add_query, weak=False)
+        decrypted_on_access.connect(self.add_access, weak=False)
+
+    def disconnect(self):
+        """Stop exporting the signals."""
+        pgcrypto_query.disconnect(self.add_query)
+        decrypted_on_access.disconnect(self.add_access)
+
+    def add_query(self, sender, connection, **kwargs):
+        """Export a statement calling pgcrypto, see `pgcrypto_query`; ignored here."""
+
+    def add_access(self, sender, field, values, using, **kwargs):
+        """Export a decryption on access, see `decrypted_on_access`; ignored here."""
+
+
+class StatsdMetrics(Metrics):
+    """Send counters and timers to StatsD.
+
+    `client` is a StatsD client with the `incr(name, count)` and
+    `timing(name, milliseconds)` methods of `statsd.StatsClient`.
+    """
+    def __init__(self, client, prefix='pgcrypto'):
+        """Send the metrics named `<prefix>.<name>` with `client`."""
+        self.client = client
+        self.prefix = prefix
+
+    def add_query(self, sender, connection, **kwargs):
+        """Count the statement, its columns and rows, and time it."""
+        self.client.incr('{}.queries'.format(self.prefix), 1)
+        for name in ('decrypted', 'encrypted', 'rows', 'size'):
+            if kwargs[name]:
+                self.client.incr('{}.{}'.format(self.prefix, name), kwargs[name])
+        self.client.timing(
+            '{}.duration'.format(self.prefix),
+            kwargs['duration'] * 1000,
+        )
+
+    def add_access(self, sender, field, values, using, **kwargs):
+        """Count the decryption on access."""
+        self.client.incr('{}.decrypted_on_access'.format(self.prefix), 1)
+
+
+class PrometheusMetrics(Metrics):
+    """Update Prometheus counters and histograms, labelled by database alias."""
+    def __init__(self, prefix='pgcrypto', registry=None):
+        """Register the metrics named `<prefix>_<name>` in `registry`."""
+        if prometheus_client is None:
+            raise ImproperlyConfigured(
+                'PrometheusMetrics requires the prometheus_client package.',
+            )
+        registry = registry or prometheus_client.REGISTRY
+
+        def counter(name, documentation):
+            return prometheus_client.Counter(
+                '{}_{}'.format(prefix, name),
+                documentation,
+                ['using'],
+                registry=registry,
+            )
+
+        self.queries = counter('queries_total', 'Statements calling pgcrypto.')
+        self.decrypted = counter('decrypted_total', 'Columns decrypted.')
+        self.encrypted = counter('encrypted_total', 'Columns encrypted.')
+        self.rows = counter('rows_total', 'Rows of the statements.')
+        self.size = counter('size_bytes_total', 'Bytes of the statements.')
+        self.accesses = counter('decrypted_on_access_total', 'Decryptions on access.')
+        self.duration = prometheus_client.Histogram(
+            '{}_duration_seconds'.format(prefix),
+            'Duration of the statements calling pgcrypto.',
+            ['using'],
+            registry=registry,
+        )
+
+    def add_query(self, sender, connection, **kwargs):
+        """Count the statement, its columns and rows, and observe its duration."""
+        using = connection.alias
+        self.queries.labels(using).inc()
+        for name in ('decrypted', 'encrypted', 'rows', 'size'):
+            if kwargs[name]:
+                getattr(self, name).labels(using).inc(kwargs[name])
+        self.duration.labels(using).observe(kwargs['duration'])
+
+    def add_access(self, sender, field, values, using, **kwargs):
+        """Count the decryption on access."""
+        self.accesses.labels(using).inc()
@@ -0,0 +1,475 @@
+import base64
+import hashlib
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils import six
+from django.utils.module_loading import import_string
+
+from pgcrypto_fields import (
+    get_key_binding,
+    KEY_BINDING_INLINE,
+    KEY_BINDING_PARAM,
+    routers,
+)
+
+
+DEFAULT_KEY_PROVIDER = 'pgcrypto_fields.keys.SettingsKeyProvider'
+
+# Settings read by `SettingsKeyProvider`, or configuring the provider.
+KEY_SETTINGS = (
+    'PUBLIC_PGP_KEY',
+    'PRIVATE_PGP_KEY',
+    'PGCRYPTO_KEY',
+    'PREVIOUS_PRIVATE_PGP_KEYS',
+    'PGCRYPTO_KEY_PROVIDER',
+    'PGCRYPTO_KEY_PROVIDER_OPTIONS',
+)
+
+PRIVATE_KEY_END = '-----END PGP PRIVATE KEY BLOCK-----'
+
+_dearmored_keys = {}
+_key_ids = {}
+_providers = {}
+_key_sets = {}
+_key_sets_lock = threading.Lock()
+
+# OpenPGP packet tags of the secret and public keys and subkeys.
+MAIN_KEY_TAGS = (5, 6)
+SUBKEY_TAGS = (7, 14)
+# Number of MPIs in the public part of a key, by public key algorithm: RSA and
+# ElGamal, the algorithms supported by pgcrypto.
+KEY_ALGORITHM_MPIS = {1: 2, 2: 2, 3: 2, 16: 3, 20: 3}
+ENCRYPTION_ALGORITHMS = (1, 2, 16, 20)
+
+
+def dearmor(armored):
+    """Unwrap an ASCII armored PGP key, like pgcrypto's `dearmor` does.
+
+    The armor headers (between the `-----BEGIN` line and the first empty line)
+    and the checksum (the line starting with `=`) are skipped, the remaining
+    lines are base64 decoded.
+    """
+    lines = [line.strip() for line in armored.strip().splitlines()]
+    body = lines[lines.index('') + 1:]
+    data = []
+    for line in body:
+        if line.startswith('=') or line.startswith('-----'):
+            break
+        data.append(line)
+    return base64.b64decode(''.join(data))
+
+
+def dearmored(armored):
+    """Return the dearmored `armored` key, unwrapping it only once per process."""
+    try:
+        return _dearmored_keys[armored]
+    except KeyError:
+        key = _dearmored_keys[armored] = dearmor(armored)
+        return key
+
+
+def escape_sql(text):
+    """Escape `text` for a quoted literal of a statement sent with parameters.
+
+    Quotes are doubled, and `%` too as the SQL is read by the database adapter.
+    The SQL embedding the keys must not be used as a `%` template afterwards.
+    """
+    return text.replace("'", "''").replace('%', '%%')
+
+
+class KeySet(object):
+    """Armored PGP keys and symmetric key returned by a `KeyProvider`.
+
+    The SQL embedding the keys is formatted once per key set by `format_sql`,
+    and reused as long as the provider returns the same keys.
+    """
+    def __init__(self, public_key='', private_key='', symmetric_key='',
+                 previous_private_keys=()):
+        """Hold the armored keys, the previous private keys first to last."""
+        self.public_key = public_key
+        self.private_key = private_key
+        self.symmetric_key = symmetric_key
+        self.previous_private_keys = tuple(previous_private_keys)
+        self._sql = {}
+        self._previous_private_keys_by_id = None
+
+    def __eq__(self, other):
+        """Tell if `other` holds the same keys."""
+        return isinstance(other, KeySet) and self.keys == other.keys
+
+    def __ne__(self, other):
+        """Tell if `other` holds other keys."""
+        return not self == other
+
+    @property
+    def keys(self):
+        """Return the keys as a tuple."""
+        return (
+            self.public_key,
+            self.private_key,
+            self.symmetric_key,
+            self.previous_private_keys,
+        )
+
+    @property
+    def previous_private_keys_by_id(self):
+        """Return the previous private keys by key id."""
+        if self._previous_private_keys_by_id is None:
+            self._previous_private_keys_by_id = OrderedDict(
+                (key_id(armored), armored) for armored in self.previous_private_keys
+            )
+        return self._previous_private_keys_by_id
+
+    def format_sql(self, template, **kwargs):
+        """Format the key fields of `template`, and the fields of `kwargs`.
+
+        The keys are escaped with `escape_sql`, the fields of `kwargs` are
+        inserted as they are.
+        """
+        cache_key = (template,) + tuple(sorted(kwargs.items()))
+        try:
+            return self._sql[cache_key]
+        except KeyError:
+            sql = self._sql[cache_key] = template.format(
+                public_key=escape_sql(self.public_key),
+                private_key=escape_sql(self.private_key),
+                symmetric_key=escape_sql(self.symmetric_key),
+                **kwargs
+            )
+            return sql
+
+
+class KeyProvider(object):
+    """Source of the keys, read on first use instead of at import.
+
+    `get_key_set` is called again once `ttl` seconds have passed, never by
+    default, or after `reload_keys`, so keys can be replaced without restarting
+    the process. Subclasses fetching keys from a secret manager only implement
+    `get_key_set`.
+    """
+    def __init__(self, ttl=None):
+        """Read the keys again every `ttl` seconds."""
+        self.ttl = ttl
+
+    def get_key_set(self):
+        """Return the current `KeySet`."""
+        raise NotImplementedError
+
+
+class SettingsKeyProvider(KeyProvider):
+    """Read the keys from the settings, the default provider.
+
+    The keys are `PUBLIC_PGP_KEY`, `PRIVATE_PGP_KEY`, `PGCRYPTO_KEY` and
+    `PREVIOUS_PRIVATE_PGP_KEYS`.
+    """
+    def get_key_set(self):
+        """Return the keys of the settings."""
+        return KeySet(
+            public_key=getattr(settings, 'PUBLIC_PGP_KEY', ''),
+            private_key=getattr(settings, 'PRIVATE_PGP_KEY', ''),
+            symmetric_key=getattr(settings, 'PGCRYPTO_KEY', ''),
+            previous_private_keys=getattr(settings, 'PREVIOUS_PRIVATE_PGP_KEYS', ()),
+        )
+
+
+class FileKeyProvider(KeyProvider):
+    """Read the keys from files, such as those written by a secrets agent."""
+    def __init__(self, public_key_path=None, private_key_path=None,
+                 symmetric_key_path=None, previous_private_key_paths=(), ttl=None):
+        """Read the keys from the files at these paths, when given."""
+        super(FileKeyProvider, self).__init__(ttl)
+        self.public_key_path = public_key_path
+        self.private_key_path = private_key_path
+        self.symmetric_key_path = symmetric_key_path
+        self.previous_private_key_paths = previous_private_key_paths
+
+    def read(self, path):
+        """Return the content of the file at `path`, or `''` without a path."""
+        if not path:
+            return ''
+        with open(path) as key_file:
+            return key_file.read().strip()
+
+    def get_key_set(self):
+        """Return the keys of the files."""
+        return KeySet(
+            public_key=self.read(self.public_key_path),
+            private_key=self.read(self.private_key_path),
+            symmetric_key=self.read(self.symmetric_key_path),
+            previous_private_keys=[
+                self.read(path) for path in self.previous_private_key_paths
+            ],
+        )
+
+
+class EnvironmentKeyProvider(KeyProvider):
+    """Read the keys from environment variables.
+
+    The previous private keys are concatenated in one variable.
+    """
+    def __init__(self, public_key='PUBLIC_PGP_KEY', private_key='PRIVATE_PGP_KEY',
+                 symmetric_key='PGCRYPTO_KEY',
+                 previous_private_keys='PREVIOUS_PRIVATE_PGP_KEYS', ttl=None):
+        """Read the keys from the variables with these names."""
+        super(EnvironmentKeyProvider, self).__init__(ttl)
+        self.public_key = public_key
+        self.private_key = private_key
+        self.symmetric_key = symmetric_key
+        self.previous_private_keys = previous_private_keys
+
+    def get_key_set(self):
+        """Return the keys of the environment."""
+        previous = os.environ.get(self.previous_private_keys, '')
+        return KeySet(
+            public_key=os.environ.get(self.public_key, ''),
+            private_key=os.environ.get(self.private_key, ''),
+            symmetric_key=os.environ.get(self.symmetric_key, ''),
+            previous_private_keys=[
+                key.strip() + '\n' + PRIVATE_KEY_END
+                for key in previous.split(PRIVATE_KEY_END) if key.strip()
+            ],
+        )
+
+
+def get_key_provider():
+    """Return the provider of `PGCRYPTO_KEY_PROVIDER`, created once per process.
+
+    It is created with the keyword arguments of `PGCRYPTO_KEY_PROVIDER_OPTIONS`.
+    """
+    try:
+        return _providers['default']
+    except KeyError:
+        path = getattr(settings, 'PGCRYPTO_KEY_PROVIDER', DEFAULT_KEY_PROVIDER)
+        options = getattr(settings, 'PGCRYPTO_KEY_PROVIDER_OPTIONS', {})
+        provider = _providers['default'] = import_string(path)(**options)
+        return provider
+
+
+def get_key_set():
+    """Return the current `KeySet`, read on first use and once per `ttl`.
+
+    A key set equal to the previous one is replaced by it, keeping its SQL.
+    """
+    entry = _key_sets.get('default')
+    if entry is not None and (entry[0] is None or entry[0] > time.time()):
+        return entry[1]
+
+    with _key_sets_lock:
+        entry = _key_sets.get('default')
+        if entry is not None and (entry[0] is None or entry[0] > time.time()):
+            return entry[1]
+        provider = get_key_provider()
+        key_set = provider.get_key_set()
+        if entry is not None and entry[1] == key_set:
+            key_set = entry[1]
+        expires = None if provider.ttl is None else time.time() + provider.ttl
+        _key_sets['default'] = (expires, key_set)
+        return key_set
+
+
+def reload_keys():
+    """Read the keys again from the provider on next use."""
+    with _key_sets_lock:
+        entry = _key_sets.get('default')
+        if entry is not None:
+            _key_sets['default'] = (0, entry[1])
+
+
+def reset_keys(setting, **kwargs):
+    """Create the provider again when the keys settings are changed, in tests."""
+    if setting in KEY_SETTINGS:
+        _providers.clear()
+        _key_sets.clear()
+
+
+setting_changed.connect(reset_keys)
+
+
+def format_sql(template, **kwargs):
+    """Format the key fields of `template` with the current keys."""
+    return get_key_set().format_sql(template, **kwargs)
+
+
+def public_key():
+    """Dearmored public key."""
+    return dearmored(get_key_set().public_key)
+
+
+def read_packets(data):
+    """Yield `(tag, body)` of the OpenPGP packets in `data`."""
+    data = bytearray(data)
+    position = 0
+    while position < len(data):
+        header = data[position]
+        position += 1
+        if header & 0x40:
+            # New format packet.
+            tag = header & 0x3f
+            length = data[position]
+            if length < 192:
+                position += 1
+            elif length < 224:
+                length = ((length - 192) << 8) + data[position + 1] + 192
+                position += 2
+            else:
+                length = struct.unpack('>I', bytes(data[position + 1:position + 5]))[0]
+                position += 5
+        else:
+            tag = (header >> 2) & 0x0f
+            size = 1 << (header & 0x03)
+            length = 0
+            for byte in data[position:position + size]:
+                length = (length << 8) + byte
+            position += size
+        yield tag, bytes(data[position:position + length])
+        position += length
+
+
+def public_key_body(body):
+    """Return the public part of a v4 key packet `body`."""
+    data = bytearray(body)
+    algorithm = data[5]
+    position = 6
+    for _ in range(KEY_ALGORITHM_MPIS[algorithm]):
+        bits = (data[position] << 8) + data[position + 1]
+        position += 2 + (bits + 7) // 8
+    return bytes(data[:position])
+
+
+def key_id(armored):
+    """Return the id of the key used to encrypt with `armored`.
+
+    The id is the one `pgp_key_id` returns for the messages encrypted with the
+    key: the encryption subkey's, or the main key's if it has no subkey.
+    """
+    try:
+        return _key_ids[armored]
+    except KeyError:
+        pass
+
+    public_body = None
+    for tag, body in read_packets(dearmored(armored)):
+        if tag not in MAIN_KEY_TAGS + SUBKEY_TAGS:
+            continue
+        if bytearray(body)[5] not in ENCRYPTION_ALGORITHMS:
+            continue
+        if public_body is None or tag in SUBKEY_TAGS:
+            public_body = public_key_body(body)
+
+    fingerprint = hashlib.sha1(
+        b'\x99' + struct.pack('>H', len(public_body)) + public_body,
+    ).hexdigest()
+    _key_ids[armored] = fingerprint[-16:].upper()
+    return _key_ids[armored]
+
+
+def previous_private_keys():
+    """Armored previous private keys by key id.
+
+    They decrypt the values encrypted with previous public keys until they are
+    rotated with the `rotate_pgcrypto_keys` command.
+    """
+    return get_key_set().previous_private_keys_by_id
+
+
+def private_key():
+    """Dearmored private key."""
+    return dearmored(get_key_set().private_key)
+
+
+def encrypt_key_sql(key_sql, key_binding=None):
+    """Return the SQL of the key of `key_sql` (such as `PUBLIC_KEY_SQL`) encrypting.
+
+    Placeholders can't hold query parameters, so `KEY_BINDING_PARAM` only applies
+    to decryption and to `PGPEncryptedQuerySet.bulk_create_encrypted`.
+    """
+    key_binding = get_key_binding(key_binding)
+    if key_binding == KEY_BINDING_PARAM:
+        key_binding = KEY_BINDING_INLINE
+    return format_sql(key_sql[key_binding])
+
+
+def public_key_params(key_binding):
+    """Query parameters needed by `PUBLIC_KEY_SQL[key_binding]`."""
+    if key_binding == KEY_BINDING_PARAM:
+        return [six.memoryview(public_key())]
+    return []
+
+
+def private_key_params(key_binding):
+    """Query parameters needed by `PRIVATE_KEY_SQL[key_binding]`."""
+    if key_binding == KEY_BINDING_PARAM:
+        return [six.memoryview(private_key())]
+    return []
+
+
+def previous_private_key_params(key_binding):
+    """Query parameters of the previous private keys, in `previous_private_keys` order."""
+    if key_binding == KEY_BINDING_PARAM:
+        return [
+            six.memoryview(dearmored(armored))
+            for armored in previous_private_keys().values()
+        ]
+    return []
+
+
+def symmetric_key_params(key_binding):
+    """Query parameters needed by `SYMMETRIC_KEY_SQL[key_binding]`."""
+    if key_binding == KEY_BINDING_PARAM:
+        return [get_key_set().symmetric_key]
+    return []
+
+
+def set_session_keys(connection):
+    """Store the PGP keys in the database session of `connection`.
+
+    They are read by `pgcrypto_fields_pub_key()` and `pgcrypto_fields_priv_key()`,
+    installed by the `0002_add_key_functions` migration, by
+    `pgcrypto_fields_sym_key()`, installed by `0003_add_symmetric_key_function`,
+    and by `pgcrypto_fields_priv_key(key_id)` for the previous private keys,
+    installed by `0004_add_key_rotation`, so queries don't have to embed the keys.
+
+    The private keys are only stored in the sessions of the decryption
+    databases when the `PGCRYPTO_DECRYPTION_DATABASES` setting is set (see
+    `routers.DecryptionRouter`).
+
+    The key set stored is kept on the connection, see `refresh_session_keys`.
+
+    The `set_config` statement holds the armored private keys, sent once per
+    connection: postgres writes them in its logs when statements are logged
+    (`log_statement = 'all'`) or when the statement fails.
+    """
+    key_set = get_key_set()
+    sql = [
+        "set_config('pgcrypto_fields.public_key', %s, false)",
+        "set_config('pgcrypto_fields.symmetric_key', %s, false)",
+    ]
+    params = [key_set.public_key, key_set.symmetric_key]
+    previous_private_keys_by_id = {}
+    if routers.is_decryption_database(connection.alias):
+        sql.append("set_config('pgcrypto_fields.private_key', %s, false)")
+        params.append(key_set.private_key)
+        previous_private_keys_by_id = key_set.previous_private_keys_by_id
+    for previous_key_id, armored in previous_private_keys_by_id.items():
+        sql.append("set_config('pgcrypto_fields.private_key_{}', %s, false)".format(
+            previous_key_id.lower(),
+        ))
+        params.append(armored)
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT {}'.format(', '.join(sql)), params)
+    connection.pgcrypto_key_set = key_set
+
+
+def refresh_session_keys(connection):
+    """Store the keys again in the session of `connection` if they were reloaded."""
+    if connection.connection is None:
+        return
+    if getattr(connection, 'pgcrypto_key_set', None) is not get_key_set():
+        set_session_keys(connection)
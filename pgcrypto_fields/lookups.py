@@ -0,0 +1,415 @@
+import json
+
+from django.db.models import TextField
+from django.db.models.expressions import Col
+from django.db.models.lookups import (
+    Exact,
+    GreaterThan,
+    GreaterThanOrEqual,
+    IEndsWith,
+    In,
+    IStartsWith,
+    LessThan,
+    LessThanOrEqual,
+    Lookup,
+    Range,
+    StartsWith,
+    Transform,
+)
+
+from django.utils import six
+
+from pgcrypto_fields import keys, SYMMETRIC_KEY_SQL
+from pgcrypto_fields.aggregates import contains_decryption
+
+
+def get_decrypt_sql(compiler, field, sql, key_binding, params):
+    """Return the SQL decrypting `sql`, a value of `field`, and its params.
+
+    The keys bound to the query are read if it already joins them.
+    """
+    decrypt = field.aggregate
+    return decrypt.get_decrypt_sql(
+        field,
+        sql,
+        key_binding,
+        params,
+        decrypt.read_bound_keys(compiler, key_binding),
+    )
+
+
+class BlindIndexLookupMixin(object):
+    """Rewrite a lookup on an encrypted field to its blind index column.
+
+    The left hand side is replaced by the field's `BlindIndexField` column and
+    each value on the right hand side is hashed with `HMAC_SQL`, so postgres
+    compares digests using the blind index instead of decrypting every row.
+
+    Only plain values are rewritten; lookups against expressions or subqueries
+    fall back to the default behaviour.
+    """
+    def uses_blind_index(self):
+        """Tell if the lookup compares the blind index column to hashed values."""
+        return isinstance(self.lhs, Col) and self.rhs_is_direct_value()
+
+    def process_lhs(self, compiler, connection, lhs=None):
+        """Compare against the blind index column instead of the ciphertext."""
+        if lhs is None and self.uses_blind_index():
+            lhs = Col(self.lhs.alias, self.lhs.target.blind_index_field)
+        return super(BlindIndexLookupMixin, self).process_lhs(compiler, connection, lhs)
+
+    def get_db_prep_lookup(self, value, connection):
+        """Hash the looked up value if it is compared to the blind index."""
+        sql, params = super(BlindIndexLookupMixin, self).get_db_prep_lookup(
+            value,
+            connection,
+        )
+        if not self.uses_blind_index():
+            return sql, params
+        return self.lhs.target.blind_index_field.get_hash_sql(sql), params
+
+    def batch_process_rhs(self, compiler, connection, rhs=None):
+        """Hash each of the looked up values if they are compared to the blind index."""
+        sqls, params = super(BlindIndexLookupMixin, self).batch_process_rhs(
+            compiler,
+            connection,
+            rhs,
+        )
+        if not self.uses_blind_index():
+            return sqls, params
+        index = self.lhs.target.blind_index_field
+        return [index.get_hash_sql(sql) for sql in sqls], params
+
+
+class BlindIndexExact(BlindIndexLookupMixin, Exact):
+    """`exact` lookup using the blind index."""
+
+
+class BlindIndexIn(BlindIndexLookupMixin, In):
+    """`in` lookup using the blind index."""
+
+
+class CiphertextLookupMixin(object):
+    """Compare the ciphertexts of a deterministic field.
+
+    Each value on the right hand side is encrypted like the stored values, so
+    postgres compares ciphertexts, with an index if any, without decrypting the
+    rows. Lookups against expressions, such as the column of another
+    deterministic field, compare ciphertexts as they are.
+    """
+    def encrypt(self, sql):
+        """Return the SQL encrypting the value of `sql`."""
+        key_sql = keys.encrypt_key_sql(SYMMETRIC_KEY_SQL)
+        return self.lhs.output_field.get_encrypt_sql(sql, key_sql)
+
+    def get_db_prep_lookup(self, value, connection):
+        """Encrypt the looked up value."""
+        sql, params = super(CiphertextLookupMixin, self).get_db_prep_lookup(
+            value,
+            connection,
+        )
+        return self.encrypt(sql), params
+
+    def batch_process_rhs(self, compiler, connection, rhs=None):
+        """Encrypt each of the looked up values."""
+        sqls, params = super(CiphertextLookupMixin, self).batch_process_rhs(
+            compiler,
+            connection,
+            rhs,
+        )
+        return [self.encrypt(sql) for sql in sqls], params
+
+
+class CiphertextExact(CiphertextLookupMixin, Exact):
+    """`exact` lookup comparing the ciphertexts of a deterministic field."""
+
+
+class CiphertextIn(CiphertextLookupMixin, In):
+    """`in` lookup comparing the ciphertexts of a deterministic field."""
+
+
+class DecryptedLookupMixin(object):
+    """Compare the decrypted value of an encrypted field, pruned by an index.
+
+    The left hand side is decrypted, and for plain values the comparison is
+    preceded by the lookup returned by `get_index_lookup` on one of the field's
+    companion indexes, so postgres only decrypts the rows found with the index:
+
+        (<range index> >= <bucket> AND <decrypted value> > <value>)
+
+    `key_binding` is set to the one of the `PGPEncryptedQuerySet` filtered.
+    """
+    key_binding = None
+
+    def process_lhs(self, compiler, connection, lhs=None):
+        """Decrypt the left hand side."""
+        sql, params = compiler.compile(lhs or self.lhs)
+        field = self.lhs.output_field
+        sql, params = get_decrypt_sql(compiler, field, sql, self.key_binding, params)
+        lookup_cast = connection.ops.lookup_cast(
+            self.lookup_name,
+            field.get_internal_type(),
+        )
+        return lookup_cast % sql, params
+
+    def get_index_lookup(self):
+        """Return the lookup pruning the rows with an index, if any."""
+        return None
+
+    def as_sql(self, compiler, connection):
+        """Prune the rows with the index before comparing the values."""
+        sql, params = super(DecryptedLookupMixin, self).as_sql(compiler, connection)
+        if not isinstance(self.lhs, Col) or not self.rhs_is_direct_value():
+            return sql, params
+        index_lookup = self.get_index_lookup()
+        if index_lookup is None:
+            return sql, params
+        index_sql, index_params = compiler.compile(index_lookup)
+        return '({} AND {})'.format(index_sql, sql), list(index_params) + list(params)
+
+
+class RangeIndexLookupMixin(DecryptedLookupMixin):
+    """Prune a comparison with the field's `RangeIndexField` buckets.
+
+    `index_lookup_name` is the lookup comparing the buckets.
+    """
+    index_lookup_name = None
+
+    def get_index_lookup(self):
+        """Return the lookup comparing the buckets of the values in the range index."""
+        index = self.lhs.target.range_index_field
+        if self.lookup_name == 'range':
+            buckets = [index.get_bucket(value) for value in self.rhs]
+        else:
+            buckets = index.get_bucket(self.rhs)
+        lookup_class = index.get_lookup(self.index_lookup_name)
+        return lookup_class(Col(self.lhs.alias, index), buckets)
+
+
+class RangeIndexExact(RangeIndexLookupMixin, Exact):
+    """`exact` lookup pruned by the range index."""
+    index_lookup_name = 'exact'
+
+
+class RangeIndexGreaterThan(RangeIndexLookupMixin, GreaterThan):
+    """`gt` lookup pruned by the range index."""
+    index_lookup_name = 'gte'
+
+
+class RangeIndexGreaterThanOrEqual(RangeIndexLookupMixin, GreaterThanOrEqual):
+    """`gte` lookup pruned by the range index."""
+    index_lookup_name = 'gte'
+
+
+class RangeIndexLessThan(RangeIndexLookupMixin, LessThan):
+    """`lt` lookup pruned by the range index."""
+    index_lookup_name = 'lte'
+
+
+class RangeIndexLessThanOrEqual(RangeIndexLookupMixin, LessThanOrEqual):
+    """`lte` lookup pruned by the range index."""
+    index_lookup_name = 'lte'
+
+
+class RangeIndexRange(RangeIndexLookupMixin, Range):
+    """`range` lookup pruned by the range index."""
+    index_lookup_name = 'range'
+
+
+class TokensContain(Lookup):
+    """`contains` lookup of a `SearchIndexField`: the row has all the tokens."""
+    lookup_name = 'contains'
+
+    def as_sql(self, compiler, connection):
+        """Compare the arrays with `@>`, answered by a GIN index."""
+        lhs_sql, params = self.process_lhs(compiler, connection)
+        return '{} @> %s::bytea[]'.format(lhs_sql), list(params) + [self.rhs]
+
+
+class SearchIndexLookupMixin(DecryptedLookupMixin):
+    """Prune a pattern lookup with the tokens of the field's `SearchIndexField`."""
+    def get_tokens(self, index):
+        """Return the tokens of the rows which can match the looked up value."""
+        return [index.get_prefix_token(self.rhs)]
+
+    def get_index_lookup(self):
+        """Return the lookup looking for the tokens in the search index."""
+        if not self.rhs:
+            return None
+        index = self.lhs.target.search_index_field
+        return TokensContain(Col(self.lhs.alias, index), self.get_tokens(index))
+
+
+class SearchIndexStartsWith(SearchIndexLookupMixin, StartsWith):
+    """`startswith` lookup pruned by the search index."""
+
+
+class SearchIndexIStartsWith(SearchIndexLookupMixin, IStartsWith):
+    """`istartswith` lookup pruned by the search index."""
+
+
+class SearchIndexEmailDomain(SearchIndexLookupMixin, IEndsWith):
+    """`email_domain` lookup: the address is at the domain, whatever its case.
+
+    It is an `iendswith` lookup on `'@<domain>'`, pruned by the domain token of
+    the search index.
+    """
+    def __init__(self, lhs, rhs):
+        """Look for the addresses ending with `@<rhs>`."""
+        self.domain = rhs
+        super(SearchIndexEmailDomain, self).__init__(lhs, '@{}'.format(rhs))
+
+    def get_tokens(self, index):
+        """Return the domain token."""
+        return [index.get_domain_token(self.domain)]
+
+
+class KeyTransform(Transform):
+    """`<field>__<key>` transform: the decrypted text at a key of a JSON field.
+
+    Nested transforms, `<field>__<key>__<key>`, only add to the path read with
+    `#>>`, so the value is decrypted once:
+
+        (CAST(pgp_pub_decrypt(<column>, <key>) AS jsonb) #>> '{address,city}')
+
+    Values are compared as text, numbers and booleans with their JSON text (see
+    `KeyTransformExact`); `exact` lookups on a top-level key of the field's
+    `key_index` are pruned by its tokens. Like `DecryptedLookupMixin`,
+    `key_binding` is set to the one of the `PGPEncryptedQuerySet` filtered.
+    """
+    output_field = TextField()
+    key_binding = None
+
+    def __init__(self, key_name, *args, **kwargs):
+        """Read the value at `key_name` of the left hand side."""
+        super(KeyTransform, self).__init__(*args, **kwargs)
+        self.key_name = key_name
+
+    def get_path(self):
+        """Return the JSON field's column and the keys of the path."""
+        lhs = self.lhs
+        path = [self.key_name]
+        while isinstance(lhs, KeyTransform):
+            path.insert(0, lhs.key_name)
+            lhs = lhs.lhs
+        return lhs, path
+
+    def as_sql(self, compiler, connection):
+        """Decrypt the JSON value and read the text at the path."""
+        lhs, path = self.get_path()
+        sql, params = compiler.compile(lhs)
+        field = lhs.output_field
+        sql, params = get_decrypt_sql(compiler, field, sql, self.key_binding, params)
+        return '({} #>> %s)'.format(sql), list(params) + [path]
+
+    def get_transform(self, name):
+        """Read a nested key."""
+        return KeyTransformFactory(name)
+
+    def get_lookup(self, lookup_name):
+        """Prune `exact` lookups on a key of the field's key index."""
+        if lookup_name == 'exact':
+            lhs, path = self.get_path()
+            indexed = isinstance(lhs, Col) and path[0] in lhs.target.key_index
+            if indexed and len(path) == 1:
+                return KeyIndexExact
+            return KeyTransformExact
+        return super(KeyTransform, self).get_lookup(lookup_name)
+
+
+class KeyTransformFactory(object):
+    """Create the `KeyTransform` of `key_name`, as returned by `get_transform`."""
+    def __init__(self, key_name):
+        """Read the value at `key_name`."""
+        self.key_name = key_name
+
+    def __call__(self, *args, **kwargs):
+        """Return the transform, see `Transform.__init__`."""
+        return KeyTransform(self.key_name, *args, **kwargs)
+
+
+class KeyTransformExact(Exact):
+    """`exact` lookup on a key of a JSON field.
+
+    `#>>` reads numbers and booleans as their JSON text, so they are looked up
+    as `json.dumps` writes them, `true` rather than `True`.
+    """
+    def get_prep_lookup(self):
+        """Serialize numbers and booleans to JSON."""
+        scalar_types = six.integer_types + (float,)
+        if self.rhs_is_direct_value() and isinstance(self.rhs, scalar_types):
+            self.rhs = json.dumps(self.rhs)
+        return super(KeyTransformExact, self).get_prep_lookup()
+
+
+class KeyIndexExact(KeyTransformExact):
+    """`exact` lookup on a key of a JSON field, pruned by the key index tokens.
+
+    Objects and arrays are not indexed: looking them up isn't pruned.
+    """
+    def as_sql(self, compiler, connection):
+        """Look for the token of the value before comparing the decrypted text."""
+        sql, params = super(KeyIndexExact, self).as_sql(compiler, connection)
+        if not self.rhs_is_direct_value() or self.rhs.startswith(('{', '[')):
+            return sql, params
+        lhs, path = self.lhs.get_path()
+        index = lhs.target.key_index_field
+        index_lookup = TokensContain(
+            Col(lhs.alias, index),
+            [index.get_key_token(path[0], self.rhs)],
+        )
+        index_sql, index_params = compiler.compile(index_lookup)
+        return '({} AND {})'.format(index_sql, sql), list(index_params) + list(params)
+
+
+def get_lookups(where):
+    """Return the lookups, and other leaves, of the `WHERE` tree `where`."""
+    lookups = []
+    for child in where.children:
+        if hasattr(child, 'children'):
+            lookups.extend(get_lookups(child))
+        else:
+            lookups.append(child)
+    return lookups
+
+
+def get_decrypting_nodes(where):
+    """Return the lookups and transforms of the `WHERE` tree `where` decrypting values."""
+    nodes = []
+    for lookup in get_lookups(where):
+        if isinstance(lookup, DecryptedLookupMixin):
+            nodes.append(lookup)
+        lhs = getattr(lookup, 'lhs', None)
+        while isinstance(lhs, Transform):
+            if isinstance(lhs, KeyTransform):
+                nodes.append(lhs)
+            lhs = lhs.lhs
+    return nodes
+
+
+def contains_decrypting_lookup(where):
+    """Return whether the `WHERE` tree `where` decrypts values in postgres.
+
+    Like `aggregates.contains_decryption` for expressions, the tree is walked
+    down to its lookups, their transforms and expressions, and the queries they
+    compare to.
+    """
+    if get_decrypting_nodes(where):
+        return True
+    for lookup in get_lookups(where):
+        for side in (getattr(lookup, 'lhs', None), getattr(lookup, 'rhs', None)):
+            while isinstance(side, Transform):
+                side = side.lhs
+            side = getattr(side, 'query', side)
+            if hasattr(side, 'where') and query_decrypts(side):
+                return True
+            if contains_decryption(side):
+                return True
+    return False
+
+
+def query_decrypts(query):
+    """Return whether `query` decrypts values, in its annotations or its `WHERE` tree."""
+    if any(map(contains_decryption, query.annotations.values())):
+        return True
+    return contains_decrypting_lookup(query.where)
@@ -0,0 +1,85 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from pgcrypto_fields.streaming import (
+    CHUNK_SIZE,
+    copy_decrypted,
+    stream_decrypted,
+    write_csv,
+    write_jsonl,
+)
+
+
+WRITERS = {
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+}
+
+
+class Command(BaseCommand):
+    """Export decrypted rows with `COPY` or a server-side cursor."""
+    help = (
+        'Export the decrypted values of a model as CSV or JSON lines, with '
+        'constant memory.'
+    )
+
+    def add_arguments(self, parser):
+        """Add the model, fields and format arguments."""
+        parser.add_argument('model', metavar='app_label.ModelName')
+        parser.add_argument(
+            '--fields',
+            help='Comma separated names of the exported fields, all by default.',
+        )
+        parser.add_argument('--format', choices=sorted(WRITERS), default='csv')
+        parser.add_argument(
+            '--manager',
+            help='Name of the manager used to query the model, the default one '
+                 'by default.',
+        )
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+        parser.add_argument(
+            '--no-copy',
+            action='store_false',
+            dest='copy',
+            default=True,
+            help='Read CSV rows from a server-side cursor instead of COPY.',
+        )
+        parser.add_argument('--output', help='Output file, stdout by default.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        """Write the rows with COPY or from a server-side cursor."""
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError('Unknown model: {} ({})'.format(options['model'], e))
+
+        if options['manager']:
+            manager = getattr(model, options['manager'])
+        else:
+            manager = model._default_manager
+        queryset = manager.using(options['database']).order_by('pk')
+        fields = options['fields'].split(',') if options['fields'] else None
+
+        if options['output']:
+            output = open(options['output'], 'w')
+        else:
+            output = self.stdout
+            output.ending = ''
+
+        try:
+            if options['format'] == 'csv' and options['copy']:
+                try:
+                    copy_decrypted(queryset, output, fields)
+                    return
+                except ValueError:
+                    # Some fields are decrypted by an application backend.
+                    pass
+
+            rows = stream_decrypted(queryset, fields, options['chunk_size'])
+            names = fields or [f.attname for f in model._meta.concrete_fields]
+            WRITERS[options['format']](rows, names, output)
+        finally:
+            if options['output']:
+                output.close()
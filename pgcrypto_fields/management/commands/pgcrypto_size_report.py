@@ -0,0 +1,79 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from pgcrypto_fields.sizes import (
+    get_column_sizes,
+    get_encrypted_fields,
+    get_table_size,
+    SAMPLE_SIZE,
+)
+
+
+class Command(BaseCommand):
+    """Report the size of the PGP fields' ciphertexts against their plaintexts."""
+    help = (
+        'Report the average size of the plaintexts, ciphertexts and stored values '
+        'of each PGP field, to choose their pgp_options.'
+    )
+
+    def add_arguments(self, parser):
+        """Add the models and sample arguments."""
+        parser.add_argument(
+            'models',
+            metavar='app_label.ModelName',
+            nargs='*',
+            help='Models to report, all the models with PGP fields by default.',
+        )
+        parser.add_argument(
+            '--sample',
+            type=int,
+            default=SAMPLE_SIZE,
+            help='Number of values measured per field, 0 for all of them.',
+        )
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def get_models(self, labels):
+        """Return the models named by `labels`, or all the models with PGP fields."""
+        if not labels:
+            return [
+                model for model in apps.get_models()
+                if not model._meta.proxy and get_encrypted_fields(model)
+            ]
+        try:
+            return [apps.get_model(label) for label in labels]
+        except (LookupError, ValueError) as e:
+            raise CommandError('Unknown model: {}'.format(e))
+
+    def handle(self, *args, **options):
+        """Write the sizes of each field, and of the tables."""
+        using = options['database']
+        for model in self.get_models(options['models']):
+            label = '{}.{}'.format(model._meta.app_label, model._meta.object_name)
+            self.stdout.write('{}: {} bytes in total.'.format(
+                label,
+                get_table_size(model, using),
+            ))
+            for field in get_encrypted_fields(model):
+                sizes = get_column_sizes(field, using, options['sample'] or None)
+                self.stdout.write(self.format_sizes(label, field, sizes))
+
+    def format_sizes(self, label, field, sizes):
+        """Return the line of `field` sizes, averaged per value."""
+        line = '{}.{}: {} values'.format(label, field.name, sizes['values'])
+        if sizes['values']:
+            averages = {
+                name: float(sizes[name]) / sizes['values']
+                for name in ('plaintext', 'ciphertext', 'stored')
+            }
+            line += (
+                ', plaintext {plaintext:.1f}, ciphertext {ciphertext:.1f}, '
+                'stored {stored:.1f} bytes per value'
+            ).format(**averages)
+            if sizes['plaintext']:
+                line += ' (x{:.2f})'.format(
+                    float(sizes['stored']) / sizes['plaintext'],
+                )
+        if field.pgp_options:
+            line += ', options {}'.format(field.pgp_options_sql.strip(", '"))
+        return line
@@ -0,0 +1,85 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from pgcrypto_fields import (
+    KEY_BINDING_INLINE,
+    KEY_BINDING_PARAM,
+    KEY_BINDING_SESSION,
+)
+from pgcrypto_fields.rotation import BATCH_SIZE, get_rotated_fields, KeyRotation
+
+
+class Command(BaseCommand):
+    """Re-encrypt the PGP public key fields with the current public key."""
+    help = (
+        'Re-encrypt the values of the PGP public key fields encrypted with one of '
+        'PREVIOUS_PRIVATE_PGP_KEYS with PUBLIC_PGP_KEY, in resumable batches.'
+    )
+
+    def add_arguments(self, parser):
+        """Add the models, batch, workers, throttle and key binding arguments."""
+        parser.add_argument(
+            'models',
+            metavar='app_label.ModelName',
+            nargs='*',
+            help='Models to rotate, all the models with PGP public key fields by '
+                 'default.',
+        )
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of threads re-encrypting each table, on ranges of its '
+                 'integer primary key.',
+        )
+        parser.add_argument(
+            '--max-rows-per-second',
+            type=float,
+            help='Maximum number of rows read per second for each table.',
+        )
+        parser.add_argument(
+            '--reset',
+            action='store_true',
+            default=False,
+            help='Start over instead of resuming from the checkpoints.',
+        )
+        parser.add_argument(
+            '--key-binding',
+            choices=(KEY_BINDING_INLINE, KEY_BINDING_PARAM, KEY_BINDING_SESSION),
+            help='How the keys are sent to postgres, PGCRYPTO_KEY_BINDING by default.',
+        )
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def get_models(self, labels):
+        """Return the models named by `labels`, or all the models to rotate."""
+        if not labels:
+            return [
+                model for model in apps.get_models()
+                if not model._meta.proxy and get_rotated_fields(model)
+            ]
+        try:
+            return [apps.get_model(label) for label in labels]
+        except (LookupError, ValueError) as e:
+            raise CommandError('Unknown model: {}'.format(e))
+
+    def handle(self, *args, **options):
+        """Rotate the keys of each model, one table at a time."""
+        for model in self.get_models(options['models']):
+            rotation = KeyRotation(
+                model,
+                using=options['database'],
+                batch_size=options['batch_size'],
+                max_rows_per_second=options['max_rows_per_second'],
+                key_binding=options['key_binding'],
+            )
+            if not rotation.fields:
+                continue
+            rows = rotation.rotate(workers=options['workers'], reset=options['reset'])
+            self.stdout.write('{}.{}: {} rows re-encrypted with key {}.'.format(
+                model._meta.app_label,
+                model._meta.object_name,
+                rows,
+                rotation.key_id,
+            ))
@@ -1,31 +1,578 @@
-from django.conf import settings
-from django.db import models
+import threading
+from contextlib import contextmanager
 
+from django.core.exceptions import FieldError
+from django.db import connections, models, transaction
+from django.db.models.constants import LOOKUP_SEP
+from django.utils import six
+
+from pgcrypto_fields import cache, get_key_binding
+from pgcrypto_fields.aggregates import contains_decryption
+from pgcrypto_fields.bulk import EncryptedBatch, MAX_BATCH_BYTES
+from pgcrypto_fields.lookups import get_decrypting_nodes, query_decrypts
 from pgcrypto_fields.mixins import PGPMixin
+from pgcrypto_fields.routers import DECRYPT_HINT
 
 
-class PGPEncryptedManager(models.Manager):
-    """Custom manager to decrypt values at query time."""
+# Values are decrypted by postgres when the queryset is evaluated...
+DECRYPT_EAGER = 'eager'
+# ...or when they are first accessed on a model instance...
+DECRYPT_LAZY = 'lazy'
+# ...or never: ciphertexts are passed through as they are.
+DECRYPT_PASSTHROUGH = 'passthrough'
 
-    use_for_related_fields = True
+_passthrough = threading.local()
+
+
+def mark_loaded(instance):
+    """Remember the values of the PGP fields loaded in `instance`.
+
+    Those left unchanged are not encrypted again when the instance is saved.
+    """
+    for field in instance._meta.concrete_fields:
+        if isinstance(field, PGPMixin) and field.attname in instance.__dict__:
+            field.mark_loaded(instance)
+
+
+def has_ciphertexts(instance):
+    """Tell if PGP fields of `instance` hold ciphertexts to decrypt on access."""
+    return any(
+        isinstance(instance.__dict__.get(field.attname), six.memoryview)
+        for field in instance._meta.concrete_fields
+        if isinstance(field, PGPMixin)
+    )
+
+
+class LazyDecryption(object):
+    """Model instances loaded together whose values are decrypted on access.
+
+    `EncryptedProxyField` calls `decrypt` when it reads a ciphertext; the field's
+    values of every instance still holding a ciphertext are then decrypted in one
+    batch by the field's backend, except those found in the decryption cache
+    (see `cache.DecryptionCache`).
+    """
+    def __init__(self, using, key_binding=None):
+        """Decrypt with the database `using`."""
+        self.using = using
+        self.key_binding = key_binding
+        self.instances = []
+
+    def add(self, instance):
+        """Decrypt `instance` values with the other instances.
+
+        The loaded values are remembered, so those left unchanged are not
+        encrypted again when the instance is saved.
+        """
+        instance._lazy_decryption = self
+        self.instances.append(instance)
+        mark_loaded(instance)
+
+    def decrypt(self, field):
+        """Decrypt `field` values of the instances, return how many were decrypted."""
+        pending = [
+            instance for instance in self.instances
+            if isinstance(instance, field.model)
+            if isinstance(instance.__dict__.get(field.name), six.memoryview)
+        ]
+        if not pending:
+            return 0
+
+        values = cache.decrypt(
+            field,
+            [instance.__dict__[field.name] for instance in pending],
+            self.using,
+            self.key_binding,
+        )
+        for instance, value in zip(pending, values):
+            instance.__dict__[field.name] = value
+            field.mark_loaded(instance)
+        return len(pending)
+
+    def decrypt_all(self, names=None):
+        """Decrypt the PGP fields of the instances, or those named in `names`.
+
+        Each field is decrypted in one batch; return how many values were
+        decrypted.
+        """
+        fields = []
+        for instance in self.instances:
+            for field in instance._meta.concrete_fields:
+                if not isinstance(field, PGPMixin) or field in fields:
+                    continue
+                if names is None or field.name in names:
+                    fields.append(field)
+        return sum(self.decrypt(field) for field in fields)
+
+
+class CiphertextPassthrough(LazyDecryption):
+    """Model instances loaded together whose ciphertexts are never decrypted.
+
+    Their PGP fields hold the `bytea` ciphertexts, saved again as they are
+    without being encrypted, for example to copy rows to another database.
+    """
+    def decrypt(self, field):
+        """Leave the ciphertexts of `field` as they are."""
+        return 0
+
+
+@contextmanager
+def ciphertext_passthrough():
+    """Pass the ciphertexts of the `PGPEncryptedQuerySet` evaluated in the block.
+
+    The querysets are evaluated with `DECRYPT_PASSTHROUGH`, whatever the mode of
+    their manager, so the `serializers` get the ciphertexts of the default
+    managers read by `dumpdata`.
+    """
+    previous = getattr(_passthrough, 'active', False)
+    _passthrough.active = True
+    try:
+        yield
+    finally:
+        _passthrough.active = previous
+
+
+def decrypt_loaded(instances, *names):
+    """Decrypt the ciphertexts of `instances` loaded lazily, before any access.
+
+    The PGP fields, or those named in `names`, are decrypted in one query per
+    field for all the instances of each queryset, so the instances can then be
+    read without any query, for example by code which must not block on the
+    database. Return how many values were decrypted.
+    """
+    lazy_decryptions = []
+    for instance in instances:
+        lazy_decryption = getattr(instance, '_lazy_decryption', None)
+        if lazy_decryption is not None and lazy_decryption not in lazy_decryptions:
+            lazy_decryptions.append(lazy_decryption)
+    return sum(
+        lazy_decryption.decrypt_all(names or None)
+        for lazy_decryption in lazy_decryptions
+    )
+
+
+class PGPEncryptedQuerySet(models.QuerySet):
+    """QuerySet of models with PGP fields.
+
+    PGP fields are decrypted by postgres when the queryset is evaluated. The
+    decryption SQL is only added then, for the fields selected with `decrypt`
+    which are loaded according to `only` and `defer`.
+
+    `decrypt` defines what happens to the other PGP fields:
+    - with `DECRYPT_EAGER` they are deferred;
+    - with `DECRYPT_LAZY` their ciphertexts are loaded and decrypted on first
+      access;
+    - with `DECRYPT_PASSTHROUGH` their ciphertexts are loaded and never
+      decrypted, see `CiphertextPassthrough`.
+
+    With `route_decryption`, the queries decrypting values are hinted to
+    `routers.DecryptionRouter`.
+    """
+    def __init__(self, *args, **kwargs):
+        """Store how, when and where values are decrypted."""
+        self.key_binding = get_key_binding(kwargs.pop('key_binding', None))
+        self.decrypt_mode = kwargs.pop('decrypt', DECRYPT_EAGER)
+        self.route_decryption = kwargs.pop('route_decryption', True)
+        # Names of the PGP fields decrypted in the query, `None` for all of them.
+        self.decrypt_fields = kwargs.pop('decrypt_fields', None)
+        if self.decrypt_mode != DECRYPT_EAGER and self.decrypt_fields is None:
+            self.decrypt_fields = ()
+        super(PGPEncryptedQuerySet, self).__init__(*args, **kwargs)
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('key_binding', self.key_binding)
+        kwargs.setdefault('decrypt_mode', self.decrypt_mode)
+        kwargs.setdefault('decrypt_fields', self.decrypt_fields)
+        kwargs.setdefault('route_decryption', self.route_decryption)
+        return super(PGPEncryptedQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def _for_decryption(self):
+        """Return a clone hinted to `routers.DecryptionRouter` as decrypting values."""
+        clone = self._clone()
+        if self.route_decryption:
+            clone._hints = dict(clone._hints, **{DECRYPT_HINT: True})
+        return clone
+
+    def _route_decryption(self, expressions=()):
+        """Return a clone hinted as decrypting values if the query decrypts any.
+
+        The annotations, the lookups of the `WHERE` clause and the extra
+        `expressions`, such as aggregates, are looked at.
+        """
+        if query_decrypts(self.query) or any(map(contains_decryption, expressions)):
+            return self._for_decryption()
+        return self._clone()
+
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        """Decrypt the filtered values with the key binding of the queryset.
+
+        Querysets filtering on decrypted values are hinted as decrypting values,
+        so their `count()` and `exists()` are read from a decryption database.
+        """
+        clone = super(PGPEncryptedQuerySet, self)._filter_or_exclude(
+            negate,
+            *args,
+            **kwargs
+        )
+        for node in get_decrypting_nodes(clone.query.where):
+            if 'key_binding' not in vars(node):
+                node.key_binding = self.key_binding
+        return clone._route_decryption()
+
+    def annotate(self, *args, **kwargs):
+        """Annotate, hinted as decrypting values if the annotations decrypt any."""
+        clone = super(PGPEncryptedQuerySet, self).annotate(*args, **kwargs)
+        return clone._route_decryption()
+
+    def decrypt(self, *fields):
+        """Decrypt only the PGP fields named in `fields`, or all of them if empty."""
+        pgp_fields = [field.name for field in self._get_pgp_fields()]
+        for name in fields:
+            if name not in pgp_fields:
+                raise FieldError('{} is not a PGP field of {}.'.format(
+                    name,
+                    self.model.__name__,
+                ))
+        return self._clone(decrypt_fields=fields or None)
+
+    def only_decrypt(self, *fields):
+        """Load only `fields`, decrypting the PGP ones."""
+        pgp_fields = [field.name for field in self._get_pgp_fields()]
+        return self.only(*fields).decrypt(*[
+            name for name in fields if name in pgp_fields
+        ])
+
+    def ciphertexts(self):
+        """Load the ciphertexts of the PGP fields without ever decrypting them."""
+        return self._clone(decrypt_mode=DECRYPT_PASSTHROUGH, decrypt_fields=())
+
+    def _get_pgp_fields(self, model=None):
+        return [
+            field for field in (model or self.model)._meta.concrete_fields
+            if isinstance(field, PGPMixin)
+        ]
+
+    def _get_decrypted_fields(self, names=None):
+        """PGP fields to decrypt, among `names` or the loaded fields.
+
+        Fields with a backend which doesn't use the database are always loaded
+        as ciphertexts.
+        """
+        fields = [f for f in self._get_pgp_fields() if f.backend.in_database]
+        if self.decrypt_fields is not None:
+            fields = [f for f in fields if f.name in self.decrypt_fields]
+
+        if names is not None:
+            return [f for f in fields if f.name in names or f.attname in names]
+
+        existing, defer = self.query.deferred_loading
+        if defer:
+            return [f for f in fields if f.name not in existing]
+        if existing:
+            return [f for f in fields if f.name in existing]
+        return fields
+
+    def _get_related_pgp_fields(self):
+        """Return `(path, field)` for the PGP fields of `select_related` models."""
+        related_fields = []
+
+        def walk(model, related, prefix):
+            for name, nested in related.items():
+                path = prefix + [name]
+                related_model = model._meta.get_field(name).related_model
+                for field in self._get_pgp_fields(related_model):
+                    related_fields.append((LOOKUP_SEP.join(path), field))
+                walk(related_model, nested, path)
+
+        # `select_related()` without fields follows every non-null foreign key
+        # through the compiler, only explicit relations are decrypted.
+        if isinstance(self.query.select_related, dict):
+            walk(self.model, self.query.select_related, [])
+        return related_fields
 
-    def get_decrypt_sql(self, field):
-        """If field needs an explicit cast, use it."""
-        if hasattr(field, 'cast_sql'):
-            return field.cast_sql % """pgp_pub_decrypt("{0}"."{1}", dearmor('{2}'))"""
+    def _add_decryption(self, fields, prefix=''):
+        """Annotate the decrypted value of `fields` under their name.
+
+        The annotations replace the loaded ciphertexts on the instances.
+        """
+        for field in fields:
+            name = prefix + field.name
+            self.query.add_annotation(
+                field.aggregate(name, key_binding=self.key_binding),
+                name,
+                is_summary=False,
+            )
+
+    def _with_decryption(self):
+        """Return a clone of the queryset decrypting the loaded PGP fields.
+
+        The ciphertext of decrypted fields is deferred, unless they are loaded
+        explicitly with `only` which is needed to refresh deferred fields.
+
+        With `DECRYPT_EAGER`, the PGP fields of the models followed by
+        `select_related` are decrypted too.
+        """
+        fields = self._get_decrypted_fields()
+        clone = self._clone()
+        clone._add_decryption(fields)
+
+        if self.decrypt_mode == DECRYPT_EAGER:
+            for path, field in self._get_related_pgp_fields():
+                if field.backend.in_database:
+                    clone._add_decryption([field], path + LOOKUP_SEP)
+
+        if clone.query.deferred_loading[1]:
+            if self.decrypt_mode == DECRYPT_EAGER:
+                deferred = [
+                    f for f in self._get_pgp_fields() if f.backend.in_database
+                ]
+            else:
+                deferred = fields
+            clone.query.add_deferred_loading([f.name for f in deferred])
+        return clone._route_decryption()
+
+    def _get_related_instances(self, instance, paths):
+        """Return `(path, related instance)` for the `select_related` `paths`."""
+        for path in paths:
+            related = instance
+            for name in path.split(LOOKUP_SEP):
+                related = getattr(related, name, None)
+                if related is None:
+                    break
+            yield path, related
+
+    def _attach(self, lazy_decryption, instance):
+        """Add `instance` to `lazy_decryption` if it has ciphertexts to decrypt.
+
+        Other instances aren't kept, so `iterator()` doesn't hold the rows read.
+        """
+        if self.decrypt_mode == DECRYPT_PASSTHROUGH or has_ciphertexts(instance):
+            lazy_decryption.add(instance)
         else:
-            return """pgp_pub_decrypt("{0}"."{1}", dearmor('{2}'))"""
-
-    def get_queryset(self, *args, **kwargs):
-        """Django queryset.extra() is used here to add decryption sql to query."""
-        select_sql = {}
-        encrypted_fields = []
-        for f in self.model._meta.get_fields_with_model():
-            field = f[0]
-            if isinstance(field, PGPMixin):
-                select_sql[field.name] = self.get_decrypt_sql(field).format(
-                    field.model._meta.db_table, field.name, settings.PRIVATE_PGP_KEY,
+            mark_loaded(instance)
+
+    def iterator(self):
+        """Decrypt the PGP fields and attach instances to a `LazyDecryption`.
+
+        PGP fields of `select_related` models are either decrypted with the
+        query or added to the `LazyDecryption`.
+
+        Inside `ciphertext_passthrough`, the ciphertexts are passed through.
+        """
+        passthrough = getattr(_passthrough, 'active', False)
+        if passthrough and self.decrypt_mode != DECRYPT_PASSTHROUGH:
+            for instance in self.ciphertexts().iterator():
+                yield instance
+            return
+
+        queryset = self._with_decryption()
+        related_fields = self._get_related_pgp_fields()
+        related_paths = set(path for path, field in related_fields)
+        if self.decrypt_mode == DECRYPT_EAGER:
+            decrypted_fields = [
+                (path, field) for path, field in related_fields
+                if field.backend.in_database
+            ]
+        else:
+            decrypted_fields = []
+
+        # Lazily loaded values are decrypted where decrypting queries are read.
+        if self.decrypt_mode == DECRYPT_PASSTHROUGH:
+            lazy_decryption = CiphertextPassthrough(self.db)
+        else:
+            lazy_decryption = LazyDecryption(
+                self._for_decryption().db,
+                self.key_binding,
+            )
+        for instance in super(PGPEncryptedQuerySet, queryset).iterator():
+            self._attach(lazy_decryption, instance)
+            related_instances = dict(
+                self._get_related_instances(instance, related_paths),
+            )
+            for path, field in decrypted_fields:
+                value = instance.__dict__.pop(path + LOOKUP_SEP + field.name)
+                if related_instances[path] is not None:
+                    related_instances[path].__dict__[field.name] = value
+            for related in related_instances.values():
+                if related is not None:
+                    self._attach(lazy_decryption, related)
+            yield instance
+
+    def _get_value_names(self):
+        """Names returned by `values()` without arguments, in the same order."""
+        names = list(self.query.extra_select)
+        names.extend(f.attname for f in self.model._meta.concrete_fields)
+        names.extend(self.query.annotation_select)
+        return names
+
+    def values(self, *fields):
+        """Return decrypted values of the PGP fields selected with `decrypt`."""
+        if not fields:
+            fields = self._get_value_names()
+        clone = self._clone()
+        clone._add_decryption(self._get_decrypted_fields(fields))
+        clone = clone._route_decryption()
+        return super(PGPEncryptedQuerySet, clone).values(*fields)
+
+    def values_list(self, *fields, **kwargs):
+        """Return decrypted values of the PGP fields selected with `decrypt`."""
+        if not fields:
+            fields = self._get_value_names()
+        clone = self._clone()
+        clone._add_decryption(self._get_decrypted_fields(fields))
+        clone = clone._route_decryption()
+        return super(PGPEncryptedQuerySet, clone).values_list(*fields, **kwargs)
+
+    def aggregate(self, *args, **kwargs):
+        """Aggregate where decrypting queries are read if values are decrypted."""
+        clone = self._route_decryption(args + tuple(kwargs.values()))
+        return super(PGPEncryptedQuerySet, clone).aggregate(*args, **kwargs)
+
+    def _write_batches(self, objs, get_batch, max_batch_bytes, batch_size):
+        """Add `objs` to the batch returned by `get_batch`, writing full batches."""
+        batches = []
+        count = 0
+        with transaction.atomic(using=self.db, savepoint=False):
+            for obj in objs:
+                batch, add = get_batch(obj)
+                if batch not in batches:
+                    batches.append(batch)
+                batch.add([batch.prepare(field, obj, add) for field in batch.fields])
+                count += 1
+                if batch.size >= max_batch_bytes or len(batch) == batch_size:
+                    batch.execute()
+            for batch in batches:
+                if len(batch):
+                    batch.execute()
+        return count
+
+    def bulk_create_encrypted(self, objs, max_batch_bytes=MAX_BATCH_BYTES,
+                              batch_size=None):
+        """Insert `objs`, sending the keys once per statement instead of per value.
+
+        `objs` can be any iterable, a statement is sent every time the values
+        reach about `max_batch_bytes` bytes or `batch_size` rows. Like
+        `bulk_create`, `save()` is not called and no signal is sent; primary keys
+        are not set either. Return the number of inserted rows.
+        """
+        if self.model._meta.parents:
+            raise ValueError("Can't bulk create a multi-table inherited model")
+
+        connection = connections[self.db]
+        fields = self.model._meta.local_concrete_fields
+        with_pk = EncryptedBatch(self.model, fields, connection, self.key_binding)
+        without_pk = EncryptedBatch(
+            self.model,
+            [f for f in fields if not isinstance(f, models.AutoField)],
+            connection,
+            self.key_binding,
+        )
+
+        def get_batch(obj):
+            obj._state.adding = False
+            obj._state.db = self.db
+            return (without_pk if obj.pk is None else with_pk), True
+
+        return self._write_batches(objs, get_batch, max_batch_bytes, batch_size)
+
+    def bulk_update_encrypted(self, objs, fields, max_batch_bytes=MAX_BATCH_BYTES,
+                              batch_size=None):
+        """Update `fields` of `objs`, sending the keys once per statement.
+
+        The blind, range and search indexes of the updated fields are updated too. See
+        `bulk_create_encrypted` for the batches. Return the number of objects.
+        """
+        opts = self.model._meta
+        update_fields = [opts.pk]
+        for name in fields:
+            field = opts.get_field(name)
+            if not field.concrete or field.primary_key:
+                raise ValueError(
+                    'bulk_update_encrypted() can only update concrete fields which '
+                    'are not primary keys: {}.'.format(name),
                 )
-                encrypted_fields.append(field.name)
-        return super(PGPEncryptedManager, self).get_queryset(
-            *args, **kwargs).defer(*encrypted_fields).extra(select=select_sql)
+            update_fields.append(field)
+            if isinstance(field, PGPMixin):
+                update_fields.extend(field.index_fields)
+
+        batch = EncryptedBatch(
+            self.model,
+            update_fields,
+            connections[self.db],
+            self.key_binding,
+            update=True,
+        )
+        return self._write_batches(
+            objs,
+            lambda obj: (batch, False),
+            max_batch_bytes,
+            batch_size,
+        )
+
+
+class PGPEncryptedManager(models.Manager):
+    """Custom manager to decrypt values at query time.
+
+    `key_binding` defines how the private key is sent to postgres:
+    - `KEY_BINDING_INLINE` writes `dearmor('<armored key>')` in the SQL;
+    - `KEY_BINDING_PARAM` sends the key, dearmored once by the application, as a
+      `bytea` query parameter;
+    - `KEY_BINDING_SESSION` reads the key stored in the database session with
+      `pgcrypto_fields_priv_key()`.
+
+    It defaults to the `PGCRYPTO_KEY_BINDING` setting.
+
+    `decrypt` defines when values are decrypted:
+    - `DECRYPT_EAGER` decrypts every PGP field in the query;
+    - `DECRYPT_LAZY` loads the ciphertexts and decrypts a field for all the
+      instances of the queryset the first time it is accessed on one of them;
+    - `DECRYPT_PASSTHROUGH` loads the ciphertexts and never decrypts them.
+
+    `route_decryption` hints the queries decrypting values to
+    `routers.DecryptionRouter`, which reads them from the replicas of the
+    `PGCRYPTO_DECRYPTION_DATABASES` setting. Disable it for the queries which
+    must read the default database, to see the writes not yet replicated.
+
+    Use `PGPEncryptedQuerySet.decrypt` to choose which fields are decrypted in
+    the query.
+    """
+
+    use_for_related_fields = True
+
+    def __init__(self, key_binding=None, decrypt=DECRYPT_EAGER,
+                 route_decryption=True):
+        """Store how the private key is sent to postgres, when and where to decrypt."""
+        super(PGPEncryptedManager, self).__init__()
+        self.key_binding = key_binding
+        self.decrypt_mode = decrypt
+        self.route_decryption = route_decryption
+
+    def get_queryset(self):
+        """Return a `PGPEncryptedQuerySet` decrypting values when evaluated."""
+        return PGPEncryptedQuerySet(
+            self.model,
+            using=self._db,
+            hints=self._hints,
+            key_binding=self.key_binding,
+            decrypt=self.decrypt_mode,
+            route_decryption=self.route_decryption,
+        )
+
+    def decrypt(self, *fields):
+        """See `PGPEncryptedQuerySet.decrypt`."""
+        return self.get_queryset().decrypt(*fields)
+
+    def only_decrypt(self, *fields):
+        """See `PGPEncryptedQuerySet.only_decrypt`."""
+        return self.get_queryset().only_decrypt(*fields)
+
+    def ciphertexts(self):
+        """See `PGPEncryptedQuerySet.ciphertexts`."""
+        return self.get_queryset().ciphertexts()
+
+    def bulk_create_encrypted(self, *args, **kwargs):
+        """See `PGPEncryptedQuerySet.bulk_create_encrypted`."""
+        return self.get_queryset().bulk_create_encrypted(*args, **kwargs)
+
+    def bulk_update_encrypted(self, *args, **kwargs):
+        """See `PGPEncryptedQuerySet.bulk_update_encrypted`."""
+        return self.get_queryset().bulk_update_encrypted(*args, **kwargs)
@@ -0,0 +1,27 @@
+from django.db import migrations
+
+
+CREATE_FUNCTIONS = """
+CREATE OR REPLACE FUNCTION pgcrypto_fields_pub_key() RETURNS bytea AS $$
+    SELECT dearmor(current_setting('pgcrypto_fields.public_key'))
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION pgcrypto_fields_priv_key() RETURNS bytea AS $$
+    SELECT dearmor(current_setting('pgcrypto_fields.private_key'))
+$$ LANGUAGE sql STABLE;
+"""
+DROP_FUNCTIONS = """
+DROP FUNCTION pgcrypto_fields_pub_key();
+DROP FUNCTION pgcrypto_fields_priv_key();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pgcrypto_fields', '0001_add_pgcrypto_extension'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_FUNCTIONS, DROP_FUNCTIONS),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+
+CREATE_FUNCTION = """
+CREATE OR REPLACE FUNCTION pgcrypto_fields_sym_key() RETURNS text AS $$
+    SELECT current_setting('pgcrypto_fields.symmetric_key')
+$$ LANGUAGE sql STABLE;
+"""
+DROP_FUNCTION = """
+DROP FUNCTION pgcrypto_fields_sym_key();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pgcrypto_fields', '0002_add_key_functions'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_FUNCTION, DROP_FUNCTION),
+    ]
@@ -0,0 +1,44 @@
+from django.db import migrations, models
+
+
+CREATE_FUNCTION = """
+CREATE OR REPLACE FUNCTION pgcrypto_fields_priv_key(key_id text) RETURNS bytea AS $$
+    SELECT dearmor(current_setting('pgcrypto_fields.private_key_' || lower(key_id)))
+$$ LANGUAGE sql STABLE;
+"""
+DROP_FUNCTION = """
+DROP FUNCTION pgcrypto_fields_priv_key(text);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pgcrypto_fields', '0003_add_symmetric_key_function'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_FUNCTION, DROP_FUNCTION),
+        migrations.CreateModel(
+            name='KeyRotationCheckpoint',
+            fields=[
+                ('id', models.AutoField(
+                    verbose_name='ID',
+                    serialize=False,
+                    auto_created=True,
+                    primary_key=True,
+                )),
+                ('table', models.CharField(max_length=255)),
+                ('key_id', models.CharField(max_length=16)),
+                ('range_start', models.TextField(null=True)),
+                ('range_end', models.TextField(null=True)),
+                ('last_pk', models.TextField(null=True)),
+                ('rows', models.BigIntegerField(default=0)),
+                ('completed', models.BooleanField(default=False)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ('table', 'id'),
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+from django.db import migrations
+
+
+# The IV is the keyed hash of the value, so equal values have equal ciphertexts.
+# It is stored before the AES ciphertext to decrypt it.
+CREATE_FUNCTIONS = """
+CREATE OR REPLACE FUNCTION pgcrypto_fields_det_encrypt(value text, passphrase text)
+RETURNS bytea AS $$
+    SELECT d.iv || encrypt_iv(d.data, d.key, d.iv, 'aes-cbc/pad:pkcs')
+    FROM (
+        SELECT
+            convert_to(value, 'UTF8') AS data,
+            hmac('pgcrypto_fields:deterministic:key', passphrase, 'sha256') AS key,
+            substring(hmac(
+                convert_to(value, 'UTF8'),
+                hmac('pgcrypto_fields:deterministic:iv', passphrase, 'sha256'),
+                'sha256'
+            ) FROM 1 FOR 16) AS iv
+    ) AS d
+$$ LANGUAGE sql IMMUTABLE STRICT;
+
+CREATE OR REPLACE FUNCTION pgcrypto_fields_det_decrypt(data bytea, passphrase text)
+RETURNS text AS $$
+    SELECT convert_from(decrypt_iv(
+        substring(data FROM 17),
+        hmac('pgcrypto_fields:deterministic:key', passphrase, 'sha256'),
+        substring(data FROM 1 FOR 16),
+        'aes-cbc/pad:pkcs'
+    ), 'UTF8')
+$$ LANGUAGE sql IMMUTABLE STRICT;
+"""
+DROP_FUNCTIONS = """
+DROP FUNCTION pgcrypto_fields_det_encrypt(text, text);
+DROP FUNCTION pgcrypto_fields_det_decrypt(bytea, text);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pgcrypto_fields', '0004_add_key_rotation'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_FUNCTIONS, DROP_FUNCTIONS),
+    ]
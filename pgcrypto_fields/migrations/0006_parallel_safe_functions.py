@@ -0,0 +1,42 @@
+from django.db import migrations
+
+
+# Functions are parallel unsafe unless marked otherwise, which keeps postgres
+# from planning parallel scans of the queries calling them. `PARALLEL` only
+# exists since postgres 9.6.
+FUNCTIONS = (
+    'pgcrypto_fields_pub_key()',
+    'pgcrypto_fields_priv_key()',
+    'pgcrypto_fields_sym_key()',
+    'pgcrypto_fields_priv_key(text)',
+    'pgcrypto_fields_det_encrypt(text, text)',
+    'pgcrypto_fields_det_decrypt(bytea, text)',
+)
+ALTER_FUNCTIONS = """
+DO $$
+BEGIN
+    IF current_setting('server_version_num')::integer >= 90600 THEN
+        {}
+    END IF;
+END
+$$;
+"""
+
+
+def alter_functions(parallel):
+    """Return the SQL marking the functions `parallel` on postgres >= 9.6."""
+    return ALTER_FUNCTIONS.format('\n        '.join(
+        'EXECUTE \'ALTER FUNCTION {} PARALLEL {}\';'.format(function, parallel)
+        for function in FUNCTIONS
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pgcrypto_fields', '0005_add_deterministic_functions'),
+    ]
+
+    operations = [
+        migrations.RunSQL(alter_functions('SAFE'), alter_functions('UNSAFE')),
+    ]
@@ -1,7 +1,50 @@
+import copy
+import json
+
+from django.core import checks
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MaxLengthValidator
+from django.db import models
+from django.utils import six
 
+from pgcrypto_fields import (
+    CAST_TO_TEXT,
+    DETERMINISTIC_ENCRYPT_SQL,
+    keys,
+    PGP_PUB_ENCRYPT_SQL,
+    PGP_SYM_ENCRYPT_SQL,
+    PUBLIC_KEY_SQL,
+    SYMMETRIC_KEY_SQL,
+)
 from pgcrypto_fields.aggregates import (
+    DeterministicDecrypt,
     PGPPublicKeyAggregate,
+    PGPSymmetricKeyDecrypt,
+)
+from pgcrypto_fields.backends import get_backend
+from pgcrypto_fields.indexes import (
+    BlindIndexField,
+    KeyIndexField,
+    RangeIndexField,
+    SEARCH_PREFIX_LENGTH,
+    SearchIndexField,
+)
+from pgcrypto_fields.lookups import (
+    BlindIndexExact,
+    BlindIndexIn,
+    CiphertextExact,
+    CiphertextIn,
+    KeyTransformFactory,
+    RangeIndexExact,
+    RangeIndexGreaterThan,
+    RangeIndexGreaterThanOrEqual,
+    RangeIndexLessThan,
+    RangeIndexLessThanOrEqual,
+    RangeIndexRange,
+    SearchIndexEmailDomain,
+    SearchIndexIStartsWith,
+    SearchIndexStartsWith,
 )
 from pgcrypto_fields.proxy import EncryptedProxyField
 
@@ -15,14 +58,150 @@ class PGPMixin(object):
     """PGP encryption for field's value.
 
     `PGPMixin` uses 'pgcrypto' to encrypt data in a postgres database.
+
+    With `blind_index=True` a keyed hash of the value is kept in a companion
+    indexed column (see `BlindIndexField`) and `exact`/`in` lookups are
+    rewritten to use it.
+
+    With `range_index=<bucket size>`, integer and date fields keep the keyed
+    bucket of `bucket size` values (or days) holding the value in a companion
+    indexed column (see `RangeIndexField`), pruning the rows decrypted by
+    `exact`, `gt`, `gte`, `lt`, `lte` and `range` lookups.
+
+    With `search_index=True`, or the maximum length of the indexed prefixes, text
+    fields keep keyed tokens of their prefixes (and of the domain of email
+    addresses) in a companion column (see `SearchIndexField`), pruning the rows
+    decrypted by `startswith`, `istartswith` and `email_domain` lookups.
+
+    `backend` is the dotted path of the backend encrypting and decrypting the
+    values, defaulting to the `PGCRYPTO_BACKEND` setting (see `backends`).
+
+    `pgp_options` is a dict of pgcrypto options used to encrypt the values, for
+    example `{'compress-algo': 2, 'compress-level': 9}` to compress large texts
+    before they are encrypted (see `pgp_option_names`).
     """
     descriptor_class = EncryptedProxyField
+    symmetric_key = False
+    blind_index_lookups = {
+        'exact': BlindIndexExact,
+        'in': BlindIndexIn,
+    }
+    range_index_lookups = {
+        'exact': RangeIndexExact,
+        'gt': RangeIndexGreaterThan,
+        'gte': RangeIndexGreaterThanOrEqual,
+        'lt': RangeIndexLessThan,
+        'lte': RangeIndexLessThanOrEqual,
+        'range': RangeIndexRange,
+    }
+    range_index_types = (models.IntegerField, models.DateField)
+    search_index_lookups = {
+        'startswith': SearchIndexStartsWith,
+        'istartswith': SearchIndexIStartsWith,
+    }
+    search_index_types = (models.CharField, models.TextField)
+    # Options of `pgp_pub_encrypt`; the `s2k-*` and `sess-key` options only
+    # apply to symmetric keys.
+    pgp_option_names = (
+        'cipher-algo',
+        'compress-algo',
+        'compress-level',
+        'convert-crlf',
+        'disable-mdc',
+        'unicode-mode',
+    )
 
     def __init__(self, *args, **kwargs):
         """`max_length` should be set to None as encrypted text size is variable."""
+        self.blind_index = kwargs.pop('blind_index', False)
+        self.range_index = kwargs.pop('range_index', None)
+        self.search_index = kwargs.pop('search_index', None)
+        self.backend_path = kwargs.pop('backend', None)
+        self.pgp_options = kwargs.pop('pgp_options', None) or {}
         kwargs['max_length'] = None
         super(PGPMixin, self).__init__(*args, **kwargs)
 
+    def deconstruct(self):
+        """Add the indexes, backend and options to the field's arguments."""
+        name, path, args, kwargs = super(PGPMixin, self).deconstruct()
+        if self.blind_index:
+            kwargs['blind_index'] = True
+        if self.range_index:
+            kwargs['range_index'] = self.range_index
+        if self.search_index:
+            kwargs['search_index'] = self.search_index
+        if self.backend_path:
+            kwargs['backend'] = self.backend_path
+        if self.pgp_options:
+            kwargs['pgp_options'] = self.pgp_options
+        return name, path, args, kwargs
+
+    @property
+    def backend(self):
+        """Backend encrypting and decrypting the field's values."""
+        return get_backend(self.backend_path)
+
+    @property
+    def pgp_options_sql(self):
+        """Return the options argument of the encryption function, if any."""
+        if not self.pgp_options:
+            return ''
+        return ", '{}'".format(', '.join(
+            '{}={}'.format(name, value)
+            for name, value in sorted(self.pgp_options.items())
+        ))
+
+    @property
+    def encrypt_sql(self):
+        """Return the SQL encrypting the value with the field's `pgp_options`."""
+        return self.encrypt_sql_template.format(
+            key=keys.encrypt_key_sql(self.key_sql),
+            options=self.pgp_options_sql,
+        )
+
+    @property
+    def blind_index_name(self):
+        """Name of the companion `BlindIndexField`."""
+        return '{}_blind_index'.format(self.name)
+
+    @property
+    def blind_index_field(self):
+        """Companion `BlindIndexField` holding the value's keyed hash."""
+        return self.model._meta.get_field(self.blind_index_name)
+
+    @property
+    def range_index_name(self):
+        """Name of the companion `RangeIndexField`."""
+        return '{}_range_index'.format(self.name)
+
+    @property
+    def range_index_field(self):
+        """Companion `RangeIndexField` holding the value's bucket."""
+        return self.model._meta.get_field(self.range_index_name)
+
+    @property
+    def search_index_name(self):
+        """Name of the companion `SearchIndexField`."""
+        return '{}_search_index'.format(self.name)
+
+    @property
+    def search_index_field(self):
+        """Companion `SearchIndexField` holding the tokens of the value."""
+        return self.model._meta.get_field(self.search_index_name)
+
+    @property
+    def index_fields(self):
+        """Companion fields computed from the field's value."""
+        return [
+            self.model._meta.get_field(name)
+            for name, enabled in (
+                (self.blind_index_name, self.blind_index),
+                (self.range_index_name, self.range_index),
+                (self.search_index_name, self.search_index),
+            )
+            if enabled
+        ]
+
     def contribute_to_class(self, cls, name, **kwargs):
         """
         Add a decrypted field proxy to the model.
@@ -36,19 +215,191 @@ class PGPMixin(object):
         super(PGPMixin, self).contribute_to_class(cls, name, **kwargs)
         setattr(cls, self.name, self.descriptor_class(field=self))
 
+        # Models rendered from migrations already have the indexes in their
+        # state, and abstract models pass them on to their children.
+        if cls._meta.abstract or cls.__module__ == '__fake__':
+            return
+        if self.blind_index:
+            BlindIndexField(source=name).contribute_to_class(cls, self.blind_index_name)
+        if self.range_index:
+            RangeIndexField(
+                source=name,
+                bucket_size=self.range_index,
+            ).contribute_to_class(cls, self.range_index_name)
+        if self.search_index:
+            prefix_length = self.search_index
+            if prefix_length is True:
+                prefix_length = SEARCH_PREFIX_LENGTH
+            SearchIndexField(
+                source=name,
+                prefix_length=prefix_length,
+            ).contribute_to_class(cls, self.search_index_name)
+
     def db_type(self, connection=None):
         """Value stored in the database is hexadecimal."""
         return 'bytea'
 
+    def mark_loaded(self, model_instance):
+        """Remember the value loaded from the database, see `is_unchanged`."""
+        value = model_instance.__dict__[self.attname]
+        if not isinstance(value, six.memoryview):
+            # Copied so values changed in place, like JSON objects, are noticed.
+            value = copy.deepcopy(value)
+        loaded = model_instance.__dict__.setdefault('_pgcrypto_loaded', {})
+        loaded[self.attname] = (model_instance.pk, value)
+
+    def is_unchanged(self, model_instance):
+        """Tell if the value is still the one loaded for the same row."""
+        loaded = model_instance.__dict__.get('_pgcrypto_loaded', {})
+        if model_instance._state.adding or self.attname not in loaded:
+            return False
+        if self.attname not in model_instance.__dict__:
+            return False
+        pk, value = loaded[self.attname]
+        return pk == model_instance.pk and value == model_instance.__dict__[self.attname]
+
+    def pre_save(self, model_instance, add):
+        """Return the value without decrypting a ciphertext loaded lazily.
+
+        A value unchanged since it was loaded by a `PGPEncryptedManager` is saved
+        as the column itself: it is neither sent nor encrypted again into a new
+        ciphertext.
+        """
+        auto_now = getattr(self, 'auto_now', False)
+        if not add and not auto_now and self.is_unchanged(model_instance):
+            return models.F(self.attname)
+        return self.get_save_value(model_instance, add)
+
+    def get_save_value(self, model_instance, add):
+        """Return the value to encrypt, or a ciphertext loaded lazily."""
+        if self.attname in model_instance.__dict__:
+            return model_instance.__dict__[self.attname]
+        return super(PGPMixin, self).pre_save(model_instance, add)
+
+    def get_db_prep_save(self, value, connection):
+        """Keep ciphertexts which have not been decrypted, see `get_placeholder`.
+
+        Values are encrypted here when the backend doesn't use the database.
+        """
+        if isinstance(value, six.memoryview):
+            return value
+        value = self.get_db_prep_plaintext(value, connection)
+        if value is None or self.backend.in_database:
+            return value
+        return six.memoryview(self.backend.encrypt(self, value))
+
+    def get_db_prep_plaintext(self, value, connection):
+        """Prepare `value` to be encrypted."""
+        return super(PGPMixin, self).get_db_prep_save(value, connection)
+
     def get_placeholder(self, value=None, compiler=None, connection=None):
         """
         Tell postgres to encrypt this field using PGP.
 
-        `value`, `compiler`, and `connection` are ignored here as we don't need
+        Ciphertexts loaded lazily and never decrypted, or encrypted by the
+        backend, are saved as they are.
+
+        `compiler`, and `connection` are ignored here as we don't need
         custom operators.
         """
+        if isinstance(value, six.memoryview):
+            return '%s'
         return self.encrypt_sql
 
+    def get_lookup(self, lookup_name):
+        """Use the blind, range or search index when they are enabled."""
+        if self.blind_index and lookup_name in self.blind_index_lookups:
+            return self.blind_index_lookups[lookup_name]
+        if self.range_index and lookup_name in self.range_index_lookups:
+            return self.range_index_lookups[lookup_name]
+        if self.search_index:
+            if lookup_name in self.search_index_lookups:
+                return self.search_index_lookups[lookup_name]
+            if lookup_name == 'email_domain' and isinstance(self, models.EmailField):
+                return SearchIndexEmailDomain
+        return super(PGPMixin, self).get_lookup(lookup_name)
+
+    def check(self, **kwargs):
+        """Check the indexes and the options are valid."""
+        errors = super(PGPMixin, self).check(**kwargs)
+        errors.extend(self._check_blind_index_key())
+        errors.extend(self._check_range_index())
+        errors.extend(self._check_search_index())
+        errors.extend(self._check_pgp_options())
+        return errors
+
+    def _check_blind_index_key(self):
+        if self.blind_index and not keys.get_key_set().symmetric_key:
+            return [
+                checks.Error(
+                    'PGCRYPTO_KEY setting is required to use blind_index.',
+                    hint='Set PGCRYPTO_KEY to a secret used to hash the values.',
+                    obj=self,
+                    id='pgcrypto_fields.E001',
+                ),
+            ]
+        return []
+
+    def _check_range_index(self):
+        if not self.range_index:
+            return []
+        if not isinstance(self, self.range_index_types):
+            return [
+                checks.Error(
+                    'range_index is only supported by integer and date fields.',
+                    obj=self,
+                    id='pgcrypto_fields.E004',
+                ),
+            ]
+        if not keys.get_key_set().symmetric_key:
+            return [
+                checks.Error(
+                    'PGCRYPTO_KEY setting is required to use range_index.',
+                    hint='Set PGCRYPTO_KEY to a secret used to offset the buckets.',
+                    obj=self,
+                    id='pgcrypto_fields.E005',
+                ),
+            ]
+        return []
+
+    def _check_search_index(self):
+        if not self.search_index:
+            return []
+        if not isinstance(self, self.search_index_types):
+            return [
+                checks.Error(
+                    'search_index is only supported by text and email fields.',
+                    obj=self,
+                    id='pgcrypto_fields.E006',
+                ),
+            ]
+        if not keys.get_key_set().symmetric_key:
+            return [
+                checks.Error(
+                    'PGCRYPTO_KEY setting is required to use search_index.',
+                    hint='Set PGCRYPTO_KEY to a secret used to hash the tokens.',
+                    obj=self,
+                    id='pgcrypto_fields.E007',
+                ),
+            ]
+        return []
+
+    def _check_pgp_options(self):
+        errors = []
+        for name, value in sorted(self.pgp_options.items()):
+            if name not in self.pgp_option_names or "'" in six.text_type(value):
+                errors.append(
+                    checks.Error(
+                        'Invalid pgp_options {}={}.'.format(name, value),
+                        hint='Use the options known to pgcrypto: {}.'.format(
+                            ', '.join(self.pgp_option_names),
+                        ),
+                        obj=self,
+                        id='pgcrypto_fields.E003',
+                    ),
+                )
+        return errors
+
     def _check_max_length_attribute(self, **kwargs):
         """Override `_check_max_length_attribute` to remove check on max_length."""
         return []
@@ -57,6 +408,114 @@ class PGPMixin(object):
 class PGPPublicKeyFieldMixin(PGPMixin):
     """PGP public key encrypted field mixin for postgres."""
     aggregate = PGPPublicKeyAggregate
+    key_sql = PUBLIC_KEY_SQL
+
+    def get_encrypt_sql(self, value_sql, key_sql):
+        """Return the SQL encrypting `value_sql` with the public key `key_sql`."""
+        return 'pgp_pub_encrypt({}, {}{})'.format(
+            CAST_TO_TEXT % value_sql,
+            key_sql,
+            self.pgp_options_sql,
+        )
+
+
+class PGPSymmetricKeyFieldMixin(PGPMixin):
+    """PGP symmetric key encrypted field mixin for postgres.
+
+    Values are encrypted with `settings.PGCRYPTO_KEY` by `pgp_sym_encrypt`, which
+    is much cheaper to decrypt than public key encryption.
+    """
+    aggregate = PGPSymmetricKeyDecrypt
+    encrypt_sql_template = PGP_SYM_ENCRYPT_SQL
+    key_sql = SYMMETRIC_KEY_SQL
+    symmetric_key = True
+    pgp_option_names = (
+        'cipher-algo',
+        'compress-algo',
+        'compress-level',
+        'convert-crlf',
+        'disable-mdc',
+        'sess-key',
+        's2k-mode',
+        's2k-count',
+        's2k-digest-algo',
+        's2k-cipher-algo',
+        'unicode-mode',
+    )
+
+    def get_encrypt_sql(self, value_sql, key_sql):
+        """Return the SQL encrypting `value_sql` with the key `key_sql`."""
+        return 'pgp_sym_encrypt({}, {}{})'.format(
+            CAST_TO_TEXT % value_sql,
+            key_sql,
+            self.pgp_options_sql,
+        )
+
+    def check(self, **kwargs):
+        """Check the key is configured."""
+        errors = super(PGPSymmetricKeyFieldMixin, self).check(**kwargs)
+        errors.extend(self._check_symmetric_key())
+        return errors
+
+    def _check_symmetric_key(self):
+        if not keys.get_key_set().symmetric_key:
+            return [
+                checks.Error(
+                    'PGCRYPTO_KEY setting is required to use PGP symmetric key fields.',
+                    hint='Set PGCRYPTO_KEY to a secret used to encrypt the values.',
+                    obj=self,
+                    id='pgcrypto_fields.E002',
+                ),
+            ]
+        return []
+
+
+class DeterministicFieldMixin(PGPSymmetricKeyFieldMixin):
+    """Deterministic encryption field mixin for postgres.
+
+    Values are encrypted with AES by pgcrypto's `encrypt_iv`, with an IV derived
+    from the value by an HMAC keyed with `settings.PGCRYPTO_KEY`, by the functions
+    installed by the `0005_add_deterministic_functions` migration. Equal values
+    have equal ciphertexts, so `exact` and `in` lookups, joins, `distinct()` and
+    indexes work on the ciphertexts, without decrypting them.
+
+    In exchange, the ciphertexts reveal which rows hold the same value, and how
+    often each value occurs.
+    """
+    aggregate = DeterministicDecrypt
+    encrypt_sql_template = DETERMINISTIC_ENCRYPT_SQL
+    pgp_option_names = ()
+    ciphertext_lookups = {
+        'exact': CiphertextExact,
+        'in': CiphertextIn,
+    }
+
+    def get_encrypt_sql(self, value_sql, key_sql):
+        """Return the SQL encrypting `value_sql` with the key `key_sql`."""
+        return 'pgcrypto_fields_det_encrypt({}, {})'.format(
+            CAST_TO_TEXT % value_sql,
+            key_sql,
+        )
+
+    def get_lookup(self, lookup_name):
+        """Compare the ciphertexts for `exact` and `in` lookups."""
+        if lookup_name in self.ciphertext_lookups:
+            return self.ciphertext_lookups[lookup_name]
+        return super(DeterministicFieldMixin, self).get_lookup(lookup_name)
+
+    def check(self, **kwargs):
+        """Check the values are encrypted by postgres."""
+        errors = super(DeterministicFieldMixin, self).check(**kwargs)
+        if not self.backend.in_database:
+            errors.append(
+                checks.Error(
+                    'Deterministic fields can only be encrypted by postgres.',
+                    hint='Remove the backend argument of the field.',
+                    obj=self,
+                    id='pgcrypto_fields.E009',
+                ),
+            )
+        return errors
 
 
 class RemoveMaxLengthValidatorMixin(object):
@@ -70,3 +529,101 @@ class RemoveMaxLengthValidatorMixin(object):
 class EmailPGPPublicKeyFieldMixin(PGPPublicKeyFieldMixin,
                                   RemoveMaxLengthValidatorMixin):
     """Email mixin for PGP public key fields."""
+
+
+class EmailPGPSymmetricKeyFieldMixin(PGPSymmetricKeyFieldMixin,
+                                     RemoveMaxLengthValidatorMixin):
+    """Email mixin for PGP symmetric key fields."""
+
+
+class EmailDeterministicFieldMixin(DeterministicFieldMixin,
+                                   RemoveMaxLengthValidatorMixin):
+    """Email mixin for deterministic fields."""
+
+
+class JSONPGPPublicKeyFieldMixin(PGPPublicKeyFieldMixin):
+    """JSON mixin for PGP public key fields.
+
+    Values are serialized to JSON, encrypted as text and decrypted by postgres to
+    `jsonb`. `<field>__<key>__<key>` filters compare the decrypted text at a path
+    (see `KeyTransform`).
+
+    With `key_index=[<key>, ...]`, keyed tokens of the values at these top-level
+    keys are kept in a companion column (see `KeyIndexField`), pruning the rows
+    decrypted by `<field>__<key>=<value>` filters.
+    """
+    cast_sql = 'CAST(%s AS jsonb)'
+    encrypt_sql_template = PGP_PUB_ENCRYPT_SQL
+
+    def __init__(self, *args, **kwargs):
+        """Store the indexed keys."""
+        self.key_index = tuple(kwargs.pop('key_index', None) or ())
+        super(JSONPGPPublicKeyFieldMixin, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        """Add `key_index` to the field's arguments for migrations."""
+        name, path, args, kwargs = super(JSONPGPPublicKeyFieldMixin, self).deconstruct()
+        if self.key_index:
+            kwargs['key_index'] = list(self.key_index)
+        return name, path, args, kwargs
+
+    @property
+    def key_index_name(self):
+        """Name of the companion `KeyIndexField`."""
+        return '{}_key_index'.format(self.name)
+
+    @property
+    def key_index_field(self):
+        """Companion `KeyIndexField` holding the tokens of the indexed keys."""
+        return self.model._meta.get_field(self.key_index_name)
+
+    @property
+    def index_fields(self):
+        """Companion fields computed from the field's value."""
+        fields = super(JSONPGPPublicKeyFieldMixin, self).index_fields
+        if self.key_index:
+            fields.append(self.key_index_field)
+        return fields
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        """Add the key index to the model, see `PGPMixin.contribute_to_class`."""
+        super(JSONPGPPublicKeyFieldMixin, self).contribute_to_class(cls, name, **kwargs)
+        if self.key_index and not cls._meta.abstract and cls.__module__ != '__fake__':
+            KeyIndexField(
+                source=name,
+                keys=self.key_index,
+            ).contribute_to_class(cls, self.key_index_name)
+
+    def get_prep_value(self, value):
+        """Serialize the value to JSON before encryption."""
+        if value is None:
+            return None
+        return json.dumps(value, cls=DjangoJSONEncoder)
+
+    def to_python(self, value):
+        """Parse JSON text, such as the values decrypted by a backend."""
+        if not isinstance(value, six.string_types):
+            return value
+        try:
+            return json.loads(value)
+        except ValueError:
+            raise ValidationError('Enter valid JSON.', code='invalid')
+
+    def get_transform(self, name):
+        """Read the key `name` of the decrypted value."""
+        transform = super(JSONPGPPublicKeyFieldMixin, self).get_transform(name)
+        return transform or KeyTransformFactory(name)
+
+    def check(self, **kwargs):
+        """Check the secret key used by the key index is configured."""
+        errors = super(JSONPGPPublicKeyFieldMixin, self).check(**kwargs)
+        if self.key_index and not keys.get_key_set().symmetric_key:
+            errors.append(
+                checks.Error(
+                    'PGCRYPTO_KEY setting is required to use key_index.',
+                    hint='Set PGCRYPTO_KEY to a secret used to hash the tokens.',
+                    obj=self,
+                    id='pgcrypto_fields.E008',
+                ),
+            )
+        return errors
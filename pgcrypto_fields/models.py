@@ -1 +1,24 @@
+from django.db import models
+
+
 __author__ = 'coldmind'
+
+
+class KeyRotationCheckpoint(models.Model):
+    """Progress of `rotate_pgcrypto_keys` over a range of primary keys of a table.
+
+    Each worker of the command owns a range, `(range_start, range_end]`, and
+    saves the last primary key it re-encrypted with the batch, so an interrupted
+    rotation to `key_id` resumes where it stopped.
+    """
+    table = models.CharField(max_length=255)
+    key_id = models.CharField(max_length=16)
+    range_start = models.TextField(null=True)
+    range_end = models.TextField(null=True)
+    last_pk = models.TextField(null=True)
+    rows = models.BigIntegerField(default=0)
+    completed = models.BooleanField(default=False)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ('table', 'id')
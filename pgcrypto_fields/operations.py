@@ -0,0 +1,65 @@
+from django.db.migrations.operations.base import Operation
+
+
+CREATE_INDEX_SQL = 'CREATE INDEX {name} ON {table} USING gin ({column})'
+DROP_INDEX_SQL = 'DROP INDEX IF EXISTS {name}'
+
+
+class AddSearchIndex(Operation):
+    """Create the GIN index of the `SearchIndexField` of a field in a migration.
+
+    Django can't declare GIN indexes on models, add the operation to the
+    migration adding a field declared with `search_index`:
+
+        AddSearchIndex('user', 'email')
+    """
+    reduces_to_sql = True
+    reversible = True
+    index_suffix = 'search_index'
+
+    def __init__(self, model_name, name):
+        """Index the search index of the field `name` of the model `model_name`."""
+        self.model_name = model_name
+        self.name = name
+
+    def state_forwards(self, app_label, state):
+        """Leave the state as it is: the index is not part of it."""
+
+    def get_sql(self, schema_editor, model, template):
+        """Return `template` formatted for the search index column of the model."""
+        column = model._meta.get_field(
+            '{}_{}'.format(self.name, self.index_suffix),
+        ).column
+        return template.format(
+            name=schema_editor.quote_name(
+                schema_editor._create_index_name(model, [column], suffix='_gin'),
+            ),
+            table=schema_editor.quote_name(model._meta.db_table),
+            column=schema_editor.quote_name(column),
+        )
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        """Create the index."""
+        model = to_state.apps.get_model(app_label, self.model_name)
+        schema_editor.execute(self.get_sql(schema_editor, model, CREATE_INDEX_SQL))
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        """Drop the index."""
+        model = from_state.apps.get_model(app_label, self.model_name)
+        schema_editor.execute(self.get_sql(schema_editor, model, DROP_INDEX_SQL))
+
+    def describe(self):
+        """Describe the operation for `sqlmigrate` and `migrate`."""
+        return 'Create GIN index on the {} of {}.{}'.format(
+            self.index_suffix.replace('_', ' '),
+            self.model_name,
+            self.name,
+        )
+
+
+class AddKeyIndex(AddSearchIndex):
+    """Create the GIN index of the `KeyIndexField` of a JSON field in a migration.
+
+    See `AddSearchIndex`, for example `AddKeyIndex('event', 'payload')`.
+    """
+    index_suffix = 'key_index'
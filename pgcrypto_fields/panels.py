@@ -0,0 +1,37 @@
+from debug_toolbar.panels import Panel
+
+from pgcrypto_fields.instrumentation import QueryStats
+
+
+class PGCryptoPanel(Panel):
+    """Debug toolbar panel of the pgcrypto statements and decryptions of a request.
+
+    Add `'pgcrypto_fields.panels.PGCryptoPanel'` to `DEBUG_TOOLBAR_PANELS`.
+    """
+    title = 'pgcrypto'
+    template = 'pgcrypto_fields/panel.html'
+
+    def enable_instrumentation(self):
+        """Collect the statements of the request."""
+        self.query_stats = QueryStats()
+        self.query_stats.__enter__()
+
+    def disable_instrumentation(self):
+        """Stop collecting."""
+        self.query_stats.__exit__(None, None, None)
+
+    @property
+    def nav_subtitle(self):
+        """Summarize the columns decrypted and encrypted by the request."""
+        stats = self.get_stats().get('stats')
+        if not stats:
+            return ''
+        return '{decrypted} decrypted, {encrypted} encrypted'.format(**stats)
+
+    def process_response(self, request, response):
+        """Record the statements and totals of the request."""
+        self.record_stats({
+            'queries': self.query_stats.queries,
+            'accesses': sorted(self.query_stats.accesses.items()),
+            'stats': self.query_stats.stats(),
+        })
@@ -2,6 +2,8 @@ from __future__ import unicode_literals
 
 from django.utils import six
 
+from pgcrypto_fields import cache, instrumentation
+
 
 class EncryptedProxyField(object):
     """Descriptor for encrypted values.
@@ -10,6 +12,12 @@ class EncryptedProxyField(object):
 
     When accessing the field name attribute on a model instance we are
     generating N+1 queries.
+
+    Ciphertexts loaded by a `PGPEncryptedManager` in lazy mode, or of fields with
+    a backend which doesn't use the database, are decrypted on first access,
+    together with the ciphertexts of the other instances of the same queryset,
+    unless they are found in the decryption cache. `decrypted_on_access` is
+    then sent (see `instrumentation`).
     """
     def __init__(self, field):
         """
@@ -26,6 +34,8 @@ class EncryptedProxyField(object):
         Retrieve the value of the field from the instance.
 
         If the value has been saved to the database, decrypt it using an aggregate query.
+
+        If the value is a ciphertext loaded lazily, decrypt it with its queryset.
         """
         if not instance:
             return self
@@ -39,8 +49,28 @@ class EncryptedProxyField(object):
         if isinstance(value, six.binary_type):
             return value
 
-        if isinstance(value, buffer):
-            print('Unexpected encrypted field "%s"!' % self.field.name)
+        if isinstance(value, six.memoryview):
+            lazy_decryption = getattr(instance, '_lazy_decryption', None)
+            decrypted = 0
+            if lazy_decryption is not None:
+                decrypted = lazy_decryption.decrypt(self.field)
+            elif not self.field.backend.in_database:
+                instance.__dict__[self.field.name], = cache.decrypt(
+                    self.field,
+                    [value],
+                    instance._state.db,
+                )
+                decrypted = 1
+            else:
+                print('Unexpected encrypted field "%s"!' % self.field.name)
+
+            if decrypted:
+                instrumentation.decrypted_on_access.send(
+                    sender=self.model,
+                    field=self.field,
+                    values=decrypted,
+                    using=instance._state.db,
+                )
 
         return instance.__dict__[self.field.name]
 
@@ -48,8 +78,13 @@ class EncryptedProxyField(object):
         """
         Store a value in the model instance's __dict__.
 
-        The value will be keyed by the field's name.
+        The value will be keyed by the field's name. Assigning another value than
+        the one loaded from the database marks the field as changed, see
+        `PGPMixin.is_unchanged`.
         """
+        loaded = instance.__dict__.get('_pgcrypto_loaded', {})
+        if self.field.attname in loaded and loaded[self.field.attname][1] != value:
+            del loaded[self.field.attname]
         instance.__dict__[self.field.name] = value
 
     def _parse_decrypted_value(self, value, field):
@@ -0,0 +1,233 @@
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.db import connections, DEFAULT_DB_ALIAS, models, transaction
+from django.utils import six
+
+from pgcrypto_fields import get_key_binding, keys, PUBLIC_KEY_SQL
+from pgcrypto_fields.mixins import PGPMixin
+from pgcrypto_fields.models import KeyRotationCheckpoint
+
+
+BATCH_SIZE = 1000
+
+INTEGER_PKS = (models.AutoField, models.IntegerField)
+
+SELECT_BATCH_SQL = (
+    'SELECT max(b.pk), count(*) FROM '
+    '(SELECT {pk} AS pk FROM {table} WHERE {range} ORDER BY {pk} LIMIT %s) AS b'
+)
+ROTATE_SQL = (
+    'UPDATE {table} SET {assignments} FROM (SELECT {public_key} AS public_key) AS k '
+    'WHERE {range} AND {pk} <= %s AND ({stale})'
+)
+ASSIGNMENT_SQL = (
+    "{name} = CASE WHEN {column} IS NULL OR pgp_key_id({column}) = '{key_id}' "
+    "THEN {column} ELSE {encrypt} END"
+)
+
+
+def get_rotated_fields(model):
+    """Return the concrete fields of `model` encrypted with the PGP public key.
+
+    Symmetric key fields can't be rotated: `pgp_key_id` can't tell which
+    passphrase encrypted a value.
+    """
+    return [
+        field for field in model._meta.concrete_fields
+        if isinstance(field, PGPMixin) and not field.symmetric_key
+    ]
+
+
+class KeyRotation(object):
+    """Re-encrypt the PGP public key fields of a model with the current public key.
+
+    Rows are updated in batches of `batch_size` primary keys, in a transaction
+    each, by postgres only: values are decrypted with the previous private key
+    matching their `pgp_key_id` and encrypted with the current public key.
+    Values already encrypted with it are left untouched.
+
+    The progress is saved in `KeyRotationCheckpoint` rows, one per range of
+    primary keys, with each batch.
+    """
+    def __init__(self, model, using=DEFAULT_DB_ALIAS, batch_size=BATCH_SIZE,
+                 max_rows_per_second=None, key_binding=None):
+        """Rotate the keys of `model` in the database `using`.
+
+        `max_rows_per_second` limits the rate at which each range of primary keys
+        is read, to leave room for the other queries. `key_binding` defines how
+        the keys are sent to postgres, the `PGCRYPTO_KEY_BINDING` setting by default.
+        """
+        self.model = model
+        self.using = using
+        self.key_binding = get_key_binding(key_binding)
+        self.batch_size = batch_size
+        self.max_rows_per_second = max_rows_per_second
+        self.fields = get_rotated_fields(model)
+        self.pk = model._meta.pk
+        self.table = model._meta.db_table
+        self.key_id = keys.key_id(keys.get_key_set().public_key)
+
+    @property
+    def checkpoints(self):
+        """Return the checkpoints of the rotation of the table to the current key."""
+        return KeyRotationCheckpoint.objects.using(self.using).filter(
+            table=self.table,
+            key_id=self.key_id,
+        )
+
+    def get_ranges(self, count):
+        """Split the primary keys in `count` ranges of `(start, end]`.
+
+        Only integer primary keys are split, on their minimum and maximum.
+        """
+        if count < 2 or not isinstance(self.pk, INTEGER_PKS):
+            return [(None, None)]
+
+        bounds = self.model._default_manager.using(self.using).aggregate(
+            low=models.Min('pk'),
+            high=models.Max('pk'),
+        )
+        if bounds['low'] is None:
+            return [(None, None)]
+        start = bounds['low'] - 1
+        step = max(1, (bounds['high'] - start + count - 1) // count)
+        ends = list(six.moves.range(start + step, bounds['high'], step))
+        ends.append(None)
+        ranges = []
+        for end in ends:
+            ranges.append((start, end))
+            start = end
+        return ranges
+
+    def get_checkpoints(self, workers=1, reset=False):
+        """Return the checkpoints of the rotation, created for `workers` on start."""
+        if reset:
+            self.checkpoints.delete()
+        checkpoints = list(self.checkpoints)
+        if not checkpoints:
+            checkpoints = [
+                KeyRotationCheckpoint.objects.using(self.using).create(
+                    table=self.table,
+                    key_id=self.key_id,
+                    range_start=None if start is None else six.text_type(start),
+                    range_end=None if end is None else six.text_type(end),
+                )
+                for start, end in self.get_ranges(workers)
+            ]
+        return checkpoints
+
+    def _get_range(self, checkpoint):
+        """Return the SQL selecting the rows left in `checkpoint`, and its params."""
+        qn = connections[self.using].ops.quote_name
+        pk = '{}.{}'.format(qn(self.table), qn(self.pk.column))
+        conditions = []
+        params = []
+        start = checkpoint.last_pk
+        if start is None:
+            start = checkpoint.range_start
+        if start is not None:
+            conditions.append('{} > %s'.format(pk))
+            params.append(self.pk.to_python(start))
+        if checkpoint.range_end is not None:
+            conditions.append('{} <= %s'.format(pk))
+            params.append(self.pk.to_python(checkpoint.range_end))
+        return ' AND '.join(conditions) or 'TRUE', params
+
+    def rotate_sql(self, checkpoint, batch_end):
+        """Return the `UPDATE` re-encrypting rows up to `batch_end`, and its params."""
+        qn = connections[self.using].ops.quote_name
+        table = qn(self.table)
+        assignments = []
+        stale = []
+        params = []
+        for field in self.fields:
+            column = '{}.{}'.format(table, qn(field.column))
+            key_sql, key_params = field.aggregate.get_key_sql(
+                column,
+                key_binding=self.key_binding,
+            )
+            decrypt_sql = '{}({}, {})'.format(field.aggregate.function, column, key_sql)
+            assignments.append(ASSIGNMENT_SQL.format(
+                name=qn(field.column),
+                column=column,
+                key_id=self.key_id,
+                encrypt=field.get_encrypt_sql(decrypt_sql, 'k.public_key'),
+            ))
+            params.extend(key_params)
+            stale.append("pgp_key_id({}) <> '{}'".format(column, self.key_id))
+
+        range_sql, range_params = self._get_range(checkpoint)
+        sql = ROTATE_SQL.format(
+            table=table,
+            assignments=', '.join(assignments),
+            range=range_sql,
+            pk='{}.{}'.format(table, qn(self.pk.column)),
+            stale=' OR '.join(stale),
+            public_key=keys.format_sql(PUBLIC_KEY_SQL[self.key_binding]),
+        )
+        params.extend(keys.public_key_params(self.key_binding))
+        params.extend(range_params)
+        params.append(batch_end)
+        return sql, params
+
+    def rotate_batch(self, checkpoint):
+        """Re-encrypt the next batch of `checkpoint` and save it.
+
+        Return the number of rows read.
+        """
+        qn = connections[self.using].ops.quote_name
+        range_sql, range_params = self._get_range(checkpoint)
+        with transaction.atomic(using=self.using):
+            with connections[self.using].cursor() as cursor:
+                cursor.execute(
+                    SELECT_BATCH_SQL.format(
+                        pk='{}.{}'.format(qn(self.table), qn(self.pk.column)),
+                        table=qn(self.table),
+                        range=range_sql,
+                    ),
+                    range_params + [self.batch_size],
+                )
+                batch_end, count = cursor.fetchone()
+                if count:
+                    cursor.execute(*self.rotate_sql(checkpoint, batch_end))
+                    checkpoint.rows += cursor.rowcount
+                    checkpoint.last_pk = six.text_type(batch_end)
+            checkpoint.completed = count < self.batch_size
+            checkpoint.save(using=self.using)
+        return count
+
+    def rotate_range(self, checkpoint, workers=1):
+        """Re-encrypt the rows of `checkpoint` until it is completed."""
+        try:
+            while not checkpoint.completed:
+                started = time.time()
+                count = self.rotate_batch(checkpoint)
+                if self.max_rows_per_second:
+                    duration = float(count) * workers / self.max_rows_per_second
+                    time.sleep(max(0, started + duration - time.time()))
+        finally:
+            if workers > 1:
+                # Each thread has its own connection.
+                connections[self.using].close()
+        return checkpoint
+
+    def rotate(self, workers=1, reset=False):
+        """Re-encrypt the table with `workers` threads, one range of rows each.
+
+        Return the number of rows re-encrypted since the rotation started.
+        """
+        checkpoints = [
+            checkpoint for checkpoint in self.get_checkpoints(workers, reset)
+            if not checkpoint.completed
+        ]
+        if workers > 1 and len(checkpoints) > 1:
+            pool = ThreadPool(workers)
+            try:
+                pool.map(lambda c: self.rotate_range(c, workers), checkpoints)
+            finally:
+                pool.close()
+        else:
+            for checkpoint in checkpoints:
+                self.rotate_range(checkpoint)
+        return sum(checkpoint.rows for checkpoint in self.checkpoints)
@@ -0,0 +1,55 @@
+import random
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+# Hint added by `PGPEncryptedQuerySet` to the queries decrypting values.
+DECRYPT_HINT = 'pgcrypto_decrypt'
+
+
+def get_decryption_databases():
+    """Aliases of the `PGCRYPTO_DECRYPTION_DATABASES` setting."""
+    return list(getattr(settings, 'PGCRYPTO_DECRYPTION_DATABASES', ()))
+
+
+def is_decryption_database(alias):
+    """Return whether the connection `alias` may receive the private keys.
+
+    Every database may, unless `PGCRYPTO_DECRYPTION_DATABASES` is set.
+    """
+    databases = get_decryption_databases()
+    return not databases or alias in databases
+
+
+class DecryptionRouter(object):
+    """Send the queries decrypting values to the decryption databases.
+
+    `PGPEncryptedQuerySet` hints the queries which call `pgp_pub_decrypt` and
+    the other decrypt functions; they are read from one of the replicas of the
+    `PGCRYPTO_DECRYPTION_DATABASES` setting, picked at random. The other reads
+    are left to the next routers.
+
+    Writes, which only encrypt with the public key, go to the default database,
+    including those of the instances loaded from a replica.
+    """
+    def db_for_read(self, model, **hints):
+        """Return a decryption database for the queries decrypting values."""
+        databases = get_decryption_databases()
+        if databases and hints.get(DECRYPT_HINT):
+            return random.choice(databases)
+        return None
+
+    def db_for_write(self, model, **hints):
+        """Write the instances loaded from a decryption database to the default one."""
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in get_decryption_databases():
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        """Relate the instances of the default database and its replicas."""
+        databases = [DEFAULT_DB_ALIAS] + get_decryption_databases()
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
@@ -0,0 +1,113 @@
+import base64
+import json
+import sys
+
+from django.apps import apps
+from django.core.serializers.base import DeserializationError, SerializationError
+from django.core.serializers.json import Serializer as JSONSerializer
+from django.core.serializers.python import Deserializer as PythonDeserializer
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import six
+
+from pgcrypto_fields.indexes import BlindIndexField, SearchIndexField
+from pgcrypto_fields.managers import ciphertext_passthrough, CiphertextPassthrough
+from pgcrypto_fields.mixins import PGPMixin
+
+
+# Fields holding a `bytea` value, or an array of them, written in base64.
+BYTEA_FIELDS = (PGPMixin, BlindIndexField)
+BYTEA_ARRAY_FIELDS = (SearchIndexField,)
+
+
+def encode(value):
+    """Return the base64 text of a `bytea` value, or of an array of them."""
+    if isinstance(value, list):
+        return [encode(item) for item in value]
+    if value is None:
+        return None
+    return base64.b64encode(bytes(value)).decode('ascii')
+
+
+def decode(value):
+    """Return the `bytea` value, or the array of them, of base64 text."""
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+    if value is None:
+        return None
+    return six.memoryview(base64.b64decode(value))
+
+
+def is_ciphertext(value):
+    """Tell if `value` is a `bytea` value, or an array of them, loaded as it is."""
+    if isinstance(value, list):
+        return all(map(is_ciphertext, value))
+    return value is None or isinstance(value, six.memoryview)
+
+
+class Serializer(JSONSerializer):
+    """Serialize to JSON the ciphertexts of PGP fields, not their decrypted values.
+
+    Ciphertexts, and the digests and tokens of their indexes, are written in
+    base64, so the fixtures never hold decrypted values and neither key is
+    needed to dump or load them. Register the serializer with:
+
+        SERIALIZATION_MODULES = {'pgcrypto_json': 'pgcrypto_fields.serializers'}
+
+    and use `dumpdata --format pgcrypto_json`.
+    """
+    def serialize(self, queryset, **options):
+        """Pass the ciphertexts of the `PGPEncryptedManager` querysets through."""
+        with ciphertext_passthrough():
+            return super(Serializer, self).serialize(queryset, **options)
+
+    def handle_field(self, obj, field):
+        """Write the ciphertexts, and their indexes, in base64."""
+        if not isinstance(field, BYTEA_FIELDS + BYTEA_ARRAY_FIELDS):
+            return super(Serializer, self).handle_field(obj, field)
+
+        value = obj.__dict__.get(field.attname)
+        if not is_ciphertext(value):
+            raise SerializationError(
+                '{} of {} {} is not a ciphertext.'.format(
+                    field.name,
+                    type(obj).__name__,
+                    obj.pk,
+                ),
+            )
+        self._current[field.name] = encode(value)
+
+
+def Deserializer(stream_or_string, **options):
+    """Deserialize the JSON written by `Serializer`.
+
+    The ciphertexts are saved as they are by `loaddata`, without being encrypted
+    again (see `managers.CiphertextPassthrough`).
+    """
+    if not isinstance(stream_or_string, (bytes, six.string_types)):
+        stream_or_string = stream_or_string.read()
+    if isinstance(stream_or_string, bytes):
+        stream_or_string = stream_or_string.decode('utf-8')
+
+    passthrough = CiphertextPassthrough(options.get('using', DEFAULT_DB_ALIAS))
+    try:
+        objects = json.loads(stream_or_string)
+        # Values which `to_python` would not accept are set once deserialized.
+        ciphertexts = []
+        for obj in objects:
+            model = apps.get_model(obj['model'])
+            ciphertexts.append([
+                (field.attname, decode(obj['fields'].pop(field.name)))
+                for field in model._meta.concrete_fields
+                if isinstance(field, BYTEA_FIELDS + BYTEA_ARRAY_FIELDS)
+                if field.name in obj['fields']
+            ])
+
+        for obj, values in zip(PythonDeserializer(objects, **options), ciphertexts):
+            for attname, value in values:
+                setattr(obj.object, attname, value)
+            passthrough.add(obj.object)
+            yield obj
+    except GeneratorExit:
+        raise
+    except Exception as e:
+        six.reraise(DeserializationError, DeserializationError(e), sys.exc_info()[2])
@@ -0,0 +1,62 @@
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from pgcrypto_fields import KEY_BINDING_PARAM
+from pgcrypto_fields.mixins import PGPMixin
+
+
+SAMPLE_SIZE = 1000
+
+COLUMN_SIZES_SQL = (
+    'SELECT count(*), sum(octet_length({decrypted})), sum(octet_length(s.value)), '
+    'sum(pg_column_size(s.value)) FROM '
+    '(SELECT {column} AS value FROM {table} WHERE {column} IS NOT NULL LIMIT %s) AS s'
+)
+TABLE_SIZE_SQL = 'SELECT pg_total_relation_size(%s)'
+
+
+def get_encrypted_fields(model):
+    """Return the concrete PGP fields of `model`."""
+    return [
+        field for field in model._meta.concrete_fields
+        if isinstance(field, PGPMixin)
+    ]
+
+
+def get_column_sizes(field, using=DEFAULT_DB_ALIAS, sample=SAMPLE_SIZE):
+    """Return the sizes in bytes of the values of `field`, on `sample` rows or all.
+
+    Values are decrypted by postgres, with the previous private keys if needed:
+    - `values` is the number of values which are not `NULL`;
+    - `plaintext` is the size of the decrypted texts;
+    - `ciphertext` is the size of the PGP messages;
+    - `stored` is their size in the table, after TOAST compression.
+
+    The private key is sent to `using`, which isn't routed to the decryption
+    databases.
+    """
+    qn = connections[using].ops.quote_name
+    key_sql, key_params = field.aggregate.get_key_sql(
+        's.value',
+        key_binding=KEY_BINDING_PARAM,
+    )
+    sql = COLUMN_SIZES_SQL.format(
+        decrypted='{}(s.value, {})'.format(field.aggregate.function, key_sql),
+        column=qn(field.column),
+        table=qn(field.model._meta.db_table),
+    )
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, key_params + [sample])
+        values, plaintext, ciphertext, stored = cursor.fetchone()
+    return {
+        'values': values,
+        'plaintext': plaintext or 0,
+        'ciphertext': ciphertext or 0,
+        'stored': stored or 0,
+    }
+
+
+def get_table_size(model, using=DEFAULT_DB_ALIAS):
+    """Return the size in bytes of the table of `model`, with its indexes and TOAST."""
+    with connections[using].cursor() as cursor:
+        cursor.execute(TABLE_SIZE_SQL, [model._meta.db_table])
+        return cursor.fetchone()[0]
@@ -0,0 +1,218 @@
+import csv
+import json
+import uuid
+
+from django.core.management.color import no_style
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, transaction
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils import six
+
+from pgcrypto_fields.managers import CiphertextPassthrough, PGPEncryptedQuerySet
+from pgcrypto_fields.mixins import PGPMixin
+
+
+CHUNK_SIZE = 2000
+
+COPY_SQL = 'COPY (SELECT {columns} FROM ({query}) AS t) TO STDOUT WITH CSV HEADER'
+
+
+def decrypting_values(queryset, fields=None):
+    """Return a `values()` queryset decrypting every PGP field of `fields`.
+
+    `fields` defaults to the concrete fields of the model.
+    """
+    if not isinstance(queryset, PGPEncryptedQuerySet):
+        queryset = PGPEncryptedQuerySet(
+            queryset.model,
+            query=queryset.query.clone(),
+            using=queryset.db,
+        )
+    opts = queryset.model._meta
+    if not fields:
+        fields = [f.attname for f in opts.concrete_fields]
+    pgp_fields = [
+        name for name in fields
+        if isinstance(opts.get_field(name), PGPMixin)
+    ]
+    return queryset.decrypt(*pgp_fields).values(*fields)
+
+
+def get_select_names(values):
+    """Names of the columns selected by the `values()` queryset `values`, in order."""
+    names = list(values.query.extra_select)
+    names.extend(values.field_names)
+    names.extend(values.query.annotation_select)
+    return names
+
+
+def get_backend_fields(values, fields):
+    """Return `(position, field)` of `fields` decrypted by an application backend."""
+    opts = values.model._meta
+    backend_fields = []
+    for position, name in enumerate(fields):
+        field = opts.get_field(name)
+        if isinstance(field, PGPMixin) and not field.backend.in_database:
+            backend_fields.append((position, field))
+    return backend_fields
+
+
+def fetch_chunks(values, chunk_size=CHUNK_SIZE):
+    """Yield the rows of the `values()` queryset `values`, `chunk_size` at a time.
+
+    Rows are read from a server-side cursor, inside a transaction, so memory
+    doesn't grow with the size of the queryset. They hold the selected columns
+    in the order of `get_select_names`.
+    """
+    try:
+        sql, params = values.query.get_compiler(values.db).as_sql()
+    except EmptyResultSet:
+        return
+    connection = connections[values.db]
+    with transaction.atomic(using=values.db):
+        connection.ensure_connection()
+        cursor = connection.connection.cursor(
+            name='pgcrypto_fields_{}'.format(uuid.uuid4().hex),
+        )
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+
+def stream_decrypted(queryset, fields=None, chunk_size=CHUNK_SIZE):
+    """Yield tuples of the decrypted values of `fields` for `queryset`.
+
+    Rows are read `chunk_size` at a time (see `fetch_chunks`). Fields with an
+    application backend are decrypted a chunk at a time.
+    """
+    values = decrypting_values(queryset, fields)
+    fields = list(values._fields)
+    names = get_select_names(values)
+    positions = [names.index(name) for name in fields]
+    backend_fields = get_backend_fields(values, fields)
+
+    for rows in fetch_chunks(values, chunk_size):
+        rows = [[row[position] for position in positions] for row in rows]
+        for position, field in backend_fields:
+            decrypted = field.backend.decrypt(
+                field,
+                [row[position] for row in rows],
+                values.db,
+            )
+            for row, value in zip(rows, decrypted):
+                row[position] = value
+        for row in rows:
+            yield tuple(row)
+
+
+def copy_ciphertexts(queryset, using=None, model=None, chunk_size=CHUNK_SIZE):
+    """Copy the rows of `queryset` to `model` in the database `using`, encrypted.
+
+    The ciphertexts, and the values of their indexes, are read `chunk_size` rows
+    at a time (see `fetch_chunks`) and inserted as they are, without decrypting
+    or encrypting them again, for example to move the rows of a tenant to
+    another database. `model`, the queryset's model by default, must have the
+    same concrete fields. The sequences of `model` are reset like `loaddata`
+    does. Return the number of rows copied.
+    """
+    model = model or queryset.model
+    using = using or queryset.db
+    if model._meta.parents:
+        raise ValueError("Can't copy the rows of a multi-table inherited model.")
+
+    if not isinstance(queryset, PGPEncryptedQuerySet):
+        queryset = PGPEncryptedQuerySet(
+            queryset.model,
+            query=queryset.query.clone(),
+            using=queryset.db,
+        )
+    fields = model._meta.concrete_fields
+    names = [field.attname for field in fields]
+    values = queryset.ciphertexts().values_list(*names)
+    positions = [get_select_names(values).index(name) for name in names]
+
+    count = 0
+    connection = connections[using]
+    with transaction.atomic(using=using):
+        for rows in fetch_chunks(values, chunk_size):
+            passthrough = CiphertextPassthrough(using)
+            objs = []
+            for row in rows:
+                obj = model(**{
+                    name: row[position] for name, position in zip(names, positions)
+                })
+                passthrough.add(obj)
+                objs.append(obj)
+            model._base_manager._insert(objs, fields=fields, using=using, raw=True)
+            count += len(objs)
+
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [model]):
+                cursor.execute(sql)
+    return count
+
+
+def copy_decrypted(queryset, output, fields=None):
+    """Write the decrypted values of `fields` for `queryset` as CSV to `output`.
+
+    Rows are formatted by postgres with `COPY ... TO STDOUT`, the fastest path,
+    which is only available when every field is decrypted by the database.
+    """
+    values = decrypting_values(queryset, fields)
+    fields = list(values._fields)
+    if get_backend_fields(values, fields):
+        raise ValueError('COPY needs every field to be decrypted by the database.')
+
+    opts = values.model._meta
+    connection = connections[values.db]
+    qn = connection.ops.quote_name
+    columns = []
+    for name in fields:
+        field = opts.get_field(name)
+        column = name if name in values.query.annotation_select else field.column
+        columns.append('{} AS {}'.format(qn(column), qn(name)))
+
+    try:
+        sql, params = values.query.get_compiler(values.db).as_sql()
+    except EmptyResultSet:
+        write_csv([], fields, output)
+        return
+
+    connection.ensure_connection()
+    cursor = connection.connection.cursor()
+    try:
+        query = cursor.mogrify(sql, params)
+        if isinstance(query, six.binary_type):
+            query = query.decode('utf-8')
+        cursor.copy_expert(
+            COPY_SQL.format(columns=', '.join(columns), query=query),
+            output,
+        )
+    finally:
+        cursor.close()
+
+
+def write_csv(rows, fields, output):
+    """Write `rows` of `fields` values as CSV to `output`."""
+    writer = csv.writer(output)
+    writer.writerow(fields)
+    for row in rows:
+        if six.PY2:
+            row = [
+                value.encode('utf-8') if isinstance(value, six.text_type) else value
+                for value in row
+            ]
+        writer.writerow(row)
+
+
+def write_jsonl(rows, fields, output):
+    """Write `rows` of `fields` values as JSON lines to `output`."""
+    for row in rows:
+        output.write(json.dumps(dict(zip(fields, row)), cls=DjangoJSONEncoder))
+        output.write('\n')
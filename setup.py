@@ -8,6 +8,12 @@ setup(
     name='django-pgcrypto-fields',
     packages=find_packages(),
     include_package_data=True,
+    package_data={'pgcrypto_fields': ['templates/pgcrypto_fields/*.html']},
+    extras_require={
+        'debug_toolbar': ['django-debug-toolbar'],
+        'pgpy': ['PGPy'],
+        'prometheus': ['prometheus_client'],
+    },
     version=version,
     license='BSD',
     description='Encrypted fields dealing with pgcrypto postgres extension.',
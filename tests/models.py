@@ -1,7 +1,14 @@
 from django.db import models
 
-from pgcrypto_fields import fields
-from pgcrypto_fields.managers import PGPEncryptedManager
+from pgcrypto_fields import fields, KEY_BINDING_PARAM, KEY_BINDING_SESSION
+from pgcrypto_fields.managers import (
+    DECRYPT_LAZY,
+    DECRYPT_PASSTHROUGH,
+    PGPEncryptedManager,
+)
+
+
+PGPY_BACKEND = 'pgcrypto_fields.backends.PGPyBackend'
 
 
 class EncryptedModel(models.Model):
@@ -13,3 +20,134 @@ class EncryptedModel(models.Model):
     pgp_pub_null_boolean_field = fields.NullBooleanPGPPublicKeyField()
 
     objects = PGPEncryptedManager()
+    param_key_objects = PGPEncryptedManager(key_binding=KEY_BINDING_PARAM)
+    session_key_objects = PGPEncryptedManager(key_binding=KEY_BINDING_SESSION)
+    lazy_objects = PGPEncryptedManager(decrypt=DECRYPT_LAZY)
+    primary_objects = PGPEncryptedManager(route_decryption=False)
+    ciphertext_objects = PGPEncryptedManager(decrypt=DECRYPT_PASSTHROUGH)
+
+
+class SymmetricEncryptedModel(models.Model):
+    """Dummy model used for tests to check the symmetric key fields."""
+    email_pgp_sym_field = fields.EmailPGPSymmetricKeyField(blank=True, null=True)
+    integer_pgp_sym_field = fields.IntegerPGPSymmetricKeyField(blank=True, null=True)
+    pgp_sym_field = fields.TextPGPSymmetricKeyField(
+        blank=True,
+        null=True,
+        pgp_options={'cipher-algo': 'aes256', 'compress-algo': 1},
+    )
+    pgp_sym_date_field = fields.DatePGPSymmetricKeyField(blank=True, null=True)
+    pgp_sym_null_boolean_field = fields.NullBooleanPGPSymmetricKeyField()
+
+    objects = PGPEncryptedManager()
+    param_key_objects = PGPEncryptedManager(key_binding=KEY_BINDING_PARAM)
+    session_key_objects = PGPEncryptedManager(key_binding=KEY_BINDING_SESSION)
+    lazy_objects = PGPEncryptedManager(decrypt=DECRYPT_LAZY)
+
+
+class PGPyModel(models.Model):
+    """Dummy model used for tests to check fields decrypted by `PGPyBackend`."""
+    integer_pgp_pub_field = fields.IntegerPGPPublicKeyField(
+        blank=True,
+        null=True,
+        backend=PGPY_BACKEND,
+    )
+    pgp_pub_field = fields.TextPGPPublicKeyField(
+        blank=True,
+        null=True,
+        backend=PGPY_BACKEND,
+    )
+    pgp_sym_date_field = fields.DatePGPSymmetricKeyField(
+        blank=True,
+        null=True,
+        backend=PGPY_BACKEND,
+    )
+    email_pgp_pub_field = fields.EmailPGPPublicKeyField(blank=True, null=True)
+
+    objects = PGPEncryptedManager()
+
+
+class BlindIndexModel(models.Model):
+    """Dummy model used for tests to check blind index lookups."""
+    email_pgp_pub_field = fields.EmailPGPPublicKeyField(
+        blank=True,
+        null=True,
+        blind_index=True,
+    )
+    integer_pgp_pub_field = fields.IntegerPGPPublicKeyField(
+        blank=True,
+        null=True,
+        blind_index=True,
+    )
+
+    objects = PGPEncryptedManager()
+    lazy_objects = PGPEncryptedManager(decrypt=DECRYPT_LAZY)
+
+
+class RangeIndexModel(models.Model):
+    """Dummy model used for tests to check range index lookups."""
+    integer_pgp_pub_field = fields.IntegerPGPPublicKeyField(
+        blank=True,
+        null=True,
+        range_index=10,
+    )
+    pgp_pub_date_field = fields.DatePGPPublicKeyField(
+        blank=True,
+        null=True,
+        range_index=30,
+    )
+    pgp_sym_date_field = fields.DatePGPSymmetricKeyField(
+        blank=True,
+        null=True,
+        range_index=7,
+    )
+
+    objects = PGPEncryptedManager()
+
+
+class SearchIndexModel(models.Model):
+    """Dummy model used for tests to check search index lookups."""
+    email_pgp_pub_field = fields.EmailPGPPublicKeyField(
+        blank=True,
+        null=True,
+        search_index=True,
+    )
+    pgp_sym_field = fields.TextPGPSymmetricKeyField(
+        blank=True,
+        null=True,
+        search_index=4,
+    )
+
+    objects = PGPEncryptedManager()
+
+
+class RelatedModel(models.Model):
+    """Dummy model used for tests to check related PGP fields."""
+    encrypted = models.ForeignKey(
+        EncryptedModel,
+        blank=True,
+        null=True,
+        related_name='+',
+    )
+
+    objects = PGPEncryptedManager()
+    lazy_objects = PGPEncryptedManager(decrypt=DECRYPT_LAZY)
+
+
+class JSONModel(models.Model):
+    """Dummy model used for tests to check the JSON field."""
+    payload = fields.JSONPGPPublicKeyField(blank=True, null=True, key_index=['status'])
+
+    objects = PGPEncryptedManager()
+    lazy_objects = PGPEncryptedManager(decrypt=DECRYPT_LAZY)
+
+
+class DeterministicModel(models.Model):
+    """Dummy model used for tests to check deterministic fields."""
+    email_det_field = fields.EmailDeterministicField(blank=True, null=True)
+    backup_email_det_field = fields.EmailDeterministicField(blank=True, null=True)
+    integer_det_field = fields.IntegerDeterministicField(blank=True, null=True)
+    text_det_field = fields.TextDeterministicField(blank=True, null=True)
+    date_det_field = fields.DateDeterministicField(blank=True, null=True)
+
+    objects = PGPEncryptedManager()
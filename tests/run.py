@@ -20,6 +20,11 @@ settings.configure(
         'default': dj_database_url.config(
             default='postgres://localhost/pgcrypto_fields'
         ),
+        # Stands for a replica of `default` in the tests of the decryption router.
+        'replica': dj_database_url.config(
+            'REPLICA_DATABASE_URL',
+            default='postgres://localhost/pgcrypto_fields_replica'
+        ),
     },
     INSTALLED_APPS=(
         'pgcrypto_fields',
@@ -1,20 +1,72 @@
 import datetime
+import json
+import os
+import shutil
+import tempfile
 
+from django.conf import settings
+from django.core.exceptions import FieldError
+from django.core import serializers
+from django.core.management import call_command
+from django.core.serializers.base import SerializationError
+from django.core.signals import request_started
+from django.db import connection, connections
+from django.db.models import Count, F, Value
+from django.db.models.functions import Coalesce
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import six
+from django.utils.six import StringIO
 
-from pgcrypto_fields import aggregates, proxy
+from pgcrypto_fields import (
+    aggregates,
+    backends,
+    cache,
+    instrumentation,
+    KEY_BINDING_INLINE,
+    KEY_BINDING_PARAM,
+    KEY_BINDING_SESSION,
+    keys,
+    managers,
+    proxy,
+    sizes,
+    streaming,
+)
 from pgcrypto_fields import fields
+from pgcrypto_fields.indexes import recompute_indexes
+from pgcrypto_fields.models import KeyRotationCheckpoint
+from pgcrypto_fields.rotation import KeyRotation
 
 from .factories import EncryptedModelFactory
-from .models import EncryptedModel
+from .models import (
+    BlindIndexModel,
+    DeterministicModel,
+    EncryptedModel,
+    JSONModel,
+    PGPyModel,
+    RangeIndexModel,
+    RelatedModel,
+    SearchIndexModel,
+    SymmetricEncryptedModel,
+)
 
 
+KEYS_PATH = os.path.join(os.path.dirname(__file__), 'keys')
+PREVIOUS_PUBLIC_PGP_KEY = open(os.path.join(KEYS_PATH, 'previous_public.key')).read()
+PREVIOUS_PRIVATE_PGP_KEY = open(os.path.join(KEYS_PATH, 'previous_private.key')).read()
+
 EMAIL_PGP_FIELDS = (fields.EmailPGPPublicKeyField,)
 PGP_FIELDS = EMAIL_PGP_FIELDS + (
     fields.IntegerPGPPublicKeyField,
     fields.TextPGPPublicKeyField,
     fields.DatePGPPublicKeyField,
 )
+PGP_SYM_FIELDS = (
+    fields.EmailPGPSymmetricKeyField,
+    fields.IntegerPGPSymmetricKeyField,
+    fields.TextPGPSymmetricKeyField,
+    fields.DatePGPSymmetricKeyField,
+)
 
 
 class TestPGPMixin(TestCase):
@@ -34,6 +86,71 @@ class TestPGPMixin(TestCase):
         for field in PGP_FIELDS:
             self.assertEqual(field().db_type(), 'bytea')
 
+    def test_encrypt_sql(self):
+        """Assert `pgp_options` are passed to `pgp_pub_encrypt`."""
+        field = fields.TextPGPPublicKeyField(
+            pgp_options={'compress-algo': 2, 'compress-level': 9},
+        )
+        self.assertTrue(
+            field.encrypt_sql.endswith(", 'compress-algo=2, compress-level=9')"),
+        )
+        self.assertTrue(fields.TextPGPPublicKeyField().encrypt_sql.endswith("'))"))
+
+    def test_check_pgp_options(self):
+        """Assert options of symmetric keys only are reported."""
+        field = fields.TextPGPPublicKeyField(
+            name='field',
+            pgp_options={'compress-algo': 1, 's2k-mode': 1},
+        )
+        errors = field.check()
+        self.assertEqual([error.id for error in errors], ['pgcrypto_fields.E003'])
+
+
+class TestPGPSymmetricKeyFieldMixin(TestCase):
+    """Test `PGPSymmetricKeyFieldMixin` behave properly."""
+    def test_check(self):
+        """Assert symmetric key fields don't return any error."""
+        for field in PGP_SYM_FIELDS:
+            self.assertEqual(field(name='field').check(), [])
+
+    def test_check_key(self):
+        """Assert `PGCRYPTO_KEY` is required."""
+        with self.settings(PGCRYPTO_KEY=''):
+            errors = fields.TextPGPSymmetricKeyField(name='field').check()
+        self.assertEqual([error.id for error in errors], ['pgcrypto_fields.E002'])
+
+    def test_check_pgp_options(self):
+        """Assert unknown pgp options are reported."""
+        field = fields.TextPGPSymmetricKeyField(
+            name='field',
+            pgp_options={'cipher-algo': 'aes256', 'cipher': 'aes256'},
+        )
+        errors = field.check()
+        self.assertEqual([error.id for error in errors], ['pgcrypto_fields.E003'])
+
+    def test_db_type(self):
+        """Check db_type is `bytea`."""
+        for field in PGP_SYM_FIELDS:
+            self.assertEqual(field().db_type(), 'bytea')
+
+    def test_encrypt_sql(self):
+        """Assert `pgp_options` are passed to `pgp_sym_encrypt`."""
+        field = fields.TextPGPSymmetricKeyField(
+            pgp_options={'compress-algo': 0, 'cipher-algo': 'aes256'},
+        )
+        self.assertIn(
+            "'cipher-algo=aes256, compress-algo=0')",
+            field.encrypt_sql,
+        )
+        self.assertNotIn("', '", fields.TextPGPSymmetricKeyField().encrypt_sql)
+
+    def test_deconstruct(self):
+        """Assert `pgp_options` is kept in migrations."""
+        options = {'cipher-algo': 'aes256'}
+        field = fields.TextPGPSymmetricKeyField(pgp_options=options)
+        name, path, args, kwargs = field.deconstruct()
+        self.assertEqual(kwargs['pgp_options'], options)
+
 
 class TestEmailPGPMixin(TestCase):
     """Test emails fields behave properly."""
@@ -213,3 +330,2090 @@ class TestEncryptedTextFieldModel(TestCase):
         fields.remove('id')
         for field in fields:
             self.assertEqual(getattr(instance, field), None)
+
+
+class TestKeyBinding(TestCase):
+    """Test the private key can be sent as a query parameter."""
+    model = EncryptedModel
+
+    def test_dearmor(self):
+        """Assert the armored key is unwrapped to a PGP secret key packet."""
+        key = keys.dearmor(settings.PRIVATE_PGP_KEY)
+        self.assertEqual(key[:1], b'\x95')
+
+    def test_query(self):
+        """Assert the key is not written in the query."""
+        EncryptedModelFactory.create()
+        with CaptureQueriesContext(connection) as context:
+            self.model.param_key_objects.get()
+
+        self.assertIn('pgp_pub_decrypt', context.captured_queries[0]['sql'])
+        self.assertNotIn('dearmor', context.captured_queries[0]['sql'])
+
+    def test_bound_once(self):
+        """Assert the key is sent once for all the decrypted columns."""
+        queryset = self.model.param_key_objects.all()._with_decryption()
+        sql, params = queryset.query.sql_with_params()
+
+        self.assertEqual(sql.count('pgcrypto_keys.private_key'), 5)
+        self.assertEqual(params, (six.memoryview(keys.private_key()),))
+
+    def test_aggregate_bound_once(self):
+        """Assert the key is sent once by aggregates decrypting several columns."""
+        EncryptedModelFactory.create(integer_pgp_pub_field=2)
+        EncryptedModelFactory.create(integer_pgp_pub_field=3)
+
+        with CaptureQueriesContext(connection) as context:
+            result = self.model.param_key_objects.aggregate(
+                total=aggregates.DecryptedSum(
+                    'integer_pgp_pub_field',
+                    key_binding=KEY_BINDING_PARAM,
+                ),
+                highest=aggregates.DecryptedMax(
+                    'integer_pgp_pub_field',
+                    key_binding=KEY_BINDING_PARAM,
+                ),
+            )
+
+        self.assertEqual(result, {'total': 5, 'highest': 3})
+        sql = context.captured_queries[0]['sql']
+        self.assertEqual(sql.count('pgcrypto_keys.private_key'), 2)
+        self.assertEqual(sql.count('CROSS JOIN'), 1)
+
+    @override_settings(PGCRYPTO_KEY_BINDING=KEY_BINDING_PARAM)
+    def test_setting(self):
+        """Assert the `PGCRYPTO_KEY_BINDING` setting is read when querying."""
+        queryset = self.model.objects.all()._with_decryption()
+        sql, params = queryset.query.sql_with_params()
+
+        self.assertEqual(queryset.key_binding, KEY_BINDING_PARAM)
+        self.assertNotIn('dearmor', sql)
+        self.assertIn('dearmor', fields.TextPGPPublicKeyField().encrypt_sql)
+
+    def test_value(self):
+        """Assert we can get back the decrypted values."""
+        EncryptedModelFactory.create(pgp_pub_field='bonjour', integer_pgp_pub_field=42)
+
+        instance = self.model.param_key_objects.get()
+
+        self.assertEqual(instance.pgp_pub_field, 'bonjour')
+        self.assertEqual(instance.integer_pgp_pub_field, 42)
+
+
+class CountingKeyProvider(keys.SettingsKeyProvider):
+    """Key provider standing for a secret manager, counting the keys read."""
+    calls = 0
+
+    def get_key_set(self):
+        """Count the keys read."""
+        CountingKeyProvider.calls += 1
+        return super(CountingKeyProvider, self).get_key_set()
+
+
+@override_settings(PGCRYPTO_KEY_PROVIDER='tests.test_fields.CountingKeyProvider')
+class TestKeyProvider(TestCase):
+    """Test the keys are read from the key provider on first use."""
+    model = EncryptedModel
+
+    def setUp(self):
+        """Forget the keys read by the previous tests."""
+        keys.reset_keys('PGCRYPTO_KEY_PROVIDER')
+        CountingKeyProvider.calls = 0
+
+    def test_first_use(self):
+        """Assert the keys are read once, on first use."""
+        self.assertEqual(CountingKeyProvider.calls, 0)
+
+        key_set = keys.get_key_set()
+        keys.get_key_set()
+
+        self.assertEqual(CountingKeyProvider.calls, 1)
+        self.assertEqual(key_set.symmetric_key, 'ultrasecret')
+
+    def test_format_sql(self):
+        """Assert the SQL embedding the keys is formatted once per key set."""
+        template = "dearmor('{public_key}'){options}"
+        sql = keys.format_sql(template, options='')
+
+        self.assertIs(keys.format_sql(template, options=''), sql)
+        self.assertIn(settings.PUBLIC_PGP_KEY, sql)
+
+    def test_reload(self):
+        """Assert reloaded keys equal to the previous ones are kept with their SQL."""
+        key_set = keys.get_key_set()
+
+        keys.reload_keys()
+
+        self.assertIs(keys.get_key_set(), key_set)
+        self.assertEqual(CountingKeyProvider.calls, 2)
+
+    def test_ttl(self):
+        """Assert the keys are read again once their `ttl` has passed."""
+        with self.settings(PGCRYPTO_KEY_PROVIDER_OPTIONS={'ttl': 0}):
+            keys.get_key_set()
+            keys.get_key_set()
+        self.assertEqual(CountingKeyProvider.calls, 2)
+
+    def test_changed(self):
+        """Assert new keys are used once reloaded."""
+        with self.settings(PGCRYPTO_KEY='ultrasecret'):
+            keys.get_key_set()
+            settings.PGCRYPTO_KEY = 'other secret'
+            keys.reload_keys()
+            self.assertEqual(keys.get_key_set().symmetric_key, 'other secret')
+
+    def test_file_provider(self):
+        """Assert the keys can be read from files."""
+        provider = keys.FileKeyProvider(
+            public_key_path=os.path.join(KEYS_PATH, 'public.key'),
+            private_key_path=os.path.join(KEYS_PATH, 'private.key'),
+        )
+        key_set = provider.get_key_set()
+
+        self.assertEqual(key_set.public_key, settings.PUBLIC_PGP_KEY.strip())
+        self.assertEqual(key_set.symmetric_key, '')
+
+    def test_environment_provider(self):
+        """Assert the keys can be read from environment variables."""
+        os.environ['TEST_PREVIOUS_KEYS'] = PREVIOUS_PRIVATE_PGP_KEY * 2
+        self.addCleanup(os.environ.pop, 'TEST_PREVIOUS_KEYS')
+        provider = keys.EnvironmentKeyProvider(previous_private_keys='TEST_PREVIOUS_KEYS')
+
+        key_set = provider.get_key_set()
+
+        self.assertEqual(len(key_set.previous_private_keys), 2)
+        self.assertEqual(
+            list(key_set.previous_private_keys_by_id),
+            [keys.key_id(PREVIOUS_PRIVATE_PGP_KEY)],
+        )
+
+    def test_value(self):
+        """Assert values are encrypted and decrypted with the provided keys."""
+        EncryptedModelFactory.create(pgp_pub_field='bonjour')
+
+        self.assertEqual(self.model.objects.get().pgp_pub_field, 'bonjour')
+        self.assertEqual(CountingKeyProvider.calls, 1)
+
+
+class TestSessionKeyBinding(TestCase):
+    """Test the private key can be read from the database session."""
+    model = EncryptedModel
+
+    def setUp(self):
+        """Store the keys in the database session."""
+        keys.set_session_keys(connection)
+
+    def test_query(self):
+        """Assert the key is not written in the query."""
+        EncryptedModelFactory.create()
+        with CaptureQueriesContext(connection) as context:
+            self.model.session_key_objects.get()
+
+        sql = context.captured_queries[0]['sql']
+        self.assertNotIn('dearmor', sql)
+        self.assertIn('(SELECT pgcrypto_fields_priv_key())', sql)
+
+    def test_value(self):
+        """Assert we can get back the decrypted values."""
+        EncryptedModelFactory.create(pgp_pub_field='bonjour', integer_pgp_pub_field=42)
+
+        instance = self.model.session_key_objects.get()
+
+        self.assertEqual(instance.pgp_pub_field, 'bonjour')
+        self.assertEqual(instance.integer_pgp_pub_field, 42)
+
+
+@override_settings(PGCRYPTO_KEY_BINDING=KEY_BINDING_SESSION)
+class TestSessionKeySignals(TestCase):
+    """Test the keys are stored in the database sessions when they are opened.
+
+    The `replica` connection isn't wrapped in the transaction of the test case,
+    so it can be closed to open a new session.
+    """
+    def setUp(self):
+        """Close the session of the `replica` connection."""
+        connections['replica'].close()
+
+    def tearDown(self):
+        """Don't keep the keys in the session of the `replica` connection."""
+        connections['replica'].close()
+
+    def decrypt(self, value):
+        """Encrypt and decrypt `value` with the keys of the `replica` session."""
+        with connections['replica'].cursor() as cursor:
+            cursor.execute(
+                'SELECT pgp_pub_decrypt('
+                'pgp_pub_encrypt(%s, pgcrypto_fields_pub_key()), '
+                'pgcrypto_fields_priv_key())',
+                [value],
+            )
+            return cursor.fetchone()[0]
+
+    def test_connection_created(self):
+        """Assert a new session gets the keys."""
+        self.assertEqual(self.decrypt('bonjour'), 'bonjour')
+
+    def test_request_started(self):
+        """Assert open sessions get the keys again once they are reloaded."""
+        self.decrypt('bonjour')
+        keys.reload_keys()
+
+        request_started.send(sender=self.__class__)
+
+        self.assertIs(connections['replica'].pgcrypto_key_set, keys.get_key_set())
+        self.assertEqual(self.decrypt('au revoir'), 'au revoir')
+
+
+@override_settings(
+    DATABASE_ROUTERS=['pgcrypto_fields.routers.DecryptionRouter'],
+    PGCRYPTO_DECRYPTION_DATABASES=['replica'],
+)
+class TestDecryptionRouter(TestCase):
+    """Test the queries decrypting values are read from the decryption databases.
+
+    The `replica` database isn't replicated: rows are created in one database to
+    tell which one is read.
+    """
+    model = EncryptedModel
+    multi_db = True
+
+    def test_decrypting_query(self):
+        """Assert the queries decrypting values are read from the replica."""
+        self.model.objects.using('replica').create(pgp_pub_field='replica')
+
+        self.assertEqual(self.model.objects.get().pgp_pub_field, 'replica')
+        self.assertEqual(
+            list(self.model.objects.values_list('pgp_pub_field', flat=True)),
+            ['replica'],
+        )
+
+    def test_other_query(self):
+        """Assert the queries which don't decrypt values are left to other routers."""
+        EncryptedModelFactory.create()
+
+        self.assertEqual(self.model.objects.count(), 1)
+        self.assertEqual(len(self.model.objects.values_list('pk', flat=True)), 1)
+        self.assertEqual(len(self.model.objects.only('pk')), 1)
+
+    def test_aggregate(self):
+        """Assert decrypted aggregates are read from the replica."""
+        self.model.objects.using('replica').create(integer_pgp_pub_field=42)
+
+        result = self.model.objects.aggregate(
+            total=aggregates.DecryptedSum('integer_pgp_pub_field'),
+        )
+        self.assertEqual(result['total'], 42)
+        self.assertEqual(self.model.objects.aggregate(Count('pk'))['pk__count'], 0)
+
+    def test_decrypting_filter(self):
+        """Assert the querysets filtering on decrypted values read the replica."""
+        JSONModel.objects.using('replica').create(payload={'status': 'replica'})
+        queryset = JSONModel.lazy_objects.filter(payload__status='replica')
+
+        self.assertEqual(len(queryset), 1)
+        self.assertEqual(queryset.get().payload, {'status': 'replica'})
+
+    def test_decrypting_count(self):
+        """Assert `count()` and `exists()` on decrypted values read the replica."""
+        RangeIndexModel.objects.using('replica').create(integer_pgp_pub_field=42)
+        queryset = RangeIndexModel.objects.filter(integer_pgp_pub_field__gt=40)
+
+        self.assertEqual(queryset.count(), 1)
+        self.assertTrue(queryset.exists())
+        self.assertEqual(RangeIndexModel.objects.count(), 0)
+
+    def test_lazy_decryption(self):
+        """Assert values loaded lazily are decrypted by the replica."""
+        EncryptedModelFactory.create(pgp_pub_field='bonjour')
+
+        instance = self.model.lazy_objects.get()
+        with CaptureQueriesContext(connections['replica']) as context:
+            self.assertEqual(instance.pgp_pub_field, 'bonjour')
+        self.assertEqual(len(context), 1)
+
+    def test_write(self):
+        """Assert instances read from the replica are saved in the default database."""
+        self.model.objects.using('replica').create(pgp_pub_field='replica')
+
+        instance = self.model.objects.get()
+        instance.pgp_pub_field = 'default'
+        instance.save()
+
+        self.assertEqual(
+            self.model.objects.using('default').get().pgp_pub_field,
+            'default',
+        )
+        self.assertEqual(self.model.objects.get().pgp_pub_field, 'replica')
+
+    def test_route_decryption(self):
+        """Assert managers can keep the decrypting queries in the default database."""
+        EncryptedModelFactory.create(pgp_pub_field='default')
+
+        self.assertEqual(self.model.primary_objects.get().pgp_pub_field, 'default')
+
+    def test_session_keys(self):
+        """Assert the private key is only stored in the replica sessions."""
+        query = "SELECT current_setting('pgcrypto_fields.private_key', true)"
+        for alias in ('default', 'replica'):
+            keys.set_session_keys(connections[alias])
+
+        with connections['default'].cursor() as cursor:
+            cursor.execute(query)
+            self.assertFalse(cursor.fetchone()[0])
+        with connections['replica'].cursor() as cursor:
+            cursor.execute(query)
+            self.assertEqual(cursor.fetchone()[0], settings.PRIVATE_PGP_KEY)
+
+
+class TestLazyDecryption(TestCase):
+    """Test values can be decrypted on first access."""
+    model = EncryptedModel
+
+    def test_query(self):
+        """Assert values are not decrypted by the query."""
+        EncryptedModelFactory.create()
+        with CaptureQueriesContext(connection) as context:
+            self.model.lazy_objects.get()
+
+        self.assertNotIn('pgp_pub_decrypt', context.captured_queries[0]['sql'])
+
+    def test_value(self):
+        """Assert we can get back the decrypted values."""
+        expected = datetime.date.today()
+        EncryptedModelFactory.create(
+            pgp_pub_field='bonjour',
+            integer_pgp_pub_field=42,
+            pgp_pub_date_field=expected,
+        )
+
+        instance = self.model.lazy_objects.get()
+
+        self.assertEqual(instance.pgp_pub_field, 'bonjour')
+        self.assertEqual(instance.integer_pgp_pub_field, 42)
+        self.assertEqual(instance.pgp_pub_date_field, expected)
+
+    def test_value_query(self):
+        """Assert a field is decrypted for all instances in one query."""
+        EncryptedModelFactory.create_batch(3)
+        instances = list(self.model.lazy_objects.all())
+
+        with self.assertNumQueries(1):
+            values = [instance.pgp_pub_field for instance in instances]
+
+        for value in values:
+            self.assertTrue(value.startswith('Text with public key'))
+
+    def test_decrypt_loaded(self):
+        """Assert the named fields are decrypted before any access."""
+        EncryptedModelFactory.create_batch(3, integer_pgp_pub_field=42)
+        instances = list(self.model.lazy_objects.all())
+
+        with self.assertNumQueries(2):
+            decrypted = managers.decrypt_loaded(
+                instances,
+                'pgp_pub_field',
+                'integer_pgp_pub_field',
+            )
+
+        self.assertEqual(decrypted, 6)
+        with self.assertNumQueries(0):
+            for instance in instances:
+                self.assertEqual(instance.integer_pgp_pub_field, 42)
+                self.assertTrue(instance.pgp_pub_field.startswith('Text with'))
+
+    def test_iterator_eager(self):
+        """Assert instances decrypted by the query are not kept by `iterator`."""
+        EncryptedModelFactory.create_batch(2)
+        instances = list(self.model.objects.iterator())
+
+        for instance in instances:
+            self.assertFalse(hasattr(instance, '_lazy_decryption'))
+            self.assertTrue(instance.pgp_pub_field.startswith('Text with'))
+
+    def test_iterator_lazy(self):
+        """Assert instances with ciphertexts are decrypted together."""
+        EncryptedModelFactory.create_batch(2)
+        instances = list(self.model.lazy_objects.iterator())
+
+        self.assertIs(instances[0]._lazy_decryption, instances[1]._lazy_decryption)
+
+    def test_decrypt_loaded_eager(self):
+        """Assert instances decrypted by the query are left as they are."""
+        EncryptedModelFactory.create()
+        instances = list(self.model.objects.all())
+
+        with self.assertNumQueries(0):
+            self.assertEqual(managers.decrypt_loaded(instances), 0)
+
+    def test_null(self):
+        """Assert `NULL` values are not decrypted."""
+        EncryptedModelFactory.create(pgp_pub_field=None)
+        instance = self.model.lazy_objects.get()
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(instance.pgp_pub_field)
+
+    def test_save_not_decrypted(self):
+        """Assert values not accessed are saved as they are."""
+        expected = 'bonjour'
+        EncryptedModelFactory.create(pgp_pub_field=expected)
+
+        instance = self.model.lazy_objects.get()
+        instance.integer_pgp_pub_field = 1
+        instance.save()
+
+        updated_instance = self.model.objects.get()
+        self.assertEqual(updated_instance.pgp_pub_field, expected)
+        self.assertEqual(updated_instance.integer_pgp_pub_field, 1)
+
+
+class TestUnchangedValues(TestCase):
+    """Test values unchanged since they were loaded are not encrypted again."""
+    model = EncryptedModel
+
+    def get_ciphertext(self, instance):
+        """Return the stored ciphertext of `pgp_pub_field`."""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pgp_pub_field FROM tests_encryptedmodel WHERE id = %s',
+                [instance.pk],
+            )
+            return bytes(cursor.fetchone()[0])
+
+    def assertEncrypted(self, context, count):
+        """Assert the `UPDATE` of `context` encrypts `count` values."""
+        update = [
+            query['sql'] for query in context.captured_queries
+            if query['sql'].startswith('UPDATE')
+        ][0]
+        self.assertEqual(update.count('pgp_pub_encrypt('), count)
+
+    def test_save_unchanged(self):
+        """Assert the ciphertexts are kept when nothing changed."""
+        instance = EncryptedModelFactory.create()
+        ciphertext = self.get_ciphertext(instance)
+
+        instance = self.model.objects.get()
+        with CaptureQueriesContext(connection) as context:
+            instance.save()
+
+        self.assertEncrypted(context, 0)
+        self.assertEqual(self.get_ciphertext(instance), ciphertext)
+
+    def test_save_changed(self):
+        """Assert only the changed values are encrypted."""
+        EncryptedModelFactory.create(integer_pgp_pub_field=1)
+
+        instance = self.model.objects.get()
+        instance.integer_pgp_pub_field = 2
+        with CaptureQueriesContext(connection) as context:
+            instance.save()
+
+        self.assertEncrypted(context, 1)
+        self.assertEqual(self.model.objects.get().integer_pgp_pub_field, 2)
+
+    def test_save_assigned_back(self):
+        """Assert a value assigned again is encrypted again."""
+        EncryptedModelFactory.create(pgp_pub_field='bonjour')
+
+        instance = self.model.objects.get()
+        instance.pgp_pub_field = 'hello'
+        instance.pgp_pub_field = 'bonjour'
+        with CaptureQueriesContext(connection) as context:
+            instance.save()
+
+        self.assertEncrypted(context, 1)
+
+    def test_save_lazy(self):
+        """Assert values decrypted on access are not encrypted again."""
+        instance = EncryptedModelFactory.create()
+        ciphertext = self.get_ciphertext(instance)
+
+        instance = self.model.lazy_objects.get()
+        instance.pgp_pub_field
+        with CaptureQueriesContext(connection) as context:
+            instance.save()
+
+        self.assertEncrypted(context, 0)
+        self.assertEqual(self.get_ciphertext(instance), ciphertext)
+
+    def test_save_index_unchanged(self):
+        """Assert the indexes of values not accessed are kept without decrypting."""
+        BlindIndexModel.objects.create(email_pgp_pub_field='a@b.com')
+
+        instance = BlindIndexModel.lazy_objects.get()
+        with CaptureQueriesContext(connection) as context:
+            instance.save()
+
+        self.assertEqual(len(context.captured_queries), 1)
+        self.assertNotIn('pgp_pub_decrypt', context.captured_queries[0]['sql'])
+        self.assertNotIn('hmac(', context.captured_queries[0]['sql'])
+        self.assertEqual(
+            BlindIndexModel.objects.get(email_pgp_pub_field='a@b.com').pk,
+            instance.pk,
+        )
+
+    def test_save_index_missing(self):
+        """Assert an index added to existing rows is filled when they are saved."""
+        BlindIndexModel.objects.create(email_pgp_pub_field='a@b.com')
+        BlindIndexModel.objects.update(email_pgp_pub_field_blind_index=None)
+
+        BlindIndexModel.lazy_objects.get().save()
+
+        self.assertTrue(
+            BlindIndexModel.objects.filter(email_pgp_pub_field='a@b.com').exists(),
+        )
+
+    def test_recompute_indexes(self):
+        """Assert the indexes of unchanged values are computed again on demand."""
+        BlindIndexModel.objects.create(email_pgp_pub_field='a@b.com')
+
+        instance = BlindIndexModel.lazy_objects.get()
+        with self.settings(PGCRYPTO_KEY='othersecret'):
+            with recompute_indexes():
+                instance.save()
+            self.assertTrue(
+                BlindIndexModel.objects.filter(email_pgp_pub_field='a@b.com').exists(),
+            )
+
+    def test_save_copy(self):
+        """Assert the values of a copy saved as a new row are encrypted."""
+        EncryptedModelFactory.create(pgp_pub_field='bonjour')
+
+        instance = self.model.objects.get()
+        instance.pk = None
+        instance.save()
+
+        self.assertEqual(self.model.objects.count(), 2)
+        self.assertEqual(self.model.objects.get(pk=instance.pk).pgp_pub_field, 'bonjour')
+
+    def test_save_changed_in_place(self):
+        """Assert a JSON object changed in place is encrypted again."""
+        JSONModel.objects.create(payload={'status': 'draft'})
+
+        instance = JSONModel.objects.get()
+        instance.payload['status'] = 'published'
+        instance.save()
+
+        self.assertEqual(JSONModel.objects.get().payload, {'status': 'published'})
+
+
+@override_settings(PGCRYPTO_CACHE={'max_entries': 2, 'timeout': 60})
+class TestDecryptionCache(TestCase):
+    """Test values decrypted lazily are kept in the decryption cache."""
+    model = EncryptedModel
+
+    def setUp(self):
+        """Start with an empty cache."""
+        cache.get_cache().clear()
+
+    def test_hit(self):
+        """Assert a value read again is not decrypted again."""
+        EncryptedModelFactory.create(pgp_pub_field='bonjour')
+        self.assertEqual(self.model.lazy_objects.get().pgp_pub_field, 'bonjour')
+
+        instance = self.model.lazy_objects.get()
+        with self.assertNumQueries(0):
+            self.assertEqual(instance.pgp_pub_field, 'bonjour')
+        self.assertEqual(cache.get_cache().stats()['hits'], 1)
+
+    def test_changed(self):
+        """Assert a new ciphertext is decrypted."""
+        instance = EncryptedModelFactory.create(pgp_pub_field='bonjour')
+        self.assertEqual(self.model.lazy_objects.get().pgp_pub_field, 'bonjour')
+
+        instance.pgp_pub_field = 'hello'
+        instance.save()
+        self.assertEqual(self.model.lazy_objects.get().pgp_pub_field, 'hello')
+        self.assertEqual(cache.get_cache().stats()['misses'], 2)
+
+    def test_eviction(self):
+        """Assert the least recently used values are evicted."""
+        decrypted = []
+        field = self.model._meta.get_field('pgp_pub_field')
+
+        def decrypt(values):
+            decrypted.extend(values)
+            return [bytes(value).upper() for value in values]
+
+        lru = cache.get_cache()
+        self.assertEqual(lru.decrypt(field, [b'a', b'b', b'a', None], decrypt), [
+            b'A',
+            b'B',
+            b'A',
+            None,
+        ])
+        lru.decrypt(field, [b'a', b'c'], decrypt)
+        lru.decrypt(field, [b'b'], decrypt)
+
+        self.assertEqual(decrypted, [b'a', b'b', b'c', b'b'])
+        self.assertEqual(lru.stats(), {
+            'entries': 2,
+            'hits': 1,
+            'misses': 4,
+            'evictions': 2,
+        })
+
+    def test_timeout(self):
+        """Assert values expire after `timeout` seconds."""
+        field = self.model._meta.get_field('pgp_pub_field')
+        lru = cache.DecryptionCache(timeout=0)
+        lru.decrypt(field, [b'a'], lambda values: values)
+
+        self.assertEqual(lru.get(lru.get_key(field, b'a')), (False, None))
+
+
+class TestInstrumentation(TestCase):
+    """Test statements calling pgcrypto and decryptions on access are collected."""
+    model = EncryptedModel
+
+    def test_decrypted(self):
+        """Assert decrypted columns and rows of a query are collected."""
+        EncryptedModelFactory.create_batch(2)
+        with instrumentation.QueryStats() as query_stats:
+            list(self.model.objects.decrypt('pgp_pub_field', 'integer_pgp_pub_field'))
+
+        stats = query_stats.stats()
+        self.assertEqual(stats['queries'], 1)
+        self.assertEqual(stats['decrypted'], 2)
+        self.assertEqual(stats['encrypted'], 0)
+        self.assertEqual(stats['rows'], 2)
+        self.assertGreater(stats['size'], 0)
+
+    def test_encrypted(self):
+        """Assert encrypted values of an insert are collected."""
+        with instrumentation.QueryStats() as query_stats:
+            self.model.objects.create(pgp_pub_field='bonjour')
+
+        self.assertEqual(query_stats.stats()['encrypted'], 5)
+
+    def test_other_statements(self):
+        """Assert statements which don't call pgcrypto are ignored."""
+        with instrumentation.QueryStats() as query_stats:
+            self.model.objects.count()
+
+        self.assertEqual(query_stats.queries, [])
+
+    def test_metrics(self):
+        """Assert `Metrics` subclasses only export the signals they handle."""
+        accesses = []
+
+        class AccessMetrics(instrumentation.Metrics):
+            def add_access(self, sender, field, values, using, **kwargs):
+                """Collect the number of values decrypted on access."""
+                accesses.append(values)
+
+        EncryptedModelFactory.create()
+        metrics = AccessMetrics()
+        metrics.connect()
+        try:
+            with instrumentation.QueryStats():
+                self.model.lazy_objects.get().pgp_pub_field
+        finally:
+            metrics.disconnect()
+
+        self.assertEqual(accesses, [1])
+
+    def test_n_plus_one(self):
+        """Assert fields decrypted on access one instance at a time are flagged."""
+        pks = [instance.pk for instance in EncryptedModelFactory.create_batch(3)]
+        with instrumentation.QueryStats() as query_stats:
+            for pk in pks:
+                self.model.lazy_objects.get(pk=pk).pgp_pub_field
+
+        self.assertEqual(query_stats.stats()['decrypted_on_access'], 3)
+        self.assertEqual(query_stats.n_plus_one, ['tests.EncryptedModel.pgp_pub_field'])
+
+    def test_batch_access(self):
+        """Assert fields decrypted on access with their queryset are not flagged."""
+        EncryptedModelFactory.create_batch(3)
+        with instrumentation.QueryStats() as query_stats:
+            for instance in self.model.lazy_objects.all():
+                instance.pgp_pub_field
+
+        self.assertEqual(query_stats.stats()['decrypted_on_access'], 1)
+        self.assertEqual(query_stats.n_plus_one, [])
+
+
+class TestDecryptFields(TestCase):
+    """Test the PGP fields decrypted by a queryset can be selected."""
+    model = EncryptedModel
+
+    def setUp(self):
+        """Create an instance with encrypted values."""
+        EncryptedModelFactory.create(
+            email_pgp_pub_field='a@b.com',
+            integer_pgp_pub_field=42,
+            pgp_pub_field='bonjour',
+        )
+
+    def assertDecrypted(self, queryset, expected):
+        """Assert the fields decrypted when evaluating `queryset`."""
+        with CaptureQueriesContext(connection) as context:
+            list(queryset)
+        sql = context.captured_queries[0]['sql']
+        decrypted = [
+            field.name for field in self.model._meta.concrete_fields
+            if 'pgp_pub_decrypt("tests_encryptedmodel"."{}"'.format(field.column) in sql
+        ]
+        self.assertItemsEqual(decrypted, expected)
+
+    def test_decrypt(self):
+        """Assert only the fields passed to `decrypt` are decrypted."""
+        queryset = self.model.objects.decrypt('pgp_pub_field')
+        self.assertDecrypted(queryset, ['pgp_pub_field'])
+
+        instance = queryset.get()
+        self.assertEqual(instance.pgp_pub_field, 'bonjour')
+
+    def test_decrypt_not_pgp_field(self):
+        """Assert only PGP fields can be decrypted."""
+        with self.assertRaises(FieldError):
+            self.model.objects.decrypt('id')
+
+    def test_not_decrypted_value(self):
+        """Assert fields not decrypted are still loaded on access."""
+        instance = self.model.objects.decrypt('pgp_pub_field').get()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(instance.email_pgp_pub_field, 'a@b.com')
+
+    def test_only(self):
+        """Assert fields not loaded with `only` are not decrypted."""
+        queryset = self.model.objects.only('id', 'integer_pgp_pub_field')
+        self.assertDecrypted(queryset, ['integer_pgp_pub_field'])
+        self.assertEqual(queryset.get().integer_pgp_pub_field, 42)
+
+    def test_only_decrypt(self):
+        """Assert `only_decrypt` loads and decrypts the given fields."""
+        queryset = self.model.objects.only_decrypt('id', 'pgp_pub_field')
+        self.assertDecrypted(queryset, ['pgp_pub_field'])
+
+    def test_defer(self):
+        """Assert deferred fields are not decrypted."""
+        queryset = self.model.objects.defer('pgp_pub_field', 'pgp_pub_date_field')
+        self.assertDecrypted(queryset, [
+            'email_pgp_pub_field',
+            'integer_pgp_pub_field',
+            'pgp_pub_null_boolean_field',
+        ])
+
+    def test_values(self):
+        """Assert `values` returns decrypted values."""
+        queryset = self.model.objects.values('pgp_pub_field', 'integer_pgp_pub_field')
+        self.assertEqual(queryset.get(), {
+            'pgp_pub_field': 'bonjour',
+            'integer_pgp_pub_field': 42,
+        })
+
+    def test_values_all(self):
+        """Assert `values` without fields returns decrypted values."""
+        values = self.model.objects.decrypt('pgp_pub_field').values().get()
+        self.assertEqual(values['pgp_pub_field'], 'bonjour')
+        self.assertNotEqual(values['email_pgp_pub_field'], 'a@b.com')
+
+    def test_values_all_annotations(self):
+        """Assert `values` without fields keeps the annotations and extra columns."""
+        queryset = self.model.objects.annotate(n=Count('id')).extra(
+            select={'answer': '42'},
+        )
+        values = queryset.values().get()
+        self.assertEqual(values['n'], 1)
+        self.assertEqual(values['answer'], 42)
+        self.assertEqual(values['pgp_pub_field'], 'bonjour')
+
+        row = queryset.values_list().get()
+        self.assertEqual(row[0], 42)
+        self.assertEqual(row[-1], 1)
+
+    def test_values_list(self):
+        """Assert `values_list` returns decrypted values."""
+        queryset = self.model.objects.values_list('email_pgp_pub_field', flat=True)
+        self.assertEqual(list(queryset), ['a@b.com'])
+
+    def test_lazy_decrypt(self):
+        """Assert `decrypt` decrypts fields in the query in lazy mode."""
+        queryset = self.model.lazy_objects.decrypt('pgp_pub_field')
+        self.assertDecrypted(queryset, ['pgp_pub_field'])
+
+        instance = queryset.get()
+        with self.assertNumQueries(1):
+            self.assertEqual(instance.email_pgp_pub_field, 'a@b.com')
+
+
+class TestBlindIndex(TestCase):
+    """Test `blind_index` lookups on PGP fields."""
+    model = BlindIndexModel
+
+    def test_fields(self):
+        """Assert a blind index field is added for each indexed field."""
+        fields = self.model._meta.get_all_field_names()
+        expected = (
+            'id',
+            'email_pgp_pub_field',
+            'email_pgp_pub_field_blind_index',
+            'integer_pgp_pub_field',
+            'integer_pgp_pub_field_blind_index',
+        )
+        self.assertItemsEqual(fields, expected)
+
+    def test_deconstruct(self):
+        """Assert `blind_index` is kept in migrations."""
+        field = self.model._meta.get_field('email_pgp_pub_field')
+        self.assertTrue(field.deconstruct()[3]['blind_index'])
+
+        index = self.model._meta.get_field('email_pgp_pub_field_blind_index')
+        self.assertEqual(index.deconstruct()[3]['source'], 'email_pgp_pub_field')
+
+    def test_exact_query(self):
+        """Assert `exact` lookup compares the blind index column."""
+        queryset = self.model.objects.filter(email_pgp_pub_field='a@b.com')
+        where = str(queryset.query).split('WHERE')[1]
+        self.assertIn('"email_pgp_pub_field_blind_index" = hmac(', where)
+
+    def test_expression_query(self):
+        """Assert values compared to other expressions than the column aren't hashed."""
+        queryset = self.model.objects.annotate(
+            email=Coalesce('email_pgp_pub_field', 'email_pgp_pub_field'),
+        )
+
+        for where in (
+            str(queryset.filter(email='a@b.com').query).split('WHERE')[1],
+            str(queryset.filter(email__in=['a@b.com']).query).split('WHERE')[1],
+        ):
+            self.assertNotIn('blind_index', where)
+            self.assertNotIn('hmac(', where)
+
+    def test_exact(self):
+        """Assert we can filter on the encrypted value."""
+        self.model.objects.create(email_pgp_pub_field='other@b.com')
+        created = self.model.objects.create(email_pgp_pub_field='a@b.com')
+
+        instance = self.model.objects.get(email_pgp_pub_field='a@b.com')
+
+        self.assertEqual(instance.pk, created.pk)
+        self.assertEqual(instance.email_pgp_pub_field, 'a@b.com')
+
+    @override_settings(PGCRYPTO_KEY="it's 100%s")
+    def test_exact_quoted_key(self):
+        """Assert values are hashed with a key holding quotes and `%`."""
+        created = self.model.objects.create(email_pgp_pub_field='a@b.com')
+        self.model.objects.bulk_create_encrypted([
+            self.model(email_pgp_pub_field='c@d.com'),
+        ])
+
+        instance = self.model.objects.get(email_pgp_pub_field='a@b.com')
+        self.assertEqual(instance.pk, created.pk)
+        self.assertEqual(
+            self.model.objects.filter(email_pgp_pub_field__in=['c@d.com']).count(),
+            1,
+        )
+
+    def test_exact_integer(self):
+        """Assert non text values are hashed consistently."""
+        created = self.model.objects.create(integer_pgp_pub_field=42)
+        self.model.objects.create(integer_pgp_pub_field=-42)
+
+        instance = self.model.objects.get(integer_pgp_pub_field=42)
+
+        self.assertEqual(instance.pk, created.pk)
+
+    def test_in(self):
+        """Assert `in` lookup uses the blind index."""
+        first = self.model.objects.create(email_pgp_pub_field='a@b.com')
+        second = self.model.objects.create(email_pgp_pub_field='c@d.com')
+        self.model.objects.create(email_pgp_pub_field='e@f.com')
+
+        queryset = self.model.objects.filter(
+            email_pgp_pub_field__in=['a@b.com', 'c@d.com'],
+        )
+
+        pks = queryset.values_list('pk', flat=True)
+        self.assertItemsEqual(pks, [first.pk, second.pk])
+
+    def test_update(self):
+        """Assert the blind index follows updates of the value."""
+        instance = self.model.objects.create(email_pgp_pub_field='a@b.com')
+        instance.email_pgp_pub_field = 'c@d.com'
+        instance.save()
+
+        queryset = self.model.objects.all()
+        self.assertFalse(queryset.filter(email_pgp_pub_field='a@b.com').exists())
+        self.assertTrue(queryset.filter(email_pgp_pub_field='c@d.com').exists())
+
+    def test_null(self):
+        """Assert `NULL` values do not match any value."""
+        self.model.objects.create()
+        self.assertFalse(self.model.objects.filter(email_pgp_pub_field='').exists())
+        self.assertTrue(self.model.objects.filter(email_pgp_pub_field=None).exists())
+
+
+class TestRangeIndex(TestCase):
+    """Test `range_index` lookups on PGP fields."""
+    model = RangeIndexModel
+
+    def setUp(self):
+        """Create rows with values in several buckets."""
+        for i in range(5):
+            self.model.objects.create(
+                integer_pgp_pub_field=i * 7,
+                pgp_pub_date_field=datetime.date(2000, 1, 1) + datetime.timedelta(i * 20),
+                pgp_sym_date_field=datetime.date(2000, 1, 1) + datetime.timedelta(i),
+            )
+        self.model.objects.create()
+
+    def get_values(self, **lookups):
+        """Return the integer values of the rows matching `lookups`."""
+        return list(
+            self.model.objects.filter(**lookups)
+            .order_by('integer_pgp_pub_field_range_index', 'pk')
+            .values_list('integer_pgp_pub_field', flat=True)
+        )
+
+    def test_fields(self):
+        """Assert a range index field is added for each indexed field."""
+        index = self.model._meta.get_field('pgp_pub_date_field_range_index')
+        self.assertEqual(index.deconstruct()[3]['source'], 'pgp_pub_date_field')
+        self.assertEqual(index.deconstruct()[3]['bucket_size'], 30)
+
+        field = self.model._meta.get_field('integer_pgp_pub_field')
+        self.assertEqual(field.deconstruct()[3]['range_index'], 10)
+
+    def test_query(self):
+        """Assert lookups compare the range index before the decrypted value."""
+        queryset = self.model.objects.filter(integer_pgp_pub_field__gt=10)
+        where = str(queryset.query).split('WHERE')[1]
+        self.assertIn('"integer_pgp_pub_field_range_index" >= ', where)
+        self.assertIn(
+            'pgp_pub_decrypt("tests_rangeindexmodel"."integer_pgp_pub_field"',
+            where,
+        )
+
+    def test_key_binding(self):
+        """Assert values are decrypted with the key binding of the queryset."""
+        queryset = self.model.objects.all()
+        queryset.key_binding = KEY_BINDING_PARAM
+        queryset = queryset.filter(integer_pgp_pub_field__gt=10)
+
+        sql, params = queryset.query.sql_with_params()
+        self.assertNotIn('dearmor', sql)
+        self.assertIn(six.memoryview(keys.private_key()), params)
+        self.assertEqual(queryset.count(), 3)
+
+    def test_order(self):
+        """Assert buckets keep the order of the values."""
+        buckets = list(
+            self.model.objects.exclude(integer_pgp_pub_field=None)
+            .order_by('pk')
+            .values_list('integer_pgp_pub_field_range_index', flat=True)
+        )
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertEqual(len(set(buckets)), 3)
+
+    def test_integer(self):
+        """Assert integer comparisons only match the exact values."""
+        self.assertEqual(self.get_values(integer_pgp_pub_field__gt=14), [21, 28])
+        self.assertEqual(self.get_values(integer_pgp_pub_field__gte=14), [14, 21, 28])
+        self.assertEqual(self.get_values(integer_pgp_pub_field__lt=7), [0])
+        self.assertEqual(self.get_values(integer_pgp_pub_field__lte=7), [0, 7])
+        self.assertEqual(self.get_values(integer_pgp_pub_field=21), [21])
+        self.assertEqual(self.get_values(integer_pgp_pub_field__range=(5, 15)), [7, 14])
+
+    def test_date(self):
+        """Assert date comparisons only match the exact values."""
+        self.assertEqual(
+            self.get_values(pgp_pub_date_field__gte=datetime.date(2000, 2, 10)),
+            [14, 21, 28],
+        )
+        self.assertEqual(
+            self.get_values(pgp_sym_date_field__range=(
+                datetime.date(2000, 1, 2),
+                datetime.date(2000, 1, 3),
+            )),
+            [7, 14],
+        )
+
+    def test_update(self):
+        """Assert the range index follows updates of the value."""
+        instance = self.model.objects.get(integer_pgp_pub_field=0)
+        instance.integer_pgp_pub_field = 100
+        instance.save()
+
+        self.assertEqual(self.get_values(integer_pgp_pub_field__gt=50), [100])
+
+
+class TestSearchIndex(TestCase):
+    """Test `search_index` lookups on PGP fields."""
+    model = SearchIndexModel
+
+    def setUp(self):
+        """Create rows with several prefixes and domains."""
+        for email in ('john@example.com', 'Joan@Example.org', 'jane@example.com'):
+            self.model.objects.create(email_pgp_pub_field=email, pgp_sym_field=email)
+        self.model.objects.create()
+
+    def get_values(self, **lookups):
+        """Return the emails of the rows matching `lookups`."""
+        return sorted(
+            self.model.objects.filter(**lookups)
+            .values_list('email_pgp_pub_field', flat=True)
+        )
+
+    def test_query(self):
+        """Assert lookups look for the tokens before comparing the decrypted value."""
+        queryset = self.model.objects.filter(email_pgp_pub_field__startswith='jo')
+        where = str(queryset.query).split('WHERE')[1]
+        self.assertIn('"email_pgp_pub_field_search_index" @> ', where)
+        self.assertIn('LIKE jo%', where)
+
+    def test_startswith(self):
+        """Assert `startswith` only matches the exact prefix."""
+        self.assertEqual(
+            self.get_values(email_pgp_pub_field__startswith='jo'),
+            ['john@example.com'],
+        )
+        self.assertEqual(
+            self.get_values(pgp_sym_field__startswith='jane@'),
+            ['jane@example.com'],
+        )
+
+    def test_istartswith(self):
+        """Assert `istartswith` ignores the case."""
+        self.assertEqual(
+            self.get_values(email_pgp_pub_field__istartswith='JO'),
+            ['Joan@Example.org', 'john@example.com'],
+        )
+
+    def test_email_domain(self):
+        """Assert `email_domain` matches the addresses at the domain."""
+        self.assertEqual(
+            self.get_values(email_pgp_pub_field__email_domain='example.ORG'),
+            ['Joan@Example.org'],
+        )
+        self.assertEqual(
+            self.get_values(email_pgp_pub_field__email_domain='example.com'),
+            ['jane@example.com', 'john@example.com'],
+        )
+
+    def test_tokens(self):
+        """Assert prefixes are indexed up to the configured length."""
+        instance = self.model.objects.get(email_pgp_pub_field__startswith='jane')
+        self.assertEqual(len(instance.pgp_sym_field_search_index), 4)
+        self.assertEqual(len(instance.email_pgp_pub_field_search_index), 11)
+
+    def test_update(self):
+        """Assert the tokens follow updates of the value."""
+        instance = self.model.objects.get(email_pgp_pub_field__startswith='jane')
+        instance.email_pgp_pub_field = 'bob@example.net'
+        instance.save()
+
+        self.assertEqual(self.get_values(email_pgp_pub_field__startswith='ja'), [])
+        self.assertEqual(
+            self.get_values(email_pgp_pub_field__email_domain='example.net'),
+            ['bob@example.net'],
+        )
+
+
+class TestDeterministicField(TestCase):
+    """Test deterministic fields compare and group their ciphertexts."""
+    model = DeterministicModel
+
+    def test_check(self):
+        """Assert deterministic fields are encrypted by postgres only."""
+        self.assertEqual(fields.TextDeterministicField(name='field').check(), [])
+
+        field = fields.TextDeterministicField(
+            name='field',
+            backend='pgcrypto_fields.backends.PGPyBackend',
+        )
+        self.assertIn('pgcrypto_fields.E009', [error.id for error in field.check()])
+
+    def test_check_pgp_options(self):
+        """Assert deterministic fields don't accept pgp options."""
+        field = fields.TextDeterministicField(
+            name='field',
+            pgp_options={'cipher-algo': 'aes256'},
+        )
+        errors = field.check()
+        self.assertEqual([error.id for error in errors], ['pgcrypto_fields.E003'])
+
+    def test_same_ciphertext(self):
+        """Assert equal values are encrypted to the same ciphertext."""
+        first = self.model.objects.create(text_det_field='value')
+        second = self.model.objects.create(text_det_field='value')
+        self.model.objects.create(text_det_field='other')
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT id, text_det_field FROM tests_deterministicmodel')
+            ciphertexts = {pk: bytes(value) for pk, value in cursor.fetchall()}
+        self.assertEqual(ciphertexts[first.pk], ciphertexts[second.pk])
+        self.assertEqual(len(set(ciphertexts.values())), 2)
+
+    def test_exact_query(self):
+        """Assert `exact` lookup compares the encrypted value to the column."""
+        queryset = self.model.objects.filter(text_det_field='value')
+        where = str(queryset.query).split('WHERE')[1]
+        self.assertIn('"text_det_field" = pgcrypto_fields_det_encrypt(', where)
+        self.assertNotIn('pgcrypto_fields_det_decrypt', where)
+
+    def test_exact(self):
+        """Assert we can filter on the encrypted value of each field."""
+        values = {
+            'email_det_field': 'a@b.com',
+            'integer_det_field': 42,
+            'text_det_field': 'value',
+            'date_det_field': datetime.date(2016, 1, 1),
+        }
+        created = self.model.objects.create(**values)
+        self.model.objects.create(
+            email_det_field='c@d.com',
+            integer_det_field=-42,
+            text_det_field='other',
+            date_det_field=datetime.date(2016, 1, 2),
+        )
+
+        for name, value in values.items():
+            instance = self.model.objects.get(**{name: value})
+            self.assertEqual(instance.pk, created.pk)
+            self.assertEqual(getattr(instance, name), value)
+
+    def test_in(self):
+        """Assert `in` lookup encrypts each value."""
+        first = self.model.objects.create(integer_det_field=1)
+        second = self.model.objects.create(integer_det_field=2)
+        self.model.objects.create(integer_det_field=3)
+
+        queryset = self.model.objects.filter(integer_det_field__in=[1, 2])
+
+        pks = queryset.values_list('pk', flat=True)
+        self.assertItemsEqual(pks, [first.pk, second.pk])
+
+    def test_join(self):
+        """Assert columns are compared without decrypting them."""
+        same = self.model.objects.create(
+            email_det_field='a@b.com',
+            backup_email_det_field='a@b.com',
+        )
+        self.model.objects.create(
+            email_det_field='a@b.com',
+            backup_email_det_field='c@d.com',
+        )
+
+        queryset = self.model.objects.filter(
+            email_det_field=F('backup_email_det_field'),
+        )
+
+        self.assertNotIn(
+            'pgcrypto_fields_det_decrypt',
+            str(queryset.only('pk').query).split('WHERE')[1],
+        )
+        self.assertEqual(list(queryset.values_list('pk', flat=True)), [same.pk])
+
+    def test_group_by(self):
+        """Assert values are counted and distinct without decrypting them."""
+        for value in ('a', 'a', 'b'):
+            self.model.objects.create(text_det_field=value)
+
+        # Only decrypting another field keeps the ciphertexts in `values()`.
+        queryset = self.model.objects.decrypt('email_det_field').values(
+            'text_det_field',
+        )
+        counts = queryset.annotate(count=Count('pk')).order_by('count')
+        self.assertEqual([row['count'] for row in counts], [1, 2])
+        self.assertEqual(queryset.distinct().count(), 2)
+
+    def test_decrypt(self):
+        """Assert the values are decrypted with the decrypt aggregate."""
+        self.model.objects.create(text_det_field='value')
+
+        queryset = self.model.objects.decrypt('email_det_field').annotate(
+            decrypted=aggregates.DeterministicDecrypt('text_det_field'),
+        )
+
+        self.assertEqual(queryset.get().decrypted, 'value')
+
+    def test_null(self):
+        """Assert `NULL` values are kept `NULL`."""
+        self.model.objects.create()
+        self.assertTrue(self.model.objects.filter(text_det_field=None).exists())
+        self.assertIsNone(self.model.objects.get().text_det_field)
+
+
+class TestJSONField(TestCase):
+    """Test `JSONPGPPublicKeyField` values, key filters and key index."""
+    model = JSONModel
+
+    def setUp(self):
+        """Create rows with several statuses."""
+        self.model.objects.create(payload={
+            'status': 'active',
+            'address': {'city': 'Paris'},
+            'count': 3,
+        })
+        self.model.objects.create(payload={'status': 'closed', 'count': 4})
+        self.model.objects.create(payload={'status': {'code': 1}})
+        self.model.objects.create()
+
+    def get_counts(self, **lookups):
+        """Return the `count` of the rows matching `lookups`."""
+        return sorted(
+            payload['count'] for payload in
+            self.model.objects.filter(**lookups).values_list('payload', flat=True)
+        )
+
+    def test_value(self):
+        """Assert values are decrypted to JSON."""
+        instance = self.model.objects.get(payload__status='active')
+        self.assertEqual(instance.payload['address'], {'city': 'Paris'})
+
+        instance = self.model.lazy_objects.get(payload__status='closed')
+        self.assertEqual(instance.payload, {'status': 'closed', 'count': 4})
+
+    def test_null(self):
+        """Assert `NULL` is not stored as JSON."""
+        self.assertEqual(self.model.objects.filter(payload__isnull=True).count(), 1)
+
+    def test_key(self):
+        """Assert key filters compare the decrypted text at the key."""
+        self.assertEqual(self.get_counts(payload__status='closed'), [4])
+        self.assertEqual(self.get_counts(payload__count=3), [3])
+        self.assertEqual(self.get_counts(payload__status__startswith='act'), [3])
+        self.assertEqual(self.get_counts(payload__address__city='Paris'), [3])
+
+    def test_key_json_values(self):
+        """Assert numbers, booleans and `None` are compared as JSON values."""
+        self.model.objects.create(payload={'status': True, 'ratio': 0.5, 'count': 5})
+        self.model.objects.create(payload={'status': None, 'flag': False, 'count': 6})
+
+        self.assertEqual(self.get_counts(payload__status=True), [5])
+        self.assertEqual(self.get_counts(payload__ratio=0.5), [5])
+        self.assertEqual(self.get_counts(payload__flag=False), [6])
+        self.assertEqual(
+            self.get_counts(payload__status__exact=None, payload__isnull=False),
+            [6],
+        )
+
+    def test_query(self):
+        """Assert filters on an indexed key look for its token."""
+        queryset = self.model.objects.filter(payload__status='active')
+        self.assertIn('"payload_key_index" @> ', str(queryset.query))
+
+        queryset = self.model.objects.filter(payload__count=3)
+        self.assertNotIn('"payload_key_index" @> ', str(queryset.query))
+
+    def test_key_index_object(self):
+        """Assert objects are found without the key index."""
+        self.assertEqual(
+            self.model.objects.filter(payload__status='{"code": 1}').count(),
+            1,
+        )
+
+    def test_tokens(self):
+        """Assert the values of the indexed keys only are tokenized."""
+        instance = self.model.objects.get(payload__status='active')
+        self.assertEqual(len(instance.payload_key_index), 1)
+
+        instance = self.model.objects.get(payload__status__code='1')
+        self.assertEqual(instance.payload_key_index, [])
+
+    def test_deconstruct(self):
+        """Assert `key_index` is kept in migrations."""
+        field = self.model._meta.get_field('payload')
+        name, path, args, kwargs = field.deconstruct()
+        self.assertEqual(kwargs['key_index'], ['status'])
+
+
+class TestExpressions(TestCase):
+    """Test PGP fields can be decrypted and encrypted with expressions."""
+    model = EncryptedModel
+
+    def test_order_by(self):
+        """Assert a queryset can be ordered by a decrypted value."""
+        for value in ('b', 'c', 'a'):
+            EncryptedModelFactory.create(pgp_pub_field=value)
+
+        queryset = self.model.objects.annotate(
+            aggregates.PGPPublicKeyDecrypt('pgp_pub_field'),
+        ).order_by('pgp_pub_field__decrypted')
+        self.assertEqual(
+            [instance.pgp_pub_field for instance in queryset],
+            ['a', 'b', 'c'],
+        )
+
+    def test_param_key_binding(self):
+        """Assert the private key can be sent as a parameter."""
+        EncryptedModelFactory.create(pgp_pub_field='bonjour')
+
+        queryset = self.model.objects.annotate(
+            aggregates.PGPPublicKeyDecrypt(
+                'pgp_pub_field',
+                key_binding=KEY_BINDING_PARAM,
+            ),
+        )
+        self.assertEqual(queryset.get().pgp_pub_field__decrypted, 'bonjour')
+
+    def test_encrypt_update(self):
+        """Assert a field can be updated with an encrypted expression."""
+        EncryptedModelFactory.create(pgp_pub_field='bonjour')
+
+        self.model.objects.update(
+            email_pgp_pub_field=aggregates.PGPPublicKeyEncrypt(Value('a@b.com')),
+        )
+        self.assertEqual(self.model.objects.get().email_pgp_pub_field, 'a@b.com')
+
+    def test_encrypt_decrypted_update(self):
+        """Assert a field can be updated from the decrypted value of another."""
+        EncryptedModelFactory.create(pgp_pub_field='a@b.com')
+
+        self.model.objects.update(
+            email_pgp_pub_field=aggregates.PGPPublicKeyEncrypt(
+                aggregates.PGPPublicKeyDecrypt(F('pgp_pub_field')),
+            ),
+        )
+        self.assertEqual(self.model.objects.get().email_pgp_pub_field, 'a@b.com')
+
+    def test_select_related(self):
+        """Assert PGP fields of related models are decrypted with the query."""
+        RelatedModel.objects.create(
+            encrypted=EncryptedModelFactory.create(pgp_pub_field='bonjour'),
+        )
+        RelatedModel.objects.create()
+
+        with self.assertNumQueries(1):
+            instances = list(
+                RelatedModel.objects.select_related('encrypted').order_by('pk'),
+            )
+            self.assertEqual(instances[0].encrypted.pgp_pub_field, 'bonjour')
+            self.assertIsNone(instances[1].encrypted)
+
+    def test_select_related_lazy(self):
+        """Assert PGP fields of related models are decrypted together on access."""
+        for value in ('bonjour', 'hello'):
+            RelatedModel.objects.create(
+                encrypted=EncryptedModelFactory.create(pgp_pub_field=value),
+            )
+
+        with self.assertNumQueries(2):
+            instances = list(
+                RelatedModel.lazy_objects.select_related('encrypted').order_by('pk'),
+            )
+            self.assertEqual(
+                [instance.encrypted.pgp_pub_field for instance in instances],
+                ['bonjour', 'hello'],
+            )
+
+
+class TestDecryptedAggregates(TestCase):
+    """Test the decrypted values of PGP fields are aggregated by postgres."""
+    model = EncryptedModel
+
+    def setUp(self):
+        """Create instances with integer and date values, and one without."""
+        for value in (1, 2, 3, 3):
+            EncryptedModelFactory.create(
+                integer_pgp_pub_field=value,
+                pgp_pub_date_field=datetime.date(2016, 1, value),
+            )
+        EncryptedModelFactory.create(
+            integer_pgp_pub_field=None,
+            pgp_pub_date_field=None,
+        )
+
+    def test_aggregates(self):
+        """Assert the decrypted values are aggregated, ignoring NULL values."""
+        result = self.model.objects.aggregate(
+            total=aggregates.DecryptedSum('integer_pgp_pub_field'),
+            average=aggregates.DecryptedAvg('integer_pgp_pub_field'),
+            lowest=aggregates.DecryptedMin('integer_pgp_pub_field'),
+            first=aggregates.DecryptedMin('pgp_pub_date_field'),
+            last=aggregates.DecryptedMax('pgp_pub_date_field'),
+            distinct=aggregates.DecryptedCount('integer_pgp_pub_field', distinct=True),
+        )
+        self.assertEqual(result, {
+            'total': 9,
+            'average': 2.25,
+            'lowest': 1,
+            'first': datetime.date(2016, 1, 1),
+            'last': datetime.date(2016, 1, 3),
+            'distinct': 3,
+        })
+
+    def test_decrypted_in_aggregate(self):
+        """Assert the values are decrypted inside the aggregate."""
+        with CaptureQueriesContext(connection) as queries:
+            self.model.objects.aggregate(
+                aggregates.DecryptedSum('integer_pgp_pub_field'),
+            )
+        self.assertIn('SUM(CAST(nullif(pgp_pub_decrypt(', queries[0]['sql'])
+
+    def test_param_key_binding(self):
+        """Assert the private key can be sent as a parameter."""
+        result = self.model.objects.aggregate(
+            total=aggregates.DecryptedSum(
+                'integer_pgp_pub_field',
+                key_binding=KEY_BINDING_PARAM,
+            ),
+        )
+        self.assertEqual(result['total'], 9)
+
+    def test_related(self):
+        """Assert the decrypted values of related models are aggregated."""
+        for instance in self.model.objects.all():
+            RelatedModel.objects.create(encrypted=instance)
+
+        result = RelatedModel.objects.aggregate(
+            total=aggregates.DecryptedSum('encrypted__integer_pgp_pub_field'),
+        )
+        self.assertEqual(result['total'], 9)
+
+    def test_annotate(self):
+        """Assert the decrypted values can be aggregated by group."""
+        queryset = self.model.objects.values('pgp_pub_date_field').annotate(
+            count=Count('pk'),
+            total=aggregates.DecryptedSum('integer_pgp_pub_field'),
+        ).order_by('pgp_pub_date_field')
+        self.assertEqual(
+            [(row['count'], row['total']) for row in queryset],
+            [(1, 1), (1, 2), (2, 6), (1, None)],
+        )
+
+    def test_symmetric(self):
+        """Assert the decrypted values of symmetric key fields are aggregated."""
+        for value in (4, 5):
+            SymmetricEncryptedModel.objects.create(integer_pgp_sym_field=value)
+
+        result = SymmetricEncryptedModel.objects.aggregate(
+            total=aggregates.DecryptedSum('integer_pgp_sym_field'),
+        )
+        self.assertEqual(result['total'], 9)
+
+
+class TestSymmetricEncryptedModel(TestCase):
+    """Test the PGP symmetric key fields in a `Django` model."""
+    model = SymmetricEncryptedModel
+
+    def setUp(self):
+        """Create an instance with encrypted values."""
+        self.model.objects.create(
+            email_pgp_sym_field='a@b.com',
+            integer_pgp_sym_field=-42,
+            pgp_sym_field='bonjour',
+            pgp_sym_date_field=datetime.date(2000, 1, 1),
+            pgp_sym_null_boolean_field=False,
+        )
+
+    def assertValues(self, instance):
+        """Assert `instance` holds the decrypted values."""
+        self.assertEqual(instance.email_pgp_sym_field, 'a@b.com')
+        self.assertEqual(instance.integer_pgp_sym_field, -42)
+        self.assertEqual(instance.pgp_sym_field, 'bonjour')
+        self.assertEqual(instance.pgp_sym_date_field, datetime.date(2000, 1, 1))
+        self.assertIs(instance.pgp_sym_null_boolean_field, False)
+
+    def test_value(self):
+        """Assert values are decrypted with the query."""
+        with self.assertNumQueries(1):
+            self.assertValues(self.model.objects.get())
+
+    def test_value_param_key_binding(self):
+        """Assert values are decrypted with the key sent as a parameter."""
+        self.assertValues(self.model.param_key_objects.get())
+
+    def test_value_session_key_binding(self):
+        """Assert values are decrypted with the key of the database session."""
+        keys.set_session_keys(connection)
+        self.assertValues(self.model.session_key_objects.get())
+
+    def test_value_lazy(self):
+        """Assert values are decrypted on first access."""
+        self.assertValues(self.model.lazy_objects.get())
+
+    @override_settings(PGCRYPTO_KEY="it's 100%s")
+    def test_quoted_key(self):
+        """Assert a key with quotes and `%` is escaped in the SQL."""
+        instance = self.model.objects.create(pgp_sym_field='hello')
+        self.assertEqual(self.model.objects.get(pk=instance.pk).pgp_sym_field, 'hello')
+
+    def test_null(self):
+        """Assert `NULL` values are kept."""
+        instance = self.model.objects.create()
+        instance = self.model.objects.get(pk=instance.pk)
+        self.assertIsNone(instance.pgp_sym_field)
+        self.assertIsNone(instance.integer_pgp_sym_field)
+
+    def test_not_public_key(self):
+        """Assert values are not encrypted with the public key."""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pgp_key_id(pgp_sym_field) FROM tests_symmetricencryptedmodel',
+            )
+            self.assertEqual(cursor.fetchone()[0], 'SYMKEY')
+
+    def test_decrypt_annotate(self):
+        """Assert the values can be decrypted with an expression."""
+        queryset = self.model.objects.annotate(
+            aggregates.PGPSymmetricKeyDecrypt('pgp_sym_field'),
+        )
+        self.assertEqual(queryset.get().pgp_sym_field__decrypted, 'bonjour')
+
+    def test_encrypt_update(self):
+        """Assert a field can be updated with an encrypted expression."""
+        self.model.objects.update(
+            pgp_sym_field=aggregates.PGPSymmetricKeyEncrypt(Value('hello')),
+        )
+        self.assertEqual(self.model.objects.get().pgp_sym_field, 'hello')
+
+
+class TestPGPyBackend(TestCase):
+    """Test fields encrypted and decrypted in the application by `PGPyBackend`."""
+    model = PGPyModel
+
+    def test_value(self):
+        """Assert values are decrypted in the application."""
+        self.model.objects.create(
+            integer_pgp_pub_field=42,
+            pgp_pub_field='bonjour',
+            pgp_sym_date_field=datetime.date(2000, 1, 1),
+            email_pgp_pub_field='a@b.com',
+        )
+
+        with CaptureQueriesContext(connection) as context:
+            instance = self.model.objects.get()
+            self.assertEqual(instance.integer_pgp_pub_field, 42)
+            self.assertEqual(instance.pgp_pub_field, 'bonjour')
+            self.assertEqual(instance.pgp_sym_date_field, datetime.date(2000, 1, 1))
+            self.assertEqual(instance.email_pgp_pub_field, 'a@b.com')
+
+        self.assertEqual(len(context.captured_queries), 1)
+        sql = context.captured_queries[0]['sql']
+        self.assertNotIn('pgp_pub_decrypt("tests_pgpymodel"."pgp_pub_field"', sql)
+        self.assertIn('pgp_pub_decrypt("tests_pgpymodel"."email_pgp_pub_field"', sql)
+
+    def test_decrypted_by_postgres(self):
+        """Assert values encrypted by `PGPyBackend` can be decrypted by pgcrypto."""
+        self.model.objects.create(
+            pgp_pub_field='bonjour',
+            pgp_sym_date_field=datetime.date(2000, 1, 1),
+        )
+
+        instance = self.model.objects.annotate(
+            aggregates.PGPPublicKeyDecrypt('pgp_pub_field'),
+            aggregates.PGPSymmetricKeyDecrypt('pgp_sym_date_field'),
+        ).get()
+        self.assertEqual(instance.pgp_pub_field__decrypted, 'bonjour')
+        self.assertEqual(
+            instance.pgp_sym_date_field__decrypted,
+            datetime.date(2000, 1, 1),
+        )
+
+    def test_encrypted_by_postgres(self):
+        """Assert values encrypted by pgcrypto can be decrypted by `PGPyBackend`."""
+        self.model.objects.create()
+        self.model.objects.update(
+            pgp_pub_field=aggregates.PGPPublicKeyEncrypt(Value('bonjour')),
+            pgp_sym_date_field=aggregates.PGPSymmetricKeyEncrypt(Value('2000-01-01')),
+        )
+
+        instance = self.model.objects.get()
+        self.assertEqual(instance.pgp_pub_field, 'bonjour')
+        self.assertEqual(instance.pgp_sym_date_field, datetime.date(2000, 1, 1))
+
+    def test_null(self):
+        """Assert `NULL` values are kept."""
+        self.model.objects.create()
+        instance = self.model.objects.get()
+        self.assertIsNone(instance.pgp_pub_field)
+        self.assertIsNone(instance.integer_pgp_pub_field)
+
+    def test_processes(self):
+        """Assert large batches are encrypted and decrypted by worker processes."""
+        backend = backends.PGPyBackend(workers=2, processes=True, min_batch_size=3)
+        field = self.model._meta.get_field('pgp_pub_field')
+        texts = ['bonjour', None, 'hello', 'hola']
+        try:
+            ciphertexts = backend.encrypt_values(field, texts)
+            # Ciphertexts are loaded from the database as memoryviews.
+            values = [
+                six.memoryview(ciphertext) if ciphertext is not None else None
+                for ciphertext in ciphertexts
+            ]
+            self.assertEqual(backend.decrypt(field, values), texts)
+        finally:
+            backend.close()
+
+        self.assertIsNone(backend._pool)
+
+
+class TestBulkEncrypted(TestCase):
+    """Test `bulk_create_encrypted` and `bulk_update_encrypted`."""
+    model = BlindIndexModel
+
+    def assertStatements(self, context, count, keyword):
+        """Assert `count` statements starting with `keyword` were sent."""
+        statements = [
+            query['sql'] for query in context.captured_queries
+            if query['sql'].startswith(keyword)
+        ]
+        self.assertEqual(len(statements), count)
+        return statements
+
+    def test_bulk_create(self):
+        """Assert values are encrypted with the public key sent once."""
+        with CaptureQueriesContext(connection) as context:
+            count = self.model.objects.bulk_create_encrypted(
+                self.model(email_pgp_pub_field='user{}@b.com'.format(i))
+                for i in range(3)
+            )
+
+        self.assertEqual(count, 3)
+        sql, = self.assertStatements(context, 1, 'INSERT')
+        self.assertEqual(sql.count('BEGIN PGP PUBLIC KEY'), 1)
+        self.assertEqual(
+            sorted(self.model.objects.values_list('email_pgp_pub_field', flat=True)),
+            ['user0@b.com', 'user1@b.com', 'user2@b.com'],
+        )
+        self.assertTrue(
+            self.model.objects.filter(email_pgp_pub_field='user1@b.com').exists(),
+        )
+
+    def test_bulk_create_batches(self):
+        """Assert a statement is sent when a batch reaches its size."""
+        objs = [self.model(integer_pgp_pub_field=i) for i in range(5)]
+
+        with CaptureQueriesContext(connection) as context:
+            self.model.objects.bulk_create_encrypted(objs, batch_size=2)
+        self.assertStatements(context, 3, 'INSERT')
+
+        with CaptureQueriesContext(connection) as context:
+            self.model.objects.bulk_create_encrypted(objs, max_batch_bytes=1)
+        self.assertStatements(context, 5, 'INSERT')
+
+        self.assertEqual(self.model.objects.count(), 10)
+
+    def test_bulk_create_symmetric_key(self):
+        """Assert symmetric key fields are encrypted with their options."""
+        SymmetricEncryptedModel.objects.bulk_create_encrypted([
+            SymmetricEncryptedModel(
+                pgp_sym_field='bonjour',
+                pgp_sym_date_field=datetime.date(2000, 1, 1),
+            ),
+        ])
+
+        instance = SymmetricEncryptedModel.objects.get()
+        self.assertEqual(instance.pgp_sym_field, 'bonjour')
+        self.assertEqual(instance.pgp_sym_date_field, datetime.date(2000, 1, 1))
+
+    def test_bulk_create_pgpy_backend(self):
+        """Assert fields with an application backend are encrypted by it."""
+        PGPyModel.objects.bulk_create_encrypted([
+            PGPyModel(pgp_pub_field='bonjour', email_pgp_pub_field='a@b.com'),
+            PGPyModel(),
+        ])
+
+        instances = PGPyModel.objects.order_by('pk')
+        self.assertEqual(
+            [(i.pgp_pub_field, i.email_pgp_pub_field) for i in instances],
+            [('bonjour', 'a@b.com'), (None, None)],
+        )
+
+    def test_bulk_create_ciphertexts(self):
+        """Assert ciphertexts which have not been decrypted are copied."""
+        EncryptedModelFactory.create(pgp_pub_field='bonjour')
+        instance = EncryptedModel.lazy_objects.get()
+        instance.pk = None
+
+        EncryptedModel.objects.bulk_create_encrypted([
+            instance,
+            EncryptedModel(pgp_pub_field='hello'),
+        ])
+
+        self.assertEqual(
+            sorted(EncryptedModel.objects.values_list('pgp_pub_field', flat=True)),
+            ['bonjour', 'bonjour', 'hello'],
+        )
+
+    def test_bulk_update(self):
+        """Assert values and their blind index are updated."""
+        self.model.objects.bulk_create_encrypted([
+            self.model(email_pgp_pub_field='a@b.com', integer_pgp_pub_field=1),
+            self.model(email_pgp_pub_field='c@d.com', integer_pgp_pub_field=2),
+        ])
+        objs = list(self.model.objects.order_by('pk'))
+        for obj in objs:
+            obj.email_pgp_pub_field = obj.email_pgp_pub_field.upper()
+            obj.integer_pgp_pub_field = 42
+
+        with CaptureQueriesContext(connection) as context:
+            count = self.model.objects.bulk_update_encrypted(
+                objs,
+                ['email_pgp_pub_field'],
+            )
+
+        self.assertEqual(count, 2)
+        self.assertStatements(context, 1, 'UPDATE')
+        self.assertEqual(
+            list(self.model.objects.order_by('pk').values_list(
+                'email_pgp_pub_field',
+                'integer_pgp_pub_field',
+            )),
+            [('A@B.COM', 1), ('C@D.COM', 2)],
+        )
+        self.assertTrue(
+            self.model.objects.filter(email_pgp_pub_field='C@D.COM').exists(),
+        )
+
+    def test_bulk_update_primary_key(self):
+        """Assert the primary key can't be updated."""
+        with self.assertRaises(ValueError):
+            self.model.objects.bulk_update_encrypted([], ['id'])
+
+
+class TestStreaming(TestCase):
+    """Test decrypted rows can be streamed with constant memory."""
+    model = EncryptedModel
+
+    def setUp(self):
+        """Create instances with encrypted values."""
+        for i in range(3):
+            EncryptedModelFactory.create(
+                pgp_pub_field='Text {}'.format(i),
+                integer_pgp_pub_field=i,
+            )
+
+    def test_iterator(self):
+        """Assert `iterator()` decrypts the values."""
+        values = [
+            instance.pgp_pub_field
+            for instance in self.model.objects.order_by('pk').iterator()
+        ]
+        self.assertEqual(values, ['Text 0', 'Text 1', 'Text 2'])
+
+    def test_stream_decrypted(self):
+        """Assert rows are decrypted in the order of `fields`."""
+        rows = streaming.stream_decrypted(
+            self.model.lazy_objects.order_by('pk'),
+            ['pgp_pub_field', 'integer_pgp_pub_field'],
+            chunk_size=2,
+        )
+        self.assertEqual(
+            list(rows),
+            [('Text 0', 0), ('Text 1', 1), ('Text 2', 2)],
+        )
+
+    def test_stream_decrypted_empty(self):
+        """Assert empty querysets don't return any row."""
+        rows = streaming.stream_decrypted(self.model.objects.none())
+        self.assertEqual(list(rows), [])
+
+    def test_stream_decrypted_pgpy_backend(self):
+        """Assert fields with an application backend are decrypted by chunks."""
+        PGPyModel.objects.create(pgp_pub_field='bonjour', email_pgp_pub_field='a@b.com')
+        rows = streaming.stream_decrypted(
+            PGPyModel.objects.all(),
+            ['email_pgp_pub_field', 'pgp_pub_field'],
+        )
+        self.assertEqual(list(rows), [('a@b.com', 'bonjour')])
+
+    def test_copy_decrypted(self):
+        """Assert `COPY` writes the decrypted values as CSV."""
+        output = StringIO()
+        streaming.copy_decrypted(
+            self.model.objects.filter(integer_pgp_pub_field__isnull=False).order_by('pk'),
+            output,
+            ['pgp_pub_field', 'integer_pgp_pub_field'],
+        )
+        self.assertEqual(
+            output.getvalue().splitlines(),
+            ['pgp_pub_field,integer_pgp_pub_field', 'Text 0,0', 'Text 1,1', 'Text 2,2'],
+        )
+
+    def test_command_csv(self):
+        """Assert the command exports CSV."""
+        for copy in ([], ['--no-copy']):
+            output = StringIO()
+            call_command(
+                'pgcrypto_export',
+                'tests.EncryptedModel',
+                '--fields=id,pgp_pub_field',
+                *copy,
+                stdout=output
+            )
+            lines = output.getvalue().splitlines()
+            self.assertEqual(lines[0], 'id,pgp_pub_field')
+            self.assertEqual([line.split(',')[1] for line in lines[1:]], [
+                'Text 0',
+                'Text 1',
+                'Text 2',
+            ])
+
+    def test_command_jsonl(self):
+        """Assert the command exports JSON lines."""
+        output = StringIO()
+        call_command(
+            'pgcrypto_export',
+            'tests.EncryptedModel',
+            '--fields=pgp_pub_field,pgp_pub_date_field',
+            '--format=jsonl',
+            stdout=output,
+        )
+        rows = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(rows[0], {
+            'pgp_pub_field': 'Text 0',
+            'pgp_pub_date_field': '2000-01-01',
+        })
+        self.assertEqual(len(rows), 3)
+
+
+@override_settings(
+    SERIALIZATION_MODULES={'pgcrypto_json': 'pgcrypto_fields.serializers'},
+)
+class TestCiphertextPassthrough(TestCase):
+    """Test ciphertexts can be dumped, loaded and copied without decrypting them."""
+    model = EncryptedModel
+    multi_db = True
+
+    def setUp(self):
+        """Create an instance with encrypted values."""
+        self.instance = EncryptedModelFactory.create(
+            pgp_pub_field='bonjour',
+            integer_pgp_pub_field=42,
+        )
+
+    def get_ciphertexts(self, using='default'):
+        """Return the ciphertexts of the instance."""
+        values = self.model.objects.using(using).ciphertexts().values_list(
+            'pgp_pub_field',
+            'integer_pgp_pub_field',
+        )
+        return [bytes(value) for value in values.get()]
+
+    def test_ciphertexts(self):
+        """Assert the ciphertexts are loaded and never decrypted."""
+        instance = self.model.objects.ciphertexts().get()
+
+        with self.assertNumQueries(0):
+            self.assertIsInstance(instance.pgp_pub_field, six.memoryview)
+            self.assertIsInstance(instance.integer_pgp_pub_field, six.memoryview)
+
+    def test_save(self):
+        """Assert the ciphertexts are saved as they are, and new values encrypted."""
+        ciphertexts = self.get_ciphertexts()
+
+        instance = self.model.ciphertext_objects.get()
+        instance.integer_pgp_pub_field = 7
+        instance.save()
+
+        instance = self.model.objects.get()
+        self.assertEqual(instance.pgp_pub_field, 'bonjour')
+        self.assertEqual(instance.integer_pgp_pub_field, 7)
+        self.assertEqual(self.get_ciphertexts()[0], ciphertexts[0])
+
+    def test_dumpdata_loaddata(self):
+        """Assert fixtures hold the ciphertexts, loaded as they are."""
+        ciphertexts = self.get_ciphertexts()
+        output = StringIO()
+        call_command(
+            'dumpdata',
+            'tests.EncryptedModel',
+            format='pgcrypto_json',
+            stdout=output,
+        )
+        self.assertNotIn('bonjour', output.getvalue())
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'encrypted.pgcrypto_json')
+        with open(path, 'w') as fixture:
+            fixture.write(output.getvalue())
+        self.model.objects.all().delete()
+        call_command('loaddata', path, verbosity=0)
+
+        self.assertEqual(self.get_ciphertexts(), ciphertexts)
+        instance = self.model.objects.get()
+        self.assertEqual(instance.pgp_pub_field, 'bonjour')
+        self.assertEqual(instance.integer_pgp_pub_field, 42)
+
+    def test_blind_index(self):
+        """Assert the blind index is loaded with its ciphertext."""
+        BlindIndexModel.objects.create(email_pgp_pub_field='a@b.com')
+        data = serializers.serialize(
+            'pgcrypto_json',
+            BlindIndexModel.objects.all(),
+        )
+        BlindIndexModel.objects.all().delete()
+
+        for obj in serializers.deserialize('pgcrypto_json', data):
+            obj.save()
+
+        self.assertEqual(
+            BlindIndexModel.objects.filter(email_pgp_pub_field='a@b.com').count(),
+            1,
+        )
+
+    def test_decrypted_value(self):
+        """Assert decrypted values can't be serialized as ciphertexts."""
+        with self.assertRaises(SerializationError):
+            serializers.serialize('pgcrypto_json', [self.instance])
+
+    def test_copy_ciphertexts(self):
+        """Assert rows are copied to another database as they are."""
+        count = streaming.copy_ciphertexts(
+            self.model.objects.all(),
+            using='replica',
+            chunk_size=1,
+        )
+
+        self.assertEqual(count, 1)
+        self.assertEqual(self.get_ciphertexts('replica'), self.get_ciphertexts())
+        self.assertEqual(
+            self.model.objects.using('replica').get().pgp_pub_field,
+            'bonjour',
+        )
+        # The sequence of the primary key was reset.
+        self.model.objects.using('replica').create()
+
+
+@override_settings(PREVIOUS_PRIVATE_PGP_KEYS=[PREVIOUS_PRIVATE_PGP_KEY])
+class TestSizeReport(TestCase):
+    """Test the sizes of the ciphertexts are reported."""
+    model = EncryptedModel
+
+    def test_column_sizes(self):
+        """Assert the plaintexts and ciphertexts are measured."""
+        EncryptedModelFactory.create_batch(2, pgp_pub_field='bonjour')
+        EncryptedModelFactory.create(pgp_pub_field=None)
+
+        result = sizes.get_column_sizes(self.model._meta.get_field('pgp_pub_field'))
+
+        self.assertEqual(result['values'], 2)
+        self.assertEqual(result['plaintext'], 14)
+        self.assertGreater(result['ciphertext'], result['plaintext'])
+        self.assertGreater(result['stored'], 0)
+
+    def test_sample(self):
+        """Assert only `sample` values are measured."""
+        EncryptedModelFactory.create_batch(3)
+
+        result = sizes.get_column_sizes(
+            self.model._meta.get_field('pgp_pub_field'),
+            sample=2,
+        )
+
+        self.assertEqual(result['values'], 2)
+
+    def test_command(self):
+        """Assert the command reports each field of the models."""
+        EncryptedModelFactory.create(pgp_pub_field='bonjour')
+        output = StringIO()
+
+        call_command('pgcrypto_size_report', 'tests.EncryptedModel', stdout=output)
+
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('tests.EncryptedModel: '))
+        self.assertIn(
+            'tests.EncryptedModel.pgp_pub_field: 1 values, plaintext 7.0, ',
+            output.getvalue(),
+        )
+
+
+class TestKeyRotation(TestCase):
+    """Test values encrypted with a previous key are decrypted and re-encrypted."""
+    model = EncryptedModel
+
+    def setUp(self):
+        """Create rows encrypted with the previous public key."""
+        for i in range(3):
+            EncryptedModelFactory.create(pgp_pub_field='Text {}'.format(i))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'UPDATE tests_encryptedmodel SET '
+                'pgp_pub_field = pgp_pub_encrypt(%s, dearmor(%s)), '
+                'integer_pgp_pub_field = pgp_pub_encrypt(id::text, dearmor(%s))',
+                ['Previous', PREVIOUS_PUBLIC_PGP_KEY, PREVIOUS_PUBLIC_PGP_KEY],
+            )
+
+    def get_key_ids(self):
+        """Return the ids of the keys which encrypted `pgp_pub_field`."""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT DISTINCT pgp_key_id(pgp_pub_field) FROM tests_encryptedmodel',
+            )
+            return sorted(row[0] for row in cursor.fetchall())
+
+    def test_key_id(self):
+        """Assert key ids are the ones read by `pgp_key_id`."""
+        self.assertEqual(keys.key_id(settings.PUBLIC_PGP_KEY), '4DE3FE5E142BD81D')
+        self.assertEqual(keys.key_id(settings.PRIVATE_PGP_KEY), '4DE3FE5E142BD81D')
+        self.assertEqual(self.get_key_ids(), [keys.key_id(PREVIOUS_PUBLIC_PGP_KEY)])
+
+    def test_decrypt_previous_key(self):
+        """Assert values encrypted with a previous key are decrypted."""
+        keys.set_session_keys(connection)
+        for manager in ('objects', 'param_key_objects', 'session_key_objects'):
+            instance = getattr(self.model, manager).order_by('pk').first()
+            self.assertEqual(instance.pgp_pub_field, 'Previous')
+            self.assertEqual(instance.integer_pgp_pub_field, instance.pk)
+
+    def test_rotate(self):
+        """Assert the command re-encrypts the values with the current key."""
+        output = StringIO()
+        call_command(
+            'rotate_pgcrypto_keys',
+            'tests.EncryptedModel',
+            '--batch-size=2',
+            stdout=output,
+        )
+
+        self.assertIn('3 rows re-encrypted', output.getvalue())
+        self.assertEqual(self.get_key_ids(), ['4DE3FE5E142BD81D'])
+        with self.settings(PREVIOUS_PRIVATE_PGP_KEYS=[]):
+            self.assertEqual(
+                list(self.model.objects.values_list('pgp_pub_field', flat=True)),
+                ['Previous'] * 3,
+            )
+        checkpoint = KeyRotationCheckpoint.objects.get()
+        self.assertTrue(checkpoint.completed)
+
+    def test_key_binding(self):
+        """Assert the keys are sent as defined by `key_binding`."""
+        rotation = KeyRotation(self.model, key_binding=KEY_BINDING_INLINE)
+        checkpoint, = rotation.get_checkpoints()
+        sql, params = rotation.rotate_sql(checkpoint, 1)
+        self.assertIn("dearmor('-----BEGIN PGP PUBLIC KEY BLOCK", sql)
+        self.assertEqual(params, [1])
+
+        keys.set_session_keys(connection)
+        call_command(
+            'rotate_pgcrypto_keys',
+            'tests.EncryptedModel',
+            '--key-binding=session',
+            '--reset',
+            stdout=StringIO(),
+        )
+        self.assertEqual(self.get_key_ids(), ['4DE3FE5E142BD81D'])
+
+    def test_resume(self):
+        """Assert the rotation resumes after the last saved primary key."""
+        first = self.model.objects.order_by('pk').first()
+        rotation = KeyRotation(self.model, batch_size=2)
+        checkpoint, = rotation.get_checkpoints()
+        checkpoint.last_pk = str(first.pk)
+        checkpoint.save()
+
+        self.assertEqual(rotation.rotate(), 2)
+        self.assertEqual(len(self.get_key_ids()), 2)
+
+        rotation.rotate(reset=True)
+        self.assertEqual(self.get_key_ids(), ['4DE3FE5E142BD81D'])
+
+    def test_ranges(self):
+        """Assert integer primary keys are split in ranges for the workers."""
+        pks = list(self.model.objects.order_by('pk').values_list('pk', flat=True))
+        rotation = KeyRotation(self.model)
+
+        self.assertEqual(rotation.get_ranges(1), [(None, None)])
+        self.assertEqual(rotation.get_ranges(3), [
+            (pks[0] - 1, pks[0]),
+            (pks[0], pks[0] + 1),
+            (pks[0] + 1, None),
+        ])